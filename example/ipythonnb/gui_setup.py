@@ -1,4 +1,5 @@
 from __future__ import print_function
+import os
 from warnings import filterwarnings
 filterwarnings('ignore', module='IPython.html.widgets')
 
@@ -8,6 +9,7 @@ from IPython.display import display, clear_output, HTML
 try:
     from tecancavro.models import XCaliburD
     from tecancavro.transport import TecanAPISerial, TecanAPINode
+    from tecancavro.discovery import PumpInventory
 except ImportError:  # Support direct import from package
     import sys
     import os
@@ -16,25 +18,25 @@ except ImportError:  # Support direct import from package
     sys.path.append(dirn(dirn(LOCAL_DIR)))
     from tecancavro.models import XCaliburD
     from tecancavro.transport import TecanAPISerial, TecanAPINode
+    from tecancavro.discovery import PumpInventory
 
-def findSerialPumps():
-    return TecanAPISerial.findSerialPumps()
+INVENTORY_CACHE = os.path.join(os.path.expanduser('~'),
+                               '.tecancavro_inventory.json')
 
+# Pumps are discovered in the background (cached inventory first) and are
+# added to the serial port dropdown as they come online
+device_dict = {}
 
-def getSerialPumps():
-    ''' Assumes that the pumps are XCaliburD pumps and returns a list of
-    (<serial port>, <instantiated XCaliburD>) tuples
-    '''
-    pump_list = findSerialPumps()
-    return [(ser_port, XCaliburD(com_link=TecanAPISerial(0,
-             ser_port, 9600))) for ser_port, _, _ in pump_list]
+valve_control = widgets.Dropdown(options=[str(x) for x in range(1,10)])
+port_control = widgets.Dropdown(options=[])
 
-devices = getSerialPumps()
-# devices = [('/dev/tty0', '')]
-device_dict = dict(devices)
+def pumpOnline(ser_port, pump):
+    device_dict[ser_port] = pump
+    port_control.options = list(device_dict)
+
+inventory = PumpInventory(cache_path=INVENTORY_CACHE, on_found=pumpOnline)
+inventory.start()
 
-valve_control = widgets.Dropdown(options=[str(x) for x in range(1,10)])
-port_control = widgets.Dropdown(options=[x[0] for x in devices])
 pull_volume_control = widgets.BoundedIntText(min=0, max=1000, value=0)
 push_volume_control = widgets.BoundedIntText(min=0, max=1000, value=0)
 notification_area = widgets.HTML("")
@@ -55,7 +57,7 @@ def extract(arg):
     volume = pull_volume_control.value
     update_notification("Received extract for: %d μl from port %d on serial port %s" % (volume,
           valve, serial_port))
-    if len(sp) > 0:
+    if serial_port in device_dict:
         device_dict[serial_port].extract(valve, volume)
     pull_button.disabled = False
 
@@ -71,7 +73,7 @@ def dispense(arg):
     volume = push_volume_control.value
     update_notification("Received dispense for: %d μl from port %d on serial port %s" % (volume,
           valve, serial_port))
-    if len(sp) > 0:
+    if serial_port in device_dict:
         device_dict[serial_port].dispense(valve, volume)
     push_button.disabled = False
 
@@ -1,8 +1,12 @@
 from __future__ import print_function
 
+import hashlib
+import os
+
 from flask import Flask, render_template, current_app, request
 from flask import json, jsonify, make_response, session, send_from_directory
 from flask import redirect, url_for, escape, make_response
+from flask import Response, stream_with_context
 from flask_bootstrap import Bootstrap
 
 # Create and configure out application.
@@ -18,6 +22,10 @@ app.jinja_env.lstrip_blocks = True
 try:
     from tecancavro.models import XCaliburD
     from tecancavro.transport import TecanAPISerial, TecanAPINode
+    from tecancavro.jobs import JobQueue
+    from tecancavro.status import StatusHub
+    from tecancavro.discovery import PumpInventory
+    from tecancavro.protocol import bindPumps, compileProtocol, submitProtocol
 except ImportError:  # Support direct import from package
     import sys
     import os
@@ -26,21 +34,65 @@ except ImportError:  # Support direct import from package
     sys.path.append(dirn(dirn(LOCAL_DIR)))
     from tecancavro.models import XCaliburD
     from tecancavro.transport import TecanAPISerial, TecanAPINode
+    from tecancavro.jobs import JobQueue
+    from tecancavro.status import StatusHub
+    from tecancavro.discovery import PumpInventory
+    from tecancavro.protocol import bindPumps, compileProtocol, submitProtocol
+
+# Pumps are discovered in the background (cached inventory first) and are
+# registered with the job queue and status poller as they come online, so
+# the app starts serving right away
+INVENTORY_CACHE = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                               'pump_inventory.json')
+
+# Pumps are only driven by their worker threads (see tecancavro/jobs.py)
+jobs = JobQueue({})
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
-def findSerialPumps():
-    return TecanAPISerial.findSerialPumps()
+# One background poller per serial bus feeds every status stream client
+STATUS_POLL_INTERVAL = 0.5
+status_hub = StatusHub(interval=STATUS_POLL_INTERVAL)
 
 
-def getSerialPumps():
-    ''' Assumes that the pumps are XCaliburD pumps and returns a list of
-    (<serial port>, <instantiated XCaliburD>) tuples
+def pumpOnline(key, pump):
+    # Inventory keys identify a pump by serial port and address (see
+    # tecancavro/discovery.py), since several pumps can share a bus
+    jobs.addPump(key, pump)
+    status_hub.addPumps({key: pump})
+
+# Compiled protocols keyed by content hash, so resubmitting a protocol skips
+# planning and validation
+PROTOCOL_CACHE = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                              'protocol_cache')
+
+inventory = PumpInventory(cache_path=INVENTORY_CACHE, on_found=pumpOnline)
+inventory.start()
+
+
+def getDevices():
+    ''' Returns (<serial port>, <XCaliburD>) tuples for the pumps that
+    are online so far
     '''
-    pump_list = findSerialPumps()
-    return [(ser_port, XCaliburD(com_link=TecanAPISerial(0,
-             ser_port, 9600))) for ser_port, _, _ in pump_list]
+    return inventory.items()
 
-devices = getSerialPumps()
-device_dict = dict(devices)
+
+def submitJob(sp, build=None, execute=False, description=''):
+    ''' Queues a job for the pump on serial port `sp` and returns a 202
+    response with the job id (404 if there is no such pump)
+    '''
+    try:
+        job_id = jobs.submit(sp, build, execute=execute,
+                             description=description)
+    except KeyError:
+        return jsonify(error='No pump on serial port %s' % sp), 404
+    response = jsonify(job_id=job_id)
+    response.status_code = 202
+    response.headers['Location'] = url_for('job_status', job_id=job_id)
+    return response
 
 #def get_resource_as_string(name, charset='utf-8'):
  #   with app.open_resource(name) as f:
@@ -74,70 +126,163 @@ device_dict = dict(devices)
 
 @app.route('/')
 def index():
-    global devices
     # the valve count is in the 2nd field of
     # each item in devices e.g "9dist"
     valves=list(range(1,10))
     params = {}
     params['valves'] = valves
-    params['devices'] = devices
+    params['devices'] = getDevices()
     return render_template('index.html', params=params)
 
 @app.route('/Simple_Commands')
 def Simple_Commands():
-    global devices
     # the valve count is in the 2nd field of
     # each item in devices e.g "9dist"
     valves=list(range(1,10))
     params = {}
     params['valves'] = valves
-    params['devices'] = devices
+    params['devices'] = getDevices()
     return render_template('Simple_Commands.html', params=params)
 
 @app.route('/Protocol')
 def Protocol():
-    global devices
     # the valve count is in the 2nd field of
     # each item in devices e.g "9dist"
     valves=list(range(1,10))
     params = {}
     params['valves'] = valves
-    params['devices'] = devices
+    params['devices'] = getDevices()
     return render_template('Protocol.html', params=params)
 
 @app.route('/extract')
 def extract_call():
-    global device_dict
     volume = int(request.args['volume'])
     port = int(request.args['port'])
     sp = request.args['serial_port']
     print("Received extract for: %d ul from port %d on serial port %s" % (volume,
           port, sp))
-    if len(sp) > 0:
-        device_dict[sp].extract(port, volume)
-    # device_dict[sp].doSomething(val)
-    return ('', 204)
+    if len(sp) == 0:
+        return ('', 204)
+    return submitJob(sp, lambda pump: pump.extract(port, volume),
+                     description='extract %d ul from port %d' % (volume, port))
 
 @app.route('/dispense')
 def dispense_call():
-    global device_dict
     volume = int(request.args['volume'])
     port = int(request.args['port'])
     sp = request.args['serial_port']
     print("Received dispense for: %d ul from port %d on serial port %s" % (volume,
           port, sp))
-    if len(sp) > 0:
-        device_dict[sp].dispense(port, volume)
-    return ('', 204)
+    if len(sp) == 0:
+        return ('', 204)
+    return submitJob(sp, lambda pump: pump.dispense(port, volume),
+                     description='dispense %d ul to port %d' % (volume, port))
 
 @app.route('/execute')
 def execute_call():
-    global device_dict
     sp = request.args['serial_port']
     print("executing chain")
-    if len(sp) > 0:
-        device_dict[sp].executeChain()
-    return ('', 204)
+    if len(sp) == 0:
+        return ('', 204)
+    return submitJob(sp, execute=True, description='execute chain')
+
+@app.route('/protocol', methods=['POST'])
+def protocol_call():
+    ''' Compiles and queues a whole protocol document (see
+    tecancavro/protocol.py). Protocol pump names are serial ports unless the
+    document maps them in `serial_ports` ({pump name: serial port}). Pump
+    configuration and state not given in the document are taken from the
+    connected pumps. Returns 202 with the job id and the estimated duration,
+    or 400 if the protocol does not compile.
+    '''
+    doc = request.get_json(force=True, silent=True)
+    if not isinstance(doc, dict):
+        return jsonify(error='Expected a JSON protocol document'), 400
+    doc = dict(doc)
+    serial_ports = doc.pop('serial_ports', {})
+    devices = dict(getDevices())
+    pumps = {}
+    for name in doc.get('pumps', {}):
+        sp = serial_ports.get(name, name)
+        if sp not in devices:
+            return jsonify(error='No pump on serial port %s' % sp), 404
+        pumps[name] = devices[sp]
+    try:
+        compiled = compileProtocol(bindPumps(doc, pumps),
+                                   cache_dir=PROTOCOL_CACHE)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    job_id = submitProtocol(compiled, jobs, serial_ports)
+    print("Queued protocol %s: %d phases, %.1f s" % (compiled['hash'][:12],
+          len(compiled['phases']), compiled['exec_time']))
+    response = jsonify(job_id=job_id, hash=compiled['hash'],
+                       phases=len(compiled['phases']),
+                       exec_time=compiled['exec_time'])
+    response.status_code = 202
+    response.headers['Location'] = url_for('job_status', job_id=job_id)
+    return response
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    status = jobs.status(job_id)
+    if status is None:
+        return jsonify(error='Unknown job %s' % job_id), 404
+    return jsonify(status)
+
+@app.route('/jobs')
+def pending_jobs():
+    sp = request.args.get('serial_port')
+    return jsonify(jobs=jobs.pending(sp))
+
+@app.route('/status')
+def status_call():
+    ''' JSON pump state served from each pump's cached state (no bus
+    traffic). The ETag is derived from the pumps' state versions, so
+    clients polling with If-None-Match get a 304 until a pump's state
+    changes. Optionally filtered by `serial_port`.
+    '''
+    sp = request.args.get('serial_port')
+    snapshots = [(port, id(pump), pump.stateSnapshot())
+                 for port, pump in getDevices() if sp is None or port == sp]
+    etag = hashlib.sha1(json.dumps(
+        [(port, pump_id, version)
+         for port, pump_id, (version, _) in snapshots]
+        ).encode('utf-8')).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+    else:
+        response = jsonify(pumps={port: {'version': version, 'state': state}
+                                  for port, _, (version, state) in snapshots})
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/status/stream')
+def status_stream():
+    ''' Server-Sent Events stream of pump status. Sends a `snapshot` event
+    with the full status of every pump, followed by `status` events with
+    the fields that changed.
+    '''
+    def events():
+        snapshot, updates = status_hub.subscribe()
+        try:
+            yield 'event: snapshot\ndata: %s\n\n' % json.dumps(snapshot)
+            while True:
+                try:
+                    event = updates.get(timeout=15)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                if event is None:
+                    # Client fell behind; it will reconnect and resync
+                    break
+                yield 'id: %d\nevent: status\ndata: %s\n\n' % (
+                    event['seq'], json.dumps(event))
+        finally:
+            status_hub.unsubscribe(updates)
+    return Response(stream_with_context(events()),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
 
 @app.route('/tables')
 def tables():
@@ -33,6 +33,7 @@ setup(
     name=DISTNAME,
     maintainer=AUTHORS,
     packages=['tecancavro'],
+    extras_require={'numpy': ['numpy']},
     maintainer_email=EMAIL,
     description=DESCRIPTION,
     license=LICENSE,
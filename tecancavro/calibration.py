@@ -0,0 +1,192 @@
+"""
+calibration.py
+
+Contains the `TimingCalibration` class, which holds per-device corrections
+to the plunger and valve motion-time models, and `calibratePump`, which
+fits those corrections from timed moves on a pump (or emulator).
+
+"""
+import os
+
+try:
+    import simplejson as json
+except:
+    import json
+
+from .motion import plungerMoveTime, valveTravel
+from .syringe import SyringeTimeout
+
+
+class TimingCalibration(object):
+    """
+    Per-device timing corrections. Estimated plunger move times are
+    corrected as `plunger_scale * model_time + plunger_offset` and valve
+    moves are estimated to take `valve_base_time` seconds plus
+    `valve_time_per_deg` seconds per degree of valve rotation.
+
+    """
+
+    def __init__(self, plunger_scale=1.0, plunger_offset=0.0,
+                 valve_base_time=0.1, valve_time_per_deg=0.1/90):
+        self.plunger_scale = plunger_scale
+        self.plunger_offset = plunger_offset
+        self.valve_base_time = valve_base_time
+        self.valve_time_per_deg = valve_time_per_deg
+
+    def plungerTime(self, model_time):
+        """ Returns the corrected time for a modelled plunger move time """
+        return self.plunger_scale * model_time + self.plunger_offset
+
+    def valveTime(self, port_steps, num_ports):
+        """
+        Returns the time for a valve move of `port_steps` ports on a valve
+        with `num_ports` evenly spaced ports
+
+        """
+        if port_steps == 0:
+            return 0
+        degrees = port_steps * 360.0 / num_ports
+        return self.valve_base_time + self.valve_time_per_deg * degrees
+
+    def toDict(self):
+        return {
+            'plunger_scale': self.plunger_scale,
+            'plunger_offset': self.plunger_offset,
+            'valve_base_time': self.valve_base_time,
+            'valve_time_per_deg': self.valve_time_per_deg
+        }
+
+    def save(self, path):
+        """ Saves the calibration to a JSON file at `path` """
+        with open(path, 'w') as fd:
+            json.dump(self.toDict(), fd, indent=2, sort_keys=True)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a calibration from a JSON file at `path`. Returns the default
+        (uncorrected) calibration if the file does not exist.
+
+        """
+        if not os.path.exists(path):
+            return cls()
+        with open(path) as fd:
+            return cls(**json.load(fd))
+
+
+def _fitLine(xs, ys, default_slope):
+    """
+    Least-squares fit of `ys = a * xs + b` with `b >= 0`, returns `(a, b)`.
+    If all `xs` are equal, the slope cannot be fitted: `a` is kept at
+    `default_slope` and only `b` is fitted.
+
+    """
+    n = float(len(xs))
+    mean_x = sum(xs) / n
+    mean_y = sum(ys) / n
+    var_x = sum((x - mean_x) ** 2 for x in xs)
+    if var_x == 0:
+        return default_slope, max(mean_y - default_slope * mean_x, 0.0)
+    cov_xy = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys))
+    a = cov_xy / var_x
+    b = mean_y - a * mean_x
+    if b < 0:
+        # Refit through the origin
+        a = sum(x * y for x, y in zip(xs, ys)) / sum(x * x for x in xs)
+        b = 0.0
+    return a, b
+
+
+def _timeExecution(pump, polling_interval, timeout):
+    """
+    Executes the pump's current command chain and returns the time in
+    seconds until the pump reports ready again.
+
+    """
+    tic = pump._time()
+    pump.executeChain()
+    pump._ready = False
+    while not pump._checkReady():
+        if pump._time() - tic > timeout:
+            raise SyringeTimeout('Timeout while timing pump move [{}]'
+                                 ''.format(timeout))
+        pump._sleep(polling_interval)
+    return pump._time() - tic
+
+
+def calibratePump(pump, stroke_fractions=(0.05, 0.25, 0.5, 1.0),
+                  speed_codes=(0, 5, 10, 14), port_pairs=None,
+                  polling_interval=0.01, timeout=120, path=None):
+    """
+    Runs a grid of plunger and valve moves on an initialized `pump`
+    (`XCaliburD` instance), measures their completion times, and fits
+    per-device timing corrections. The fitted `TimingCalibration` is
+    attached to the pump and, if a `path` (or the pump's
+    `calibration_path`) is set, persisted there so it is loaded
+    automatically the next time the pump is constructed.
+
+    Kwargs:
+        `stroke_fractions` (tuple) : plunger move lengths as fractions of a
+                                     full stroke
+        `speed_codes` (tuple) : speed codes to time each move at
+        `port_pairs` (list) : (from_port, to_port) valve moves to time
+            [default] - moves from port 1 to every other port
+        `polling_interval` (float) : ready polling interval in seconds
+        `timeout` (float) : max time in seconds for a single move
+
+    Returns:
+        `calibration` (TimingCalibration) : the fitted calibration
+
+    """
+    if port_pairs is None:
+        port_pairs = [(1, port) for port in range(2, pump.num_ports + 1)]
+    max_pos = 24000 if pump.state['microstep'] else 3000
+
+    pump.cacheSimSpeeds()
+    model_ts = []
+    measured_ts = []
+    for speed_code in speed_codes:
+        pump.setSpeed(speed_code, execute=True)
+        for fraction in stroke_fractions:
+            steps = int(round(fraction * max_pos))
+            pump.movePlungerAbs(0, execute=True)
+            pump.waitReady(timeout=timeout)
+            sd = pump.sim_state
+            model_ts.append(plungerMoveTime(steps, sd['start_speed'],
+                                            sd['top_speed'],
+                                            sd['cutoff_speed'], sd['slope'],
+                                            sd['microstep']))
+            pump.movePlungerAbs(steps)
+            measured_ts.append(_timeExecution(pump, polling_interval,
+                                              timeout))
+    pump.restoreSimSpeeds()
+    pump.executeChain()
+    pump.movePlungerAbs(0, execute=True)
+    pump.waitReady(timeout=timeout)
+
+    valve_degs = []
+    valve_ts = []
+    for from_port, to_port in port_pairs:
+        pump.changePort(from_port, execute=True)
+        pump.waitReady(timeout=timeout)
+        port_steps = valveTravel(from_port, to_port, pump.num_ports)[1]
+        valve_degs.append(port_steps * 360.0 / pump.num_ports)
+        pump.changePort(to_port, from_port=from_port)
+        valve_ts.append(_timeExecution(pump, polling_interval, timeout))
+
+    default = TimingCalibration()
+    plunger_scale, plunger_offset = _fitLine(model_ts, measured_ts,
+                                             default.plunger_scale)
+    valve_time_per_deg, valve_base_time = _fitLine(
+        valve_degs, valve_ts, default.valve_time_per_deg)
+    calibration = TimingCalibration(
+        plunger_scale=plunger_scale,
+        plunger_offset=plunger_offset,
+        valve_base_time=valve_base_time,
+        valve_time_per_deg=valve_time_per_deg
+    )
+    pump.calibration = calibration
+    path = path if path is not None else pump.calibration_path
+    if path is not None:
+        calibration.save(path)
+    return calibration
@@ -0,0 +1,518 @@
+"""
+capture.py
+
+Binary capture of Tecan OEM API frames. `startCapture` attaches a
+`FrameRecorder` to every `TecanAPI` link, which then appends each
+outgoing and incoming frame to a compact log:
+
+    file header : b'TCAPv2' + 2 reserved bytes
+    record      : struct '<dHBBH' (monotonic time in seconds, device id,
+                  device address byte, direction (0 = out, 1 = in,
+                  2 = device name), frame length) followed by the raw
+                  frame bytes
+
+Devices are the links' `device` names (e.g. '/dev/ttyUSB0:0'), so pumps
+at the same address on different buses are kept apart. Each name is
+written once, in a direction 2 record whose payload is the name, and
+later records refer to it by its id. Records are written in time order.
+
+The recorder also writes a sparse index to a sidecar file (the capture
+path + '.idx'), so captures can be opened without reading them:
+
+    file header : b'TCIXv1' + 2 reserved bytes
+    entry       : struct '<BqqdH' (kind (0 = checkpoint, 2 = device name),
+                  record number or device id, file offset of the record,
+                  time, name length) followed by the device name
+
+with a checkpoint for every `CHECKPOINT_INTERVAL`th record (device name
+records are not numbered).
+
+`CaptureReader` memory-maps a capture, finds records by time from the
+checkpoints (scanning at most one interval of records outside the
+requested range), computes round-trip latency statistics, and replays
+the commands of a capture against a `simulator.SimulatedLink` to compare
+the recorded and simulated pump responses.
+
+"""
+import mmap
+import os
+import struct
+import threading
+import time
+
+from array import array
+from bisect import bisect_left, bisect_right
+
+from .simulator import SimulatedLink, VirtualClock
+
+try:
+    _monotonic = time.monotonic
+except AttributeError:
+    _monotonic = time.time
+
+
+FILE_HEADER = b'TCAPv2\x00\x00'
+RECORD = struct.Struct('<dHBBH')
+
+INDEX_SUFFIX = '.idx'
+INDEX_HEADER = b'TCIXv1\x00\x00'
+INDEX_ENTRY = struct.Struct('<BqqdH')
+CHECKPOINT = 0
+CHECKPOINT_INTERVAL = 4096
+
+OUT = 0
+IN = 1
+DEVICE = 2
+
+# 64-bit record offsets where the platform supports them
+try:
+    array('q')
+    _OFFSET_TYPE = 'q'
+except ValueError:
+    _OFFSET_TYPE = 'l'
+
+_STX = 0x02
+_ETX = 0x03
+
+
+class FrameRecorder(object):
+    """
+    Appends frames to the capture file at `path` and its sparse index.
+    An existing capture is continued (and its index brought up to date,
+    e.g. after a crash). Thread-safe, so links on several buses can share
+    a recorder.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + INDEX_SUFFIX
+        self._lock = threading.Lock()
+        self._device_ids = {}
+        self._count = 0
+        self._last_time = 0.0
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            reader = CaptureReader(path)
+            try:
+                reader.saveIndex()
+                self._device_ids = {name: device_id for device_id, name
+                                    in enumerate(reader.devices)}
+                self._count = len(reader)
+                if self._count:
+                    self._last_time = reader.record(self._count - 1)[0]
+                self._offset = reader.end
+            finally:
+                reader.close()
+            self._fd = open(path, 'ab')
+            # Drop a truncated final record
+            self._fd.truncate(self._offset)
+            self._index_fd = open(self.index_path, 'ab')
+        else:
+            self._fd = open(path, 'wb')
+            self._fd.write(FILE_HEADER)
+            self._offset = len(FILE_HEADER)
+            self._index_fd = open(self.index_path, 'wb')
+            self._index_fd.write(INDEX_HEADER)
+
+    def _write(self, data):
+        self._fd.write(data)
+        self._offset += len(data)
+
+    def record(self, device, addr, direction, frame):
+        """
+        Records `frame` (bytes, or a hex string for hex-encoded links) for
+        link `device` (its name) and address byte `addr` in `direction`
+        (`OUT` or `IN`)
+
+        """
+        if not isinstance(frame, (bytes, bytearray)):
+            frame = bytearray.fromhex(frame)
+        device = str(device)
+        with self._lock:
+            # Timestamps are taken under the lock (and never go back) so
+            # records stay in time order for bisecting
+            t = max(_monotonic(), self._last_time)
+            self._last_time = t
+            device_id = self._device_ids.get(device)
+            if device_id is None:
+                device_id = len(self._device_ids)
+                self._device_ids[device] = device_id
+                name = device.encode('utf-8')
+                self._index_fd.write(INDEX_ENTRY.pack(
+                    DEVICE, device_id, self._offset, t, len(name)) + name)
+                self._write(RECORD.pack(t, device_id, addr & 0xFF, DEVICE,
+                                        len(name)))
+                self._write(name)
+            if self._count % CHECKPOINT_INTERVAL == 0:
+                self._index_fd.write(INDEX_ENTRY.pack(
+                    CHECKPOINT, self._count, self._offset, t, 0))
+            self._write(RECORD.pack(t, device_id, addr & 0xFF, direction,
+                                    len(frame)))
+            self._write(bytes(frame))
+            self._count += 1
+
+    def flush(self):
+        with self._lock:
+            self._fd.flush()
+            self._index_fd.flush()
+
+    def close(self):
+        with self._lock:
+            self._fd.close()
+            self._index_fd.close()
+
+
+def startCapture(path):
+    """ Starts recording the frames of all `TecanAPI` links to `path` """
+    from .tecanapi import TecanAPI
+    stopCapture()
+    TecanAPI.recorder = FrameRecorder(path)
+    return TecanAPI.recorder
+
+
+def stopCapture():
+    """ Stops recording and closes the capture file """
+    from .tecanapi import TecanAPI
+    if TecanAPI.recorder is not None:
+        TecanAPI.recorder.close()
+        TecanAPI.recorder = None
+
+
+def frameCommand(frame):
+    """ Returns the command string of an outgoing frame """
+    frame = bytearray(frame)
+    start = frame.index(_STX)
+    return frame[start + 3:frame.index(_ETX, start)].decode('ascii')
+
+
+def frameStatus(frame):
+    """
+    Returns the status byte of an incoming frame as a bit string (as in
+    `TecanAPI.parseFrame`), or `None` for an empty or truncated frame
+
+    """
+    frame = bytearray(frame)
+    try:
+        start = frame.index(_STX)
+        return '{:08b}'.format(frame[start + 2])
+    except (ValueError, IndexError):
+        return None
+
+
+def _isRepeat(frame):
+    frame = bytearray(frame)
+    return bool(frame[frame.index(_STX) + 2] & 0x08)
+
+
+class CaptureReader(object):
+    """
+    Memory-mapped reader for capture files. Only the sparse index is held
+    in memory (one checkpoint per `CHECKPOINT_INTERVAL` records): it is
+    loaded from the sidecar index file, and any records past its end
+    (or the whole capture, without a sidecar) are indexed on open.
+    Records are numbered in file order, excluding device name records;
+    payloads are only read when accessed.
+
+    Args:
+        `path` (str) : capture file path
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = open(path, 'rb')
+        self._mm = mmap.mmap(self._fd.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(FILE_HEADER)] != FILE_HEADER:
+            raise ValueError('`{0}` is not a frame capture'.format(path))
+        self.devices = []
+        self._cp_records = array(_OFFSET_TYPE)
+        self._cp_offsets = array(_OFFSET_TYPE)
+        self._cp_times = array('d')
+        self._length = 0
+        self.end = len(FILE_HEADER)
+        offset, idx = self._loadIndex()
+        self._index(offset, idx)
+
+    def _addDevice(self, device_id, name):
+        if device_id == len(self.devices):
+            self.devices.append(name)
+
+    def _loadIndex(self):
+        """
+        Loads the sidecar index, if any. Returns the file offset and number
+        of the first record it does not cover.
+
+        """
+        index_path = self.path + INDEX_SUFFIX
+        if not os.path.exists(index_path):
+            return len(FILE_HEADER), 0
+        with open(index_path, 'rb') as fd:
+            data = fd.read()
+        if data[:len(INDEX_HEADER)] != INDEX_HEADER:
+            return len(FILE_HEADER), 0
+        size = len(self._mm)
+        offset = len(INDEX_HEADER)
+        while offset + INDEX_ENTRY.size <= len(data):
+            kind, number, record_offset, t, length = \
+                INDEX_ENTRY.unpack_from(data, offset)
+            offset += INDEX_ENTRY.size
+            if offset + length > len(data) or \
+                    record_offset + RECORD.size > size:
+                # Written ahead of the capture (not flushed yet)
+                break
+            if kind == DEVICE:
+                self._addDevice(number, data[offset:offset + length].decode(
+                                'utf-8'))
+            elif RECORD.unpack_from(self._mm, record_offset)[0] != t:
+                # Index of another capture: re-index from the start
+                self.devices = []
+                del self._cp_records[:], self._cp_offsets[:], \
+                    self._cp_times[:]
+                return len(FILE_HEADER), 0
+            else:
+                self._cp_records.append(number)
+                self._cp_offsets.append(record_offset)
+                self._cp_times.append(t)
+            offset += length
+        if not self._cp_records:
+            return len(FILE_HEADER), 0
+        # Re-index from the last checkpoint to the end of the capture
+        idx = self._cp_records.pop()
+        self._cp_times.pop()
+        return self._cp_offsets.pop(), idx
+
+    def _scan(self, offset):
+        """
+        Generator over the complete records from file `offset`, yielding
+        `(offset, time, device_id, addr, direction, length)`
+
+        """
+        mm = self._mm
+        size = len(mm)
+        unpack = RECORD.unpack_from
+        while offset + RECORD.size <= size:
+            t, device_id, addr, direction, length = unpack(mm, offset)
+            if offset + RECORD.size + length > size:
+                # Truncated final record (e.g. capture still being written)
+                return
+            yield offset, t, device_id, addr, direction, length
+            offset += RECORD.size + length
+
+    def _index(self, offset, idx):
+        """ Indexes the records from `offset` (record number `idx`) on """
+        self.end = offset
+        for offset, t, device_id, _, direction, length in self._scan(offset):
+            self.end = offset + RECORD.size + length
+            if direction == DEVICE:
+                start = offset + RECORD.size
+                self._addDevice(device_id,
+                                self._mm[start:self.end].decode('utf-8'))
+                continue
+            if idx % CHECKPOINT_INTERVAL == 0:
+                self._cp_records.append(idx)
+                self._cp_offsets.append(offset)
+                self._cp_times.append(t)
+            idx += 1
+        self._length = idx
+
+    def saveIndex(self):
+        """ Writes the sparse index to the sidecar index file """
+        index_path = self.path + INDEX_SUFFIX
+        tmp_path = index_path + '.tmp'
+        with open(tmp_path, 'wb') as fd:
+            fd.write(INDEX_HEADER)
+            for device_id, name in enumerate(self.devices):
+                name = name.encode('utf-8')
+                fd.write(INDEX_ENTRY.pack(DEVICE, device_id,
+                                          len(FILE_HEADER), 0.0, len(name)))
+                fd.write(name)
+            for number, offset, t in zip(self._cp_records, self._cp_offsets,
+                                         self._cp_times):
+                fd.write(INDEX_ENTRY.pack(CHECKPOINT, number, offset, t, 0))
+        os.rename(tmp_path, index_path)
+
+    def __len__(self):
+        return self._length
+
+    def _records(self, checkpoint=0, start=None, end=None):
+        """
+        Generator over the records from `checkpoint` on, yielding
+        `(idx, time, device_id, addr, direction, offset)` for records with
+        `start` <= time < `end`
+
+        """
+        if checkpoint >= len(self._cp_records):
+            return
+        idx = self._cp_records[checkpoint]
+        for offset, t, device_id, addr, direction, _ in self._scan(
+                self._cp_offsets[checkpoint]):
+            if direction == DEVICE:
+                continue
+            if end is not None and t >= end:
+                return
+            if start is None or t >= start:
+                yield idx, t, device_id, addr, direction, offset
+            idx += 1
+
+    def _checkpointBefore(self, t):
+        """ Returns the last checkpoint before time `t` (or the first) """
+        if t is None:
+            return 0
+        return max(bisect_left(self._cp_times, t) - 1, 0)
+
+    def _frame(self, offset):
+        length = RECORD.unpack_from(self._mm, offset)[4]
+        start = offset + RECORD.size
+        return self._mm[start:start + length]
+
+    def record(self, idx):
+        """
+        Returns record `idx` as `(time, device, addr, direction, frame)`
+
+        """
+        if idx < 0:
+            idx += self._length
+        if not 0 <= idx < self._length:
+            raise IndexError('Record index out of range')
+        checkpoint = bisect_right(self._cp_records, idx) - 1
+        for record_idx, t, device_id, addr, direction, offset in \
+                self._records(checkpoint):
+            if record_idx == idx:
+                return (t, self.devices[device_id], addr, direction,
+                        self._frame(offset))
+
+    def select(self, device=None, start=None, end=None):
+        """
+        Returns the indices of the records for `device` (all devices if
+        `None`) with `start` <= time < `end`
+
+        """
+        if device is not None and device not in self.devices:
+            return []
+        device_id = self.devices.index(device) if device is not None \
+            else None
+        return [idx for idx, _, record_device, _, _, _ in self._records(
+                self._checkpointBefore(start), start, end)
+                if device_id is None or record_device == device_id]
+
+    def _exchanges(self, device_id, start=None, end=None):
+        """
+        Generator over the exchanges of device `device_id` (all devices if
+        `None`), yielding `(out_record, in_record)` tuples of
+        `(idx, time, device_id, addr, direction, offset)` records
+        (`in_record` is `None` for unanswered frames)
+
+        """
+        pending = {}
+        for record in self._records(self._checkpointBefore(start), start,
+                                    end):
+            record_device = record[2]
+            if device_id is not None and record_device != device_id:
+                continue
+            if record[4] == OUT:
+                if record_device in pending:
+                    yield pending[record_device], None
+                pending[record_device] = record
+            elif record_device in pending:
+                yield pending.pop(record_device), record
+        for record in sorted(pending.values()):
+            yield record, None
+
+    def exchanges(self, device, start=None, end=None):
+        """
+        Pairs each outgoing frame for `device` with the next incoming frame
+        for `device` (if any, before the next outgoing frame), for frames
+        sent with `start` <= time < `end`. Returns a list of
+        `(out_idx, in_idx)` tuples (`in_idx` is `None` for unanswered
+        frames).
+
+        """
+        if device not in self.devices:
+            return []
+        return [(out_record[0], in_record[0] if in_record else None)
+                for out_record, in_record in self._exchanges(
+                self.devices.index(device), start, end)]
+
+    def latencyStats(self, device=None):
+        """
+        Returns round-trip latency statistics in seconds, keyed by device:
+        `count`, `unanswered`, `mean`, `min`, `p50`, `p95`, `p99`, and
+        `max`
+
+        """
+        if device is not None and device not in self.devices:
+            return {device: {'count': 0, 'unanswered': 0}}
+        device_id = self.devices.index(device) if device is not None \
+            else None
+        latencies = {}
+        unanswered = {}
+        for out_record, in_record in self._exchanges(device_id):
+            record_device = out_record[2]
+            latencies.setdefault(record_device, array('d'))
+            if in_record is None:
+                unanswered[record_device] = \
+                    unanswered.get(record_device, 0) + 1
+            else:
+                latencies[record_device].append(in_record[1] -
+                                                out_record[1])
+        devices = [device_id] if device_id is not None else \
+            range(len(self.devices))
+        stats = {}
+        for device_id in devices:
+            device_latencies = sorted(latencies.get(device_id, ()))
+            entry = {'count': len(device_latencies),
+                     'unanswered': unanswered.get(device_id, 0)}
+            if device_latencies:
+                n = len(device_latencies)
+                entry.update({
+                    'mean': sum(device_latencies) / n,
+                    'min': device_latencies[0],
+                    'p50': device_latencies[(n - 1) // 2],
+                    'p95': device_latencies[int(0.95 * (n - 1))],
+                    'p99': device_latencies[int(0.99 * (n - 1))],
+                    'max': device_latencies[-1]
+                })
+            stats[self.devices[device_id]] = entry
+        return stats
+
+    def replay(self, device, link=None, **link_kwargs):
+        """
+        Replays the commands sent to `device` against a simulated pump with
+        the captured timing: the virtual clock is advanced to each
+        command's capture time before it is sent. Returns the list of
+        exchanges whose simulated ready/error status differs from the
+        recorded response, as `(out_idx, cmd, recorded_status,
+        simulated_status)` tuples.
+
+        Kwargs:
+            `link` (SimulatedLink) : simulated pump to replay against
+                [default] - a new `SimulatedLink(**link_kwargs)`
+
+        """
+        if link is None:
+            link = SimulatedLink(clock=VirtualClock(), **link_kwargs)
+        if device not in self.devices:
+            return []
+        t0 = None
+        mismatches = []
+        for out_record, in_record in self._exchanges(
+                self.devices.index(device)):
+            out_idx, out_time = out_record[:2]
+            if t0 is None:
+                t0 = out_time - link.time()
+            frame = self._frame(out_record[5])
+            if _isRepeat(frame):
+                # Resent after a lost response; the pump only acts once
+                continue
+            link.sleep(out_time - t0 - link.time())
+            cmd = frameCommand(frame)
+            simulated = link.sendRcv(cmd)['status_byte']
+            recorded = frameStatus(self._frame(in_record[5])) \
+                if in_record is not None else None
+            if recorded is not None and recorded[2:] != simulated[2:]:
+                mismatches.append((out_idx, cmd, recorded, simulated))
+        return mismatches
+
+    def close(self):
+        self._mm.close()
+        self._fd.close()
@@ -0,0 +1,386 @@
+"""
+chain.py
+
+Contains helper functions for working with Tecan command chains. A chain
+is represented as a list of `(cmd_string, exec_time)` step tuples, where
+`exec_time` is the estimated execution time of the step in seconds. Loop
+markers are regular steps: 'g' opens a loop and 'G<n>' closes it (the
+closing step carries the estimated time of the n-1 repeated iterations).
+
+"""
+import re
+
+# The XCalibur command buffer holds 255 characters, including the
+# trailing execute ('R') command
+CMD_BUFFER_LEN = 255
+
+
+_CMD_RE = re.compile(r'[A-Za-z][0-9,]*')
+
+
+def tokenizeChain(cmd_string):
+    """
+    Splits a raw command string (e.g. 'I1A3000O9A0') into a list of
+    individual commands (e.g. ['I1', 'A3000', 'O9', 'A0']). A trailing
+    execute command ('R') is dropped.
+
+    """
+    cmds = _CMD_RE.findall(cmd_string)
+    if cmds and cmds[-1] == 'R':
+        cmds = cmds[:-1]
+    return cmds
+
+
+def chainString(steps):
+    """ Returns the command string for a list of chain `steps` """
+    return ''.join(cmd for cmd, _ in steps)
+
+
+def chainTime(steps):
+    """ Returns the total estimated execution time of a list of `steps` """
+    return sum(exec_time for _, exec_time in steps)
+
+
+def _isLoopStart(cmd):
+    return cmd == 'g'
+
+
+def _isLoopEnd(cmd):
+    return cmd.startswith('G')
+
+
+def _loopCount(cmd):
+    return int(cmd[1:]) if len(cmd) > 1 else 0
+
+
+def splitUnits(steps):
+    """
+    Splits a list of chain `steps` into top-level units. Each unit is a
+    list of steps that must be sent to the pump together -- either a
+    single command or a complete (possibly nested) g...G loop.
+
+    """
+    units = []
+    depth = 0
+    unit = []
+    for step in steps:
+        cmd = step[0]
+        unit.append(step)
+        if _isLoopStart(cmd):
+            depth += 1
+        elif _isLoopEnd(cmd):
+            depth -= 1
+            if depth < 0:
+                raise ValueError('Unmatched loop end `{0}` in command chain'
+                                 ''.format(cmd))
+        if depth == 0:
+            units.append(unit)
+            unit = []
+    if depth != 0:
+        raise ValueError('Unterminated loop in command chain')
+    return units
+
+
+def unrollLoop(unit):
+    """
+    Unrolls a single top-level loop `unit` (a list of steps starting with
+    'g' and ending with 'G<n>') into its repeated body steps. Nested loops
+    within the body are left intact.
+
+    """
+    count = _loopCount(unit[-1][0])
+    if count == 0:
+        raise ValueError('Cannot unroll an infinite (G0) loop')
+    body = unit[1:-1]
+    return body * count
+
+
+def segmentChain(steps, max_len=CMD_BUFFER_LEN - 1):
+    """
+    Splits a list of chain `steps` into segments whose command strings
+    are no longer than `max_len` characters. Segments are only split at
+    top-level boundaries (never inside a loop); loops that do not fit in
+    a single segment are unrolled one level and split further.
+
+    Args:
+        `steps` (list) : list of `(cmd_string, exec_time)` tuples
+    Kwargs:
+        `max_len` (int) : maximum segment length in characters
+            [default] - 254 (buffer length minus the execute command)
+
+    Returns:
+        `segments` (list) : list of step lists
+
+    """
+    segments = []
+    segment = []
+    seg_len = 0
+    pending = splitUnits(steps)
+    pending.reverse()
+    while pending:
+        unit = pending.pop()
+        unit_len = len(chainString(unit))
+        if unit_len > max_len:
+            if len(unit) == 1:
+                raise ValueError('Command `{0}` exceeds the maximum segment '
+                                 'length [{1}]'.format(unit[0][0], max_len))
+            inner = splitUnits(unrollLoop(unit))
+            inner.reverse()
+            pending.extend(inner)
+            continue
+        if seg_len + unit_len > max_len:
+            segments.append(segment)
+            segment = []
+            seg_len = 0
+        segment.extend(unit)
+        seg_len += unit_len
+    if segment:
+        segments.append(segment)
+    return segments
+
+
+# Loop limits imposed by the XCalibur firmware
+MAX_LOOP_DEPTH = 10
+MAX_LOOP_COUNT = 29999
+
+
+class _Loop(object):
+    """
+    Loop node used while compressing a chain. `exec_time` is the estimated
+    time of all `count` iterations.
+
+    """
+
+    def __init__(self, body, count, exec_time):
+        self.body = body
+        self.count = count
+        self.exec_time = exec_time
+        self.depth = 1 + max([_nodeDepth(node) for node in body] + [0])
+        self.key = 'g{0}G{1}'.format(''.join(_nodeKey(node) for node in body),
+                                     count)
+
+    def firstIterTime(self):
+        return sum(_nodeTime(node) for node in self.body)
+
+
+def _nodeKey(node):
+    return node.key if isinstance(node, _Loop) else node[0]
+
+
+def _nodeTime(node):
+    return node.exec_time if isinstance(node, _Loop) else node[1]
+
+
+def _nodeDepth(node):
+    return node.depth if isinstance(node, _Loop) else 0
+
+
+def _parseNodes(steps):
+    """ Parses flat chain `steps` into a list of step tuples / `_Loop`s """
+    nodes = []
+    for unit in splitUnits(steps):
+        if len(unit) > 1:
+            body = _parseNodes(unit[1:-1])
+            count = _loopCount(unit[-1][0])
+            nodes.append(_Loop(body, count, chainTime(unit)))
+        else:
+            nodes.append(unit[0])
+    return nodes
+
+
+def _flattenNodes(nodes):
+    steps = []
+    for node in nodes:
+        if isinstance(node, _Loop):
+            steps.append(('g', 0))
+            steps.extend(_flattenNodes(node.body))
+            steps.append(('G{0}'.format(node.count),
+                          node.exec_time - node.firstIterTime()))
+        else:
+            steps.append(node)
+    return steps
+
+
+def _compressPass(nodes, period, max_depth):
+    """
+    Replaces runs of `period` repeated nodes with loops where doing so
+    shortens the command string. Returns the new node list and whether
+    anything was replaced.
+
+    """
+    keys = [_nodeKey(node) for node in nodes]
+    out = []
+    changed = False
+    idx = 0
+    while idx < len(nodes):
+        body_keys = keys[idx:idx + period]
+        count = 1
+        while (count < MAX_LOOP_COUNT and
+               idx + (count + 1) * period <= len(nodes) and
+               keys[idx + count * period:
+                    idx + (count + 1) * period] == body_keys):
+            count += 1
+        if count > 1:
+            body = nodes[idx:idx + period]
+            body_len = len(''.join(body_keys))
+            saving = (count - 1) * body_len - len('gG{0}'.format(count))
+            depth = 1 + max(_nodeDepth(node) for node in body)
+            if saving > 0 and depth <= max_depth:
+                run = nodes[idx:idx + count * period]
+                out.append(_Loop(body, count,
+                                 sum(_nodeTime(node) for node in run)))
+                idx += count * period
+                changed = True
+                continue
+        out.append(nodes[idx])
+        idx += 1
+    return out, changed
+
+
+def compressLoops(steps, max_period=32, max_depth=MAX_LOOP_DEPTH):
+    """
+    Compresses repeated command subsequences in a list of chain `steps`
+    into g...G<n> loops, including nested loops. The total estimated
+    execution time of the chain is preserved exactly: each loop's closing
+    step carries the time of the repeated iterations.
+
+    Kwargs:
+        `max_period` (int) : longest repeated subsequence to search for,
+                             counted in commands (or already-compressed
+                             loops)
+            [default] - 32
+        `max_depth` (int) : maximum loop nesting depth
+            [default] - 10 (XCalibur firmware limit)
+
+    Returns:
+        `steps` (list) : compressed list of `(cmd_string, exec_time)`
+                         tuples
+
+    """
+    nodes = _parseNodes(steps)
+    changed = True
+    while changed:
+        changed = False
+        for period in range(1, min(max_period, len(nodes) // 2) + 1):
+            nodes, pass_changed = _compressPass(nodes, period, max_depth)
+            changed = changed or pass_changed
+    return _flattenNodes(nodes)
+
+
+def _simulateNodes(nodes, state, num_ports):
+    """
+    Simulates chain `nodes` against `state` (updated in place), raising
+    `ValueError` on out-of-range plunger moves or invalid ports.
+
+    """
+    for node in nodes:
+        if isinstance(node, _Loop):
+            _simulateLoop(node, state, num_ports)
+            continue
+        cmd = node[0]
+        op, arg = cmd[0], cmd[1:]
+        max_pos = 24000 if state['microstep'] else 3000
+        if op in 'APD':
+            if not arg.isdigit():
+                raise ValueError('`{0}` has an invalid operand'.format(cmd))
+            arg = int(arg)
+            if op == 'A':
+                new_pos = arg
+            elif state['plunger_pos'] is None:
+                # Unknown start position -- nothing to check against
+                continue
+            elif op == 'P':
+                new_pos = state['plunger_pos'] + arg
+            else:
+                new_pos = state['plunger_pos'] - arg
+            if not 0 <= new_pos <= max_pos:
+                raise ValueError('`{0}` would move the plunger to {1} '
+                                 '(valid range 0-{2})'.format(cmd, new_pos,
+                                                              max_pos))
+            state['plunger_pos'] = new_pos
+        elif op in 'IO':
+            if not arg.isdigit() or not 0 < int(arg) <= num_ports:
+                raise ValueError('`{0}` selects an invalid port (valid range '
+                                 '1-{1})'.format(cmd, num_ports))
+            state['port'] = int(arg)
+        elif op == 'N':
+            microstep = bool(int(arg))
+            if microstep != state['microstep'] and \
+               state['plunger_pos'] is not None:
+                if microstep:
+                    state['plunger_pos'] *= 8
+                else:
+                    state['plunger_pos'] //= 8
+            state['microstep'] = microstep
+
+
+def _simulateLoop(loop, state, num_ports):
+    """
+    Simulates all iterations of `loop` without stepping through each of
+    them. A loop body either contains an absolute move (so every iteration
+    after the first starts from the same state) or only relative moves (so
+    every iteration shifts the plunger by the same amount and the extremes
+    occur in the first or the last iteration).
+
+    """
+    if loop.count == 0:
+        raise ValueError('Cannot validate an infinite (G0) loop')
+    entry = dict(state)
+    _simulateNodes(loop.body, state, num_ports)
+    if loop.count == 1 or state == entry:
+        return
+    if 'N' in loop.key:
+        for _ in range(loop.count - 1):
+            _simulateNodes(loop.body, state, num_ports)
+        return
+    after_first = dict(state)
+    _simulateNodes(loop.body, state, num_ports)
+    if loop.count == 2 or state == after_first:
+        return
+    delta_pos = state['plunger_pos'] - after_first['plunger_pos']
+    state['plunger_pos'] = entry['plunger_pos'] + delta_pos * (loop.count - 1)
+    _simulateNodes(loop.body, state, num_ports)
+
+
+def validateChain(steps, state, num_ports, max_len=CMD_BUFFER_LEN - 1):
+    """
+    Statically validates a list of chain `steps` against a simulated pump
+    `state` before anything is sent to the pump. Loops are simulated in
+    full (without unrolling them).
+
+    Args:
+        `steps` (list) : list of `(cmd_string, exec_time)` tuples
+        `state` (dict) : pump state at the start of the chain; uses the
+                         `plunger_pos`, `port`, and `microstep` keys
+        `num_ports` (int) : number of ports on the distribution valve
+    Kwargs:
+        `max_len` (int) : maximum command string length (use `None` to skip
+                          the buffer check, e.g. for chains that will be
+                          segmented)
+            [default] - 254 (buffer length minus the execute command)
+
+    Returns:
+        `state` (dict) : simulated `plunger_pos`, `port`, and `microstep`
+                         at the end of the chain
+
+    Raises `ValueError` if the chain would overflow the command buffer,
+    move the plunger out of range, or select an invalid port.
+
+    """
+    if max_len is not None:
+        chain_len = len(chainString(steps))
+        if chain_len > max_len:
+            raise ValueError('Command chain length [{0}] exceeds the command '
+                             'buffer [{1}]'.format(chain_len, max_len))
+    sim_state = {
+        'plunger_pos': state['plunger_pos'],
+        'port': state['port'],
+        'microstep': bool(state['microstep'])
+    }
+    nodes = _parseNodes(steps)
+    loop_depth = max([_nodeDepth(node) for node in nodes] + [0])
+    if loop_depth > MAX_LOOP_DEPTH:
+        raise ValueError('Loop nesting depth [{0}] exceeds the maximum [{1}]'
+                         ''.format(loop_depth, MAX_LOOP_DEPTH))
+    _simulateNodes(nodes, sim_state, num_ports)
+    return sim_state
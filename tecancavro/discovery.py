@@ -0,0 +1,182 @@
+"""
+discovery.py
+
+Contains the `PumpInventory` class, which finds XCalibur pumps on the
+local serial ports in a background thread and caches what it found (port,
+address, configuration, firmware, and pump state) in a JSON inventory
+file. On the next start, pumps from the cached inventory are reconnected
+first without re-initializing or re-configuring them (a status poll
+refreshes their position and port), so restarting an application during
+a run takes only a few round trips per pump. A full serial scan for new
+pumps follows.
+
+"""
+import os
+import threading
+
+from collections import OrderedDict
+
+try:
+    import simplejson as json
+except:
+    import json
+
+from .models import XCaliburD
+from .tecanapi import TecanAPITimeout
+from .transport import TecanAPISerial, listSerialPorts
+
+
+def _text(data):
+    return data.decode('utf-8', 'replace') if isinstance(data, bytes) \
+        else data
+
+
+class PumpInventory(object):
+    """
+    Background pump discovery with a cached inventory.
+
+    Kwargs:
+        `cache_path` (str) : JSON inventory file (not cached if `None`)
+        `tecan_addrs` (list) : device addresses to probe on each port
+        `ser_baud` (int) : serial baud rate
+        `ser_timeout` (float) : serial timeout in seconds while probing
+        `on_found` (callable) : called as `on_found(key, pump)` from the
+                                discovery thread as each pump comes online
+        `pump_kwargs` (dict) : passed to `XCaliburD` for new pumps
+
+    Pumps are keyed by serial port, or by '<port>:<address>' for
+    addresses other than 0.
+
+    """
+
+    def __init__(self, cache_path=None, tecan_addrs=(0,), ser_baud=9600,
+                 ser_timeout=0.2, on_found=None, pump_kwargs=None):
+        self.cache_path = cache_path
+        self.tecan_addrs = tecan_addrs
+        self.ser_baud = ser_baud
+        self.ser_timeout = ser_timeout
+        self.on_found = on_found
+        self.pump_kwargs = pump_kwargs or {}
+        self.pumps = OrderedDict()
+        self.inventory = OrderedDict()
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """ Starts discovery in a daemon thread and returns immediately """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._discover)
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def wait(self, timeout=None):
+        """ Blocks until discovery is complete; returns `self.pumps` """
+        self.done.wait(timeout)
+        return self.pumps
+
+    def items(self):
+        with self._lock:
+            return list(self.pumps.items())
+
+    @staticmethod
+    def _key(ser_port, tecan_addr):
+        if tecan_addr == 0:
+            return ser_port
+        return '{0}:{1}'.format(ser_port, tecan_addr)
+
+    def _loadCache(self):
+        if self.cache_path is None or not os.path.exists(self.cache_path):
+            return []
+        try:
+            with open(self.cache_path) as fd:
+                return json.load(fd)
+        except ValueError:
+            return []
+
+    def saveCache(self):
+        """ Writes the inventory (with current pump states) to the cache """
+        if self.cache_path is None:
+            return
+        with self._lock:
+            entries = []
+            for key, entry in self.inventory.items():
+                entry = dict(entry)
+                if key in self.pumps:
+                    pump = self.pumps[key]
+                    entry['state'] = dict(pump.state)
+                    entry['num_ports'] = pump.num_ports
+                    entry['syringe_ul'] = pump.syringe_ul
+                entries.append(entry)
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'w') as fd:
+            json.dump(entries, fd, indent=2)
+        os.rename(tmp_path, self.cache_path)
+
+    def _add(self, key, entry, pump):
+        with self._lock:
+            self.inventory[key] = entry
+            self.pumps[key] = pump
+        if self.on_found is not None:
+            self.on_found(key, pump)
+
+    def _reconnect(self, entry):
+        """
+        Reconnects to a cached pump without configuring it. Raises
+        `TecanAPITimeout` if it does not respond.
+
+        """
+        link = TecanAPISerial(entry['tecan_addr'], entry['ser_port'],
+                              self.ser_baud, self.ser_timeout)
+        kwargs = dict(self.pump_kwargs)
+        kwargs.setdefault('num_ports', entry.get('num_ports', 9))
+        kwargs.setdefault('syringe_ul', entry.get('syringe_ul', 1000))
+        state = dict(entry.get('state') or {})
+        pump = XCaliburD(link, state=state, **kwargs)
+        status = pump.pollStatus()
+        pump._setState({'plunger_pos': status['plunger_pos'],
+                        'port': status['port']})
+        if None in (pump.state.get('start_speed'), pump.state.get('top_speed'),
+                    pump.state.get('cutoff_speed')):
+            pump.updateSpeeds()
+        pump.updateSimState()
+        return pump
+
+    def _discover(self):
+        try:
+            # Cached pumps first: a status poll each, no configuration
+            for entry in self._loadCache():
+                key = self._key(entry['ser_port'], entry['tecan_addr'])
+                try:
+                    pump = self._reconnect(entry)
+                except (TecanAPITimeout, OSError, ValueError):
+                    continue
+                self._add(key, entry, pump)
+
+            # Full scan for new pumps
+            for ser_port in listSerialPorts():
+                for tecan_addr in self.tecan_addrs:
+                    key = self._key(ser_port, tecan_addr)
+                    if key in self.pumps:
+                        continue
+                    try:
+                        link = TecanAPISerial(tecan_addr, ser_port,
+                                              self.ser_baud, self.ser_timeout)
+                        entry = {
+                            'ser_port': ser_port,
+                            'tecan_addr': tecan_addr,
+                            'config': _text(link.sendRcv('?76')['data']),
+                            'firmware': _text(link.sendRcv('&')['data'])
+                        }
+                        pump = XCaliburD(link, **self.pump_kwargs)
+                    except OSError as e:
+                        if e.errno != 16:  # Resource busy
+                            raise
+                        continue
+                    except TecanAPITimeout:
+                        continue
+                    self._add(key, entry, pump)
+            self.saveCache()
+        finally:
+            self.done.set()
@@ -0,0 +1,203 @@
+"""
+fleet.py
+
+Parallel initialization of many pumps. `FleetInit` starts the pumps'
+initialization moves in parallel, up to a concurrency limit and with a
+minimum delay between starts (initialization draws the most current, so
+this caps the inrush on shared supplies). Pumps that have a serial bus to
+themselves are started with a single broadcast command where the limits
+allow it. One poller then waits for all pumps and records how long each
+one took.
+
+"""
+import threading
+
+from .tecanapi import TecanAPITimeout
+from .transport import TecanAPISerial
+
+
+class FleetInit(object):
+    """
+    Initializes a set of pumps in parallel.
+
+    Args:
+        `pumps` (dict) : `XCaliburD` instances keyed by name
+    Kwargs:
+        `max_concurrent` (int) : max number of pumps initializing at once
+        `stagger` (float) : min delay in seconds between starts
+        `broadcast` (bool) : start all pumps on a bus with one broadcast
+                             command when the bus holds only these pumps,
+                             they share the same init command, the whole
+                             bus fits in `max_concurrent`, and `stagger` is
+                             0
+        `polling_interval` (float) : status polling interval in seconds
+        `timeout` (float) : max init time per pump in seconds
+        `init_kwargs` : passed to `XCaliburD._initCmd` (`init_force`,
+                        `direction`, `in_port`, `out_port`)
+
+    `results` maps each pump name to a dict with `duration` (seconds from
+    start to ready, or `None`), `error` (`None`, a pump error code, or
+    'timeout'), and `broadcast` (whether it was started by broadcast).
+
+    """
+
+    def __init__(self, pumps, max_concurrent=4, stagger=0.5, broadcast=True,
+                 polling_interval=0.1, timeout=30, **init_kwargs):
+        if max_concurrent < 1:
+            raise ValueError('`max_concurrent` must be at least 1')
+        self.pumps = pumps
+        self.max_concurrent = max_concurrent
+        self.stagger = stagger
+        self.broadcast = broadcast
+        self.polling_interval = polling_interval
+        self.timeout = timeout
+        self.init_kwargs = init_kwargs
+        self.results = {}
+        self.done = threading.Event()
+        self._thread = None
+        first = next(iter(pumps.values()), None)
+        self._time = first._time if first is not None else None
+        self._sleep = first._sleep if first is not None else None
+
+    def _units(self):
+        """
+        Groups the pumps into start units: a list of `(names, cmd, bus)`
+        tuples, where `bus` is the serial port to broadcast `cmd` on, or
+        `None` to start the single pump in `names` directly
+
+        """
+        cmds = {name: pump._initCmd(**self.init_kwargs)
+                for name, pump in self.pumps.items()}
+        buses = {}
+        singles = []
+        for name in sorted(self.pumps):
+            link = self.pumps[name].com_link
+            if isinstance(link, TecanAPISerial):
+                buses.setdefault(link.ser_port, []).append(name)
+            else:
+                singles.append(name)
+        units = []
+        for bus, names in sorted(buses.items()):
+            registered = TecanAPISerial.ser_mapping[bus]['_devices']
+            if (self.broadcast and self.stagger == 0 and len(names) > 1 and
+                    len(names) <= self.max_concurrent and
+                    len(registered) == len(names) and
+                    len(set(cmds[name] for name in names)) == 1):
+                units.append((names, cmds[names[0]], bus))
+            else:
+                singles.extend(names)
+        units.extend(([name], cmds[name], None) for name in sorted(singles))
+        return units
+
+    def start(self):
+        """ Starts initialization in a daemon thread and returns `self` """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run)
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def wait(self, timeout=None):
+        """ Blocks until every pump is done; returns `self.results` """
+        self.done.wait(timeout)
+        return self.results
+
+    def _startPump(self, name, cmd_string):
+        """ Sends the init command; returns an error (or `None`) """
+        try:
+            status_byte = self.pumps[name].com_link.sendRcv(
+                cmd_string + 'R')['status_byte']
+        except TecanAPITimeout:
+            return 'timeout'
+        error = int(status_byte[4:8], 2)
+        # Errors from before the init (e.g. not initialized, overload) are
+        # cleared by it; only a rejected command means it did not start
+        if error in (2, 3, 15):
+            return error
+        return None
+
+    def _finish(self, name, entry, error):
+        pump = self.pumps[name]
+        duration = self._time() - entry['start'] if error is None else None
+        if error is None:
+            pump._initDone(entry['out_port'])
+        self.results[name] = {'duration': duration, 'error': error,
+                              'broadcast': entry['broadcast']}
+
+    def run(self):
+        """ Initializes the pumps and blocks until all are done """
+        try:
+            self._run()
+        finally:
+            self.done.set()
+
+    def _run(self):
+        units = self._units()
+        running = {}
+        last_start = None
+        while units or running:
+            now = self._time()
+            while units and len(running) + len(units[0][0]) <= \
+                    self.max_concurrent and (last_start is None or
+                                             now - last_start >= self.stagger):
+                names, (cmd_string, out_port), bus = units.pop(0)
+                if bus is not None:
+                    TecanAPISerial.broadcast(bus, cmd_string + 'R')
+                for name in names:
+                    entry = {'start': self._time(), 'cmd': cmd_string,
+                             'out_port': out_port,
+                             'broadcast': bus is not None,
+                             'confirmed': bus is None}
+                    error = None if bus is not None else \
+                        self._startPump(name, cmd_string)
+                    if error is not None:
+                        self._finish(name, entry, error)
+                    else:
+                        running[name] = entry
+                last_start = now = self._time()
+            if not running:
+                self._sleep(max(0, self.stagger - (now - last_start)))
+                continue
+            self._sleep(self.polling_interval)
+            # Shared poller: one status query per initializing pump
+            for name, entry in list(running.items()):
+                try:
+                    status_byte = self.pumps[name].com_link.sendRcv(
+                        'Q')['status_byte']
+                except TecanAPITimeout:
+                    del running[name]
+                    self._finish(name, entry, 'timeout')
+                    continue
+                ready = status_byte[2] == '1'
+                error = int(status_byte[4:8], 2)
+                if not ready:
+                    entry['confirmed'] = True
+                    if self._time() - entry['start'] > self.timeout:
+                        del running[name]
+                        self._finish(name, entry, 'timeout')
+                    continue
+                if not entry['confirmed']:
+                    # Missed the (unacknowledged) broadcast; start directly
+                    entry['start'] = self._time()
+                    entry['confirmed'] = True
+                    error = self._startPump(name, entry['cmd'])
+                    if error is not None:
+                        del running[name]
+                        self._finish(name, entry, error)
+                    continue
+                del running[name]
+                self._finish(name, entry, error or None)
+
+
+def initFleet(pumps, wait=True, **kwargs):
+    """
+    Initializes `pumps` (`XCaliburD` instances keyed by name) in parallel
+    (see `FleetInit` for the kwargs). Returns the per-pump results if
+    `wait` is `True`; otherwise returns the started `FleetInit`.
+
+    """
+    fleet = FleetInit(pumps, **kwargs)
+    if not wait:
+        return fleet.start()
+    fleet.run()
+    return fleet.results
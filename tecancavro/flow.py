@@ -0,0 +1,299 @@
+"""
+flow.py
+
+Contains the `ContinuousFlow` class, which pairs two pumps to deliver a
+constant flow rate: while one pump delivers a stroke, the other refills,
+and the next stroke starts as the current one ends.
+
+The crossover is planned ahead of time from the motion-time model (see
+motion.py). Each stroke is preloaded on its pump behind a halt ('H', see
+`XCaliburD.haltExec`) as soon as the pump has refilled, and is released
+with a single 'R' at its planned start time, so stroke timing does not
+depend on chain round trips and the two pumps do not drift apart. At or
+below the maximum start speed, the plunger runs at constant speed (no
+ramps) and the strokes hand over directly. Faster strokes ramp with the
+steepest slope, and the next stroke starts as the current one ramps down
+so that their flows add up to the target rate.
+
+"""
+import threading
+
+from .motion import (CUTOFF_SPEED_RANGE, PULSES_PER_STROKE, SLOPE_RANGE,
+                     SLOPE_UNIT, START_SPEED_RANGE, TOP_SPEED_RANGE,
+                     plungerMoveTime, valveTravel)
+
+
+class ContinuousFlow(object):
+    """
+    Continuous flow from two pumps with the same syringe size.
+
+    Args:
+        `pumps` (tuple) : two `XCaliburD` instances
+        `in_port` (int) : port the pumps refill from
+        `out_port` (int) : port the pumps deliver to
+        `flow_ul_s` (float) : target flow rate in uL/s
+    Kwargs:
+        `stroke_ul` (float) : volume delivered per stroke
+            [default] - 90% of the syringe volume
+        `refill_flow_ul_s` (float) : max refill flow rate in uL/s (e.g.
+                                     lower for viscous liquids)
+            [default] - the fastest top speed
+        `tolerance` (float) : max relative deviation from `flow_ul_s` of
+                              the delivered flow rate (speed quantization)
+                              and of the flow during a crossover
+        `lead_time` (float) : min time in seconds between a pump finishing
+                              its refill and its next stroke, for the
+                              stroke to be preloaded
+        `late_limit` (float) : extra time in seconds, beyond one stroke
+                               period, to wait for a refill that runs long
+                               before the run is aborted
+                               (`SyringeTimeout`); a late refill only
+                               delays the next stroke (see `late_strokes`
+                               in `run`)
+
+    Raises `ValueError` if the flow rate cannot be held within
+    `tolerance`, or if a pump cannot refill while the other delivers.
+
+    """
+
+    def __init__(self, pumps, in_port, out_port, flow_ul_s, stroke_ul=None,
+                 refill_flow_ul_s=None, tolerance=0.05, lead_time=0.2,
+                 late_limit=10):
+        if len(pumps) != 2:
+            raise ValueError('Continuous flow needs exactly two pumps')
+        if pumps[0].syringe_ul != pumps[1].syringe_ul:
+            raise ValueError('Both pumps must have the same syringe size')
+        self.pumps = tuple(pumps)
+        self.in_port = in_port
+        self.out_port = out_port
+        self.flow_ul_s = flow_ul_s
+        syringe_ul = pumps[0].syringe_ul
+        self.stroke_ul = stroke_ul if stroke_ul is not None else \
+            0.9 * syringe_ul
+        if not 0 < self.stroke_ul <= syringe_ul:
+            raise ValueError('`stroke_ul` [{0}] must be between 0 and the '
+                             'syringe volume [{1}]'.format(self.stroke_ul,
+                                                           syringe_ul))
+        self.refill_flow_ul_s = refill_flow_ul_s
+        self.tolerance = tolerance
+        self.lead_time = lead_time
+        self.late_limit = late_limit
+        self.stats = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self._time = pumps[0]._time
+        self._sleep = pumps[0]._sleep
+        self.plan = self.planFlow()
+
+    def planFlow(self):
+        """
+        Computes the stroke speeds and timing. Returns a dict with
+        `top_speed`, `start_speed`, `cutoff_speed`, `slope`, `flow_ul_s`
+        (delivered rate), `steps` (per stroke), `deliver_time`, `period`
+        (time between stroke starts), `refill` (refill speed settings),
+        `refill_time` (including valve moves), `slack` (spare time per
+        refill), and `crossover_deviation` (peak relative flow deviation
+        during a crossover)
+
+        """
+        pump = self.pumps[0]
+        microstep = pump.sim_state['microstep']
+        ul_per_pulse = pump.syringe_ul / PULSES_PER_STROKE
+        top_speed = int(round(self.flow_ul_s / ul_per_pulse))
+        if not TOP_SPEED_RANGE[0] <= top_speed <= TOP_SPEED_RANGE[1]:
+            raise ValueError('`flow_ul_s` [{0}] is outside the speed range of '
+                             'a {1} uL syringe [{2}-{3} uL/s]'.format(
+                             self.flow_ul_s, pump.syringe_ul,
+                             TOP_SPEED_RANGE[0] * ul_per_pulse,
+                             TOP_SPEED_RANGE[1] * ul_per_pulse))
+        flow_ul_s = top_speed * ul_per_pulse
+        if abs(flow_ul_s - self.flow_ul_s) > self.tolerance * self.flow_ul_s:
+            raise ValueError('The closest flow rate [{0:.4g} uL/s] is not '
+                             'within tolerance of {1} uL/s; use a smaller '
+                             'syringe'.format(flow_ul_s, self.flow_ul_s))
+        slope = SLOPE_RANGE[1]
+        accel = slope * SLOPE_UNIT
+        if top_speed <= START_SPEED_RANGE[1]:
+            # Constant speed strokes: the pump caps the start and cutoff
+            # speeds at the top speed
+            start_speed = max(top_speed, START_SPEED_RANGE[0])
+            cutoff_speed = max(top_speed, CUTOFF_SPEED_RANGE[0])
+            overlap = 0.0
+            deviation = 0.0
+        else:
+            # The next stroke starts `start_speed / accel` after this one
+            # starts ramping down, so the summed flow stays at the top speed
+            # except for steps of at most `start_speed` at either end
+            start_speed = START_SPEED_RANGE[0]
+            cutoff_speed = CUTOFF_SPEED_RANGE[0]
+            overlap = (top_speed - cutoff_speed - start_speed) / accel
+            deviation = float(max(start_speed, cutoff_speed)) / top_speed
+            if deviation > self.tolerance:
+                raise ValueError('Crossover flow deviation [{0:.3f}] exceeds '
+                                 'the tolerance [{1}]'.format(
+                                 deviation, self.tolerance))
+        steps = pump._ulToSteps(self.stroke_ul, microstep=microstep)
+        half_steps = 2.0 * (steps / 8.0 if microstep else steps)
+        ramp_half_steps = ((top_speed ** 2.0 - min(start_speed, top_speed) **
+                            2.0) + (top_speed ** 2.0 -
+                                    min(cutoff_speed, top_speed) ** 2.0)) / \
+            (2.0 * accel)
+        if ramp_half_steps > half_steps:
+            raise ValueError('`stroke_ul` [{0}] is too short to reach {1} '
+                             'uL/s'.format(self.stroke_ul, self.flow_ul_s))
+        calibration = pump.calibration
+        deliver_time = calibration.plungerTime(plungerMoveTime(
+            steps, min(start_speed, top_speed), top_speed,
+            min(cutoff_speed, top_speed), slope, microstep))
+        period = deliver_time - calibration.plunger_scale * overlap
+
+        refill = pump.planSpeeds(self.stroke_ul, self.refill_flow_ul_s or
+                                 TOP_SPEED_RANGE[1] * ul_per_pulse)
+        valve_time = calibration.valveTime(valveTravel(
+            self.out_port, self.in_port, pump.num_ports)[1], pump.num_ports)
+        refill_time = 2 * valve_time + calibration.plungerTime(
+            refill['move_time'])
+        # Each pump refills between the end of its stroke and the start of
+        # its next stroke, two periods after the last
+        slack = 2 * period - deliver_time - refill_time - self.lead_time
+        if slack < 0:
+            raise ValueError('Refilling takes {0:.2f} s longer than the other '
+                             'pump delivers; use a larger `stroke_ul` or a '
+                             'faster `refill_flow_ul_s`'.format(-slack))
+        return {
+            'top_speed': top_speed,
+            'start_speed': start_speed,
+            'cutoff_speed': cutoff_speed,
+            'slope': slope,
+            'flow_ul_s': flow_ul_s,
+            'steps': steps,
+            'deliver_time': deliver_time,
+            'period': period,
+            'refill': refill,
+            'refill_time': refill_time,
+            'slack': slack,
+            'crossover_deviation': deviation
+        }
+
+    def _setSpeeds(self, pump, plan):
+        pump.setTopSpeed(plan['top_speed'])
+        pump.setStartSpeed(plan['start_speed'])
+        pump.setCutoffSpeed(plan['cutoff_speed'])
+        pump.setSlope(plan['slope'])
+
+    def prime(self):
+        """
+        Fills both pumps with one stroke from `in_port` (emptying them to
+        their waste port first if they hold more) and turns their valves
+        to `out_port`
+
+        """
+        steps = self.plan['steps']
+        wait_times = []
+        for pump in self.pumps:
+            if pump.sim_state['plunger_pos'] > steps:
+                pump.changePort(pump.waste_port)
+                pump.movePlungerAbs(0)
+            self._setSpeeds(pump, self.plan['refill'])
+            pump.changePort(self.in_port)
+            pump.movePlungerAbs(steps)
+            pump.changePort(self.out_port)
+            wait_times.append(pump.executeChain(minimal_reset=True))
+        for pump, wait_time in zip(self.pumps, wait_times):
+            pump.waitReady(delay=wait_time, timeout=wait_time + 10)
+
+    def _preload(self, pump):
+        """ Sends a halted stroke + refill chain to `pump` """
+        pump.haltExec(0)
+        self._setSpeeds(pump, self.plan)
+        pump.movePlungerAbs(0)
+        self._setSpeeds(pump, self.plan['refill'])
+        pump.changePort(self.in_port)
+        pump.movePlungerAbs(self.plan['steps'])
+        pump.changePort(self.out_port)
+        pump.executeChain(minimal_reset=True)
+
+    def _release(self, pump):
+        """ Releases the halted stroke; returns the estimated start time """
+        tic = self._time()
+        pump.com_link.sendRcv('R')
+        pump._ready = False
+        return (tic + self._time()) / 2.0
+
+    def run(self, strokes=None):
+        """
+        Primes the pumps and delivers `strokes` strokes (until `stop` is
+        called if `None`), blocking until the last stroke is delivered.
+        Returns `self.stats`: `strokes`, `delivered_ul`, `max_lateness`
+        (latest stroke start relative to plan, in seconds), and
+        `late_strokes` (strokes that started later than `tolerance` of a
+        period, i.e. with a visible flow gap).
+
+        """
+        self._stop.clear()
+        self.stats = {'strokes': 0, 'delivered_ul': 0.0, 'max_lateness': 0.0,
+                      'late_strokes': 0}
+        period = self.plan['period']
+        finished = False
+        try:
+            self.prime()
+            for pump in self.pumps[:2 if strokes is None else
+                                   min(strokes, 2)]:
+                self._preload(pump)
+            t0 = self._time() + self.lead_time
+            k = 0
+            while (strokes is None or k < strokes) and \
+                    not self._stop.is_set():
+                pump = self.pumps[k % 2]
+                planned = t0 + k * period
+                if k >= 2:
+                    # Preload once the pump has refilled after stroke k - 2;
+                    # a refill that runs long makes this stroke late
+                    refilled = planned - 2 * period + \
+                        self.plan['deliver_time'] + self.plan['refill_time']
+                    pump.waitReady(delay=max(refilled - self._time(), 0),
+                                   timeout=period + self.late_limit,
+                                   polling_interval=0.01)
+                    self._preload(pump)
+                self._sleep(max(0, planned - self._time()))
+                lateness = self._release(pump) - planned
+                self.stats['strokes'] += 1
+                self.stats['delivered_ul'] += self.stroke_ul
+                self.stats['max_lateness'] = max(self.stats['max_lateness'],
+                                                 lateness)
+                if lateness > self.tolerance * period:
+                    self.stats['late_strokes'] += 1
+                k += 1
+            # Finish the delivered strokes
+            for pump in self.pumps:
+                pump.waitReady(timeout=2 * period + 10)
+            finished = True
+        finally:
+            # Cancel a stroke left preloaded (a halted pump reports ready
+            # with a non-empty command buffer), or stop both pumps if the
+            # run failed
+            for pump in self.pumps:
+                if not finished or pump.getBufferStatus():
+                    self._cancel(pump)
+        return self.stats
+
+    def _cancel(self, pump):
+        """ Terminates `pump`'s chain and re-reads its position and port """
+        pump.terminateCmd()
+        pump.resetChain()
+        pump.getPlungerPos()
+        pump.getCurPort()
+        pump.updateSimState()
+
+    def start(self, strokes=None):
+        """ Runs `run(strokes)` in a daemon thread and returns `self` """
+        self._thread = threading.Thread(target=self.run, args=(strokes,))
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self, wait=True):
+        """ Stops after the current stroke """
+        self._stop.set()
+        if wait and self._thread is not None:
+            self._thread.join()
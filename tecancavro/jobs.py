@@ -0,0 +1,296 @@
+"""
+jobs.py
+
+Contains the `JobQueue` and `PumpWorker` classes, which run pump commands
+submitted from other threads (e.g. web request handlers) on one worker
+thread per pump. Submitting returns a job id immediately. Each worker
+drains everything queued for its pump at once, so commands submitted
+while the pump is busy are coalesced into a single command chain that is
+executed (and waited on) once. Multi-pump work (e.g. a compiled protocol)
+is submitted as a group of phases that run one after another, with the
+jobs of each phase running on their pumps' workers in parallel.
+
+"""
+import itertools
+import threading
+import time
+
+from collections import OrderedDict
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class Job(object):
+    """
+    A unit of work for a single pump. `build` is called as `build(pump)` to
+    add commands to the pump's command chain; if `execute` is `True`, the
+    chain (including commands from earlier non-executing jobs) is executed
+    after it is built. Status moves from 'queued' to 'chained' (commands
+    added, waiting for an execute) or 'running', and then to 'done' or
+    'failed'. Group jobs (see `JobQueue.submitPhases`) have the ids of
+    the jobs they submitted in `jobs`. `exclusive` jobs (e.g. phases that
+    load a pre-compiled chain with `XCaliburD.loadChain`) are never
+    coalesced: commands chained before them are executed first, and they
+    are executed on their own.
+
+    """
+
+    def __init__(self, job_id, pump_key, build=None, execute=False,
+                 description='', exclusive=False):
+        self.id = job_id
+        self.pump_key = pump_key
+        self.build = build
+        self.execute = execute
+        self.exclusive = exclusive
+        self.description = description
+        self.status = 'queued'
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.exec_time = None
+        self.jobs = []
+        self.done = threading.Event()
+
+    def finish(self, status, error=None):
+        self.status = status
+        self.error = error
+        self.finished = time.time()
+        self.done.set()
+
+    def toDict(self):
+        return {
+            'id': self.id,
+            'pump': self.pump_key,
+            'description': self.description,
+            'status': self.status,
+            'error': self.error,
+            'submitted': self.submitted,
+            'started': self.started,
+            'finished': self.finished,
+            'exec_time': self.exec_time,
+            'jobs': list(self.jobs),
+            'eta': (self.started + self.exec_time
+                    if self.status == 'running' else None)
+        }
+
+
+class PumpWorker(threading.Thread):
+    """
+    Worker thread that owns a single pump and runs its jobs in order.
+
+    Args:
+        `pump` (Object) : pump to run jobs on (e.g. `XCaliburD`)
+    Kwargs:
+        `wait_timeout` (float) : extra time in seconds beyond the estimated
+                                 execution time to wait for the pump
+        `polling_interval` (float) : ready polling interval in seconds
+
+    """
+
+    def __init__(self, pump, wait_timeout=10, polling_interval=0.1):
+        super(PumpWorker, self).__init__()
+        self.daemon = True
+        self.pump = pump
+        self.wait_timeout = wait_timeout
+        self.polling_interval = polling_interval
+        self._queue = queue.Queue()
+        self._chained = []
+
+    def submit(self, job):
+        self._queue.put(job)
+
+    def run(self):
+        while True:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._runBatch(batch)
+            except Exception as e:
+                # Never let the worker die: fail whatever is unfinished
+                self._chained = []
+                try:
+                    self.pump.resetChain()
+                except Exception:
+                    pass
+                for job in batch:
+                    if job.status not in ('done', 'failed'):
+                        job.finish('failed', str(e))
+
+    def _build(self, job):
+        job.started = time.time()
+        saved = self.pump.saveChain()
+        try:
+            if job.build is not None:
+                job.build(self.pump)
+        except Exception as e:
+            job.finish('failed', str(e))
+            # Drop the failed job's commands, keeping the earlier jobs'
+            self.pump.restoreChain(saved)
+            return
+        job.status = 'chained'
+        self._chained.append(job)
+
+    def _runBatch(self, batch):
+        execute = False
+        for job in batch:
+            if job.exclusive:
+                if self._chained:
+                    self._execute()
+                execute = False
+                self._build(job)
+                if job.status != 'failed':
+                    self._execute()
+                continue
+            self._build(job)
+            execute = execute or (job.execute and job.status != 'failed')
+        if execute:
+            self._execute()
+
+    def _execute(self):
+        """ Executes the chained jobs' commands and waits for the pump """
+        jobs, self._chained = self._chained, []
+        exec_time = self.pump.exec_time
+        for job in jobs:
+            job.status = 'running'
+            job.started = time.time()
+            job.exec_time = exec_time
+        try:
+            wait_time = self.pump.executeChain()
+            self.pump.waitReady(delay=wait_time,
+                                polling_interval=self.polling_interval,
+                                timeout=self.wait_timeout + exec_time)
+            status, error = 'done', None
+        except Exception as e:
+            self.pump.resetChain()
+            status, error = 'failed', str(e)
+        for job in jobs:
+            job.finish(status, error)
+
+
+class JobQueue(object):
+    """
+    Runs jobs on a set of pumps, one `PumpWorker` per pump.
+
+    Args:
+        `pumps` (dict) : pumps keyed by name (e.g. serial port)
+    Kwargs:
+        `max_jobs` (int) : number of finished jobs kept for status queries
+        `worker_kwargs` : passed to each `PumpWorker`
+
+    """
+
+    def __init__(self, pumps, max_jobs=1000, **worker_kwargs):
+        self.max_jobs = max_jobs
+        self._worker_kwargs = worker_kwargs
+        self._workers = {}
+        self._jobs = OrderedDict()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        for key, pump in pumps.items():
+            self.addPump(key, pump)
+
+    def addPump(self, key, pump):
+        """ Starts a worker for `pump` under `key` """
+        with self._lock:
+            if key in self._workers:
+                raise ValueError('Pump `{0}` already has a worker'.format(key))
+            worker = PumpWorker(pump, **self._worker_kwargs)
+            worker.start()
+            self._workers[key] = worker
+
+    def submit(self, pump_key, build=None, execute=False, description=''):
+        """
+        Queues a job for pump `pump_key` and returns its id immediately
+        (see `Job` for `build` and `execute`)
+
+        """
+        return self._submit(pump_key, build, execute, description).id
+
+    def _submit(self, pump_key, build, execute, description,
+                exclusive=False):
+        with self._lock:
+            if pump_key not in self._workers:
+                raise KeyError(pump_key)
+            job = Job(str(next(self._ids)), pump_key, build, execute,
+                      description, exclusive)
+            self._jobs[job.id] = job
+            self._trim()
+        self._workers[pump_key].submit(job)
+        return job
+
+    def submitPhases(self, phases, exec_time=None, description=''):
+        """
+        Queues a group job that runs `phases` in order and returns its id
+        immediately. Each phase is a dict of pump key -> `build` callable;
+        the phase's builds are executed as one exclusive job per pump (see
+        `Job`), and the next phase starts once all of them are done. The
+        group fails (and stops) at the first failed job.
+
+        Kwargs:
+            `exec_time` (float) : estimated duration of the group in seconds
+            `description` (str) : job description
+
+        """
+        pump_keys = sorted(set(key for phase in phases for key in phase))
+        with self._lock:
+            missing = [key for key in pump_keys if key not in self._workers]
+            if missing:
+                raise KeyError(', '.join(missing))
+            group = Job(str(next(self._ids)), pump_keys,
+                        description=description)
+            group.exec_time = exec_time
+            self._jobs[group.id] = group
+            self._trim()
+        thread = threading.Thread(target=self._runPhases,
+                                  args=(group, phases))
+        thread.daemon = True
+        thread.start()
+        return group.id
+
+    def _runPhases(self, group, phases):
+        group.status = 'running'
+        group.started = time.time()
+        for idx, phase in enumerate(phases):
+            jobs = []
+            for key, build in sorted(phase.items()):
+                job = self._submit(key, build, True, '{0} (phase {1})'.format(
+                                   group.description, idx), exclusive=True)
+                group.jobs.append(job.id)
+                jobs.append(job)
+            for job in jobs:
+                job.done.wait()
+            failed = [job for job in jobs if job.status == 'failed']
+            if failed:
+                group.finish('failed', 'Phase {0}, pump `{1}`: {2}'.format(
+                             idx, failed[0].pump_key, failed[0].error))
+                return
+        group.finish('done')
+
+    def _trim(self):
+        """ Drops the oldest finished jobs beyond `max_jobs` """
+        excess = len(self._jobs) - self.max_jobs
+        for job_id in list(self._jobs):
+            if excess <= 0:
+                break
+            if self._jobs[job_id].status in ('done', 'failed'):
+                del self._jobs[job_id]
+                excess -= 1
+
+    def status(self, job_id):
+        """ Returns the status dict of job `job_id`, or `None` if unknown """
+        job = self._jobs.get(job_id)
+        return job.toDict() if job is not None else None
+
+    def pending(self, pump_key=None):
+        """ Returns the status dicts of all unfinished jobs """
+        return [job.toDict() for job in list(self._jobs.values())
+                if job.status not in ('done', 'failed') and
+                (pump_key is None or job.pump_key == pump_key)]
@@ -0,0 +1,248 @@
+"""
+metrics.py
+
+Contains lightweight `Counter` and `Histogram` metrics, the process-wide
+`REGISTRY` of library metrics, and a Prometheus text exposition endpoint
+(`startHttpServer`). Metrics are collected by the transports (round-trip
+latency, retries, timeouts, bus time), `Syringe` (error codes, wait
+overshoot) and `XCaliburD` (error recoveries, chain lengths), labelled by
+device. Bus utilization is the rate of `tecan_bus_busy_seconds_total`.
+
+    from tecancavro.metrics import REGISTRY, startHttpServer
+    startHttpServer(9464)   # http://127.0.0.1:9464/metrics
+    REGISTRY.get('tecan_retries_total').value(device='/dev/ttyUSB0:0')
+
+"""
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+
+def _labelKey(label_names, labels):
+    if set(labels) != set(label_names):
+        raise ValueError('Expected labels {0}, got {1}'.format(
+                         sorted(label_names), sorted(labels)))
+    return tuple(str(labels[name]) for name in label_names)
+
+
+def _formatLabels(label_names, key, extra=()):
+    pairs = list(zip(label_names, key)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, value.replace(
+        '\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs) + '}'
+
+
+def _formatValue(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter(object):
+    """
+    Monotonically increasing count, one series per label combination
+
+    Args:
+        `name` (str) : metric name
+        `help_text` (str) : metric description
+    Kwargs:
+        `label_names` (tuple) : label names
+
+    """
+
+    TYPE = 'counter'
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _labelKey(self.label_names, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(_labelKey(self.label_names, labels), 0)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [(self.name, _formatLabels(self.label_names, key), value)
+                for key, value in items]
+
+
+class Histogram(object):
+    """
+    Distribution of observed values over cumulative `buckets` (upper
+    bounds), one series per label combination
+
+    Args:
+        `name` (str) : metric name
+        `help_text` (str) : metric description
+        `buckets` (tuple) : increasing bucket upper bounds
+    Kwargs:
+        `label_names` (tuple) : label names
+
+    """
+
+    TYPE = 'histogram'
+
+    def __init__(self, name, help_text, buckets, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _labelKey(self.label_names, labels)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [[0] * len(self.buckets), 0, 0]
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][idx] += 1
+                    break
+            series[1] += 1
+            series[2] += value
+
+    def stats(self, **labels):
+        """ Returns the `(count, sum)` of the observations """
+        series = self._values.get(_labelKey(self.label_names, labels))
+        if series is None:
+            return 0, 0
+        return series[1], series[2]
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(series[0]), series[1], series[2])
+                     for key, series in sorted(self._values.items())]
+        samples = []
+        for key, counts, n, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append((self.name + '_bucket', _formatLabels(
+                    self.label_names, key, [('le', _formatValue(bound))]),
+                    cumulative))
+            labels = _formatLabels(self.label_names, key)
+            samples.append((self.name + '_sum', labels, total))
+            samples.append((self.name + '_count', labels, n))
+        return samples
+
+
+class Registry(object):
+    """ Collection of metrics exposed together """
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if self.get(metric.name) is not None:
+                raise ValueError('Metric `{0}` is already registered'.format(
+                                 metric.name))
+            self._metrics.append(metric)
+        return metric
+
+    def get(self, name):
+        for metric in self._metrics:
+            if metric.name == name:
+                return metric
+        return None
+
+    def exposition(self):
+        """ Returns all metrics in the Prometheus text exposition format """
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP {0} {1}'.format(metric.name,
+                                                  metric.help_text))
+            lines.append('# TYPE {0} {1}'.format(metric.name, metric.TYPE))
+            for name, labels, value in metric.samples():
+                lines.append('{0}{1} {2}'.format(name, labels,
+                                                 _formatValue(value)))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5)
+
+ROUND_TRIP = REGISTRY.register(Histogram(
+    'tecan_round_trip_seconds',
+    'Command round-trip time, including retries', LATENCY_BUCKETS,
+    ('device',)))
+RETRIES = REGISTRY.register(Counter(
+    'tecan_retries_total',
+    'Frames resent after a missing or invalid response', ('device',)))
+TIMEOUTS = REGISTRY.register(Counter(
+    'tecan_timeouts_total',
+    'Commands that exceeded the max send attempts', ('device',)))
+BUS_BUSY = REGISTRY.register(Counter(
+    'tecan_bus_busy_seconds_total',
+    'Time spent in command exchanges on a bus', ('bus',)))
+SYRINGE_ERRORS = REGISTRY.register(Counter(
+    'tecan_syringe_errors_total',
+    'Pump errors by error code (repeated reports of the same error are '
+    'counted once)', ('device', 'code')))
+RECOVERIES = REGISTRY.register(Counter(
+    'tecan_recoveries_total',
+    'Error recoveries by error code and recovery action',
+    ('device', 'code', 'action')))
+RECOVERY_TIME = REGISTRY.register(Histogram(
+    'tecan_recovery_seconds',
+    'Downtime per error recovery by recovery action',
+    (0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 60), ('device', 'action')))
+WAIT_OVERSHOOT = REGISTRY.register(Histogram(
+    'tecan_wait_overshoot_seconds',
+    'Time from the estimated to the detected end of a move',
+    LATENCY_BUCKETS, ('device',)))
+CHAIN_LENGTH = REGISTRY.register(Histogram(
+    'tecan_chain_length_chars',
+    'Length of executed command chains', (8, 16, 32, 64, 128, 254, 512,
+                                          1024, 4096), ('device',)))
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.exposition().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def startHttpServer(port=9464, addr='127.0.0.1', registry=REGISTRY):
+    """
+    Serves `registry` at http://`addr`:`port`/metrics from a daemon thread.
+    Returns the server (call `.shutdown()` to stop it).
+
+    """
+    handler = type('MetricsHandler', (_MetricsHandler,),
+                   {'registry': registry})
+    server = HTTPServer((addr, port), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
@@ -5,10 +5,10 @@ Contains Tecan Cavro model-specific classes that inherit from the `Syringe`
 class in syringe.py.
 
 """
+import threading
 import time
-import logging
+import warnings
 
-from math import sqrt
 from time import sleep
 from functools import wraps
 from contextlib import contextmanager
@@ -20,6 +20,14 @@ except:
     from time import sleep
 
 from .syringe import Syringe, SyringeError, SyringeTimeout
+from .motion import (SPEED_CODES, allocateSteps, plungerMoveTime, planSpeeds,
+                     valveTravel, orderByValveTravel)
+from .calibration import TimingCalibration
+from .tracing import TRACER
+from .metrics import CHAIN_LENGTH, RECOVERIES, RECOVERY_TIME
+from .chain import (CMD_BUFFER_LEN, MAX_LOOP_COUNT, chainString, chainTime,
+                    compressLoops, segmentChain, tokenizeChain,
+                    validateChain)
 
 
 class XCaliburD(Syringe):
@@ -27,21 +35,20 @@ class XCaliburD(Syringe):
     Class to control XCalibur pumps with distribution valves. Provides front-
     end validation and convenience functions (e.g. smartExtract) -- see
     individual docstrings for more information.
+
+    `state_version` increases whenever the known pump state may have changed
+    (an executed chain, or a poll that reported a different state), so
+    readers can cache `state` by version (see `stateSnapshot`).
     """
 
     DIR_DICT = {'CW': ('I', 'Z'), 'CCW': ('O', 'Y')}
 
-    SPEED_CODES = {0: 6000, 1: 5600, 2: 5000, 3: 4400, 4: 3800, 5: 3200,
-                   6: 2600, 7: 2200, 8: 2000, 9: 1800, 10: 1600, 11: 1400,
-                   12: 1200, 13: 1000, 14: 800, 15: 600, 16: 400, 17: 200,
-                   18: 190, 19: 180, 20: 170, 21: 160, 22: 150, 23: 140,
-                   24: 130, 25: 120, 26: 110, 17: 100, 28: 90, 29: 80,
-                   30: 70, 31: 60, 32: 50, 33: 40, 34: 30, 35: 20, 36: 18,
-                   37: 16, 38: 14, 39: 12, 40: 10}
+    SPEED_CODES = SPEED_CODES
 
     def __init__(self, com_link, num_ports=9, syringe_ul=1000, direction='CW',
                  microstep=False, waste_port=9, slope=14, init_force=0,
-                 debug=False, debug_log_path='.'):
+                 debug=False, debug_log_path='.', calibration_path=None,
+                 state=None):
         """
         Object initialization function.
 
@@ -67,13 +74,24 @@ class XCaliburD(Syringe):
                 1 - half plunger force and default speed
                 2 - one third plunger force and default speed
                 10-40 - full force and speed code X
-            `debug` (bool) : turns on debug file, which logs extensive debug
-                             output to 'xcaliburd_debug.log' at
-                             `debug_log_path`
+            `debug` (bool) : turns on call tracing into the in-memory trace
+                             buffer and 'xcaliburd_debug.log' at
+                             `debug_log_path` (see tracing.py)
                 [default] - False
             `debug_log_path` : path to debug log file - only relevant if
                                `debug` == True.
                 [default] - '' (cwd)
+            `calibration_path` : path to a JSON timing calibration file for
+                                 this device (see calibration.py). Loaded
+                                 if it exists; `calibratePump` saves to it.
+                [default] - None (uncalibrated datasheet timing)
+            `state` (dict) : known pump state (e.g. `plunger_pos`, `port`,
+                             and speeds) to start from. If provided, the
+                             pump is not polled or configured on
+                             construction, so `com_link` may be `None`
+                             to build and validate chains offline (see
+                             protocol.py).
+                [default] - None (poll the pump)
 
         """
         super(XCaliburD, self).__init__(com_link)
@@ -82,6 +100,12 @@ class XCaliburD(Syringe):
         self.direction = direction
         self.waste_port = waste_port
         self.init_force = init_force
+        self._step_residuals = {}
+        self.calibration_path = calibration_path
+        if calibration_path is not None:
+            self.calibration = TimingCalibration.load(calibration_path)
+        else:
+            self.calibration = TimingCalibration()
         self.state = {
             'plunger_pos': None,
             'port': None,
@@ -91,24 +115,41 @@ class XCaliburD(Syringe):
             'cutoff_speed': None,
             'slope': slope
         }
+        self.state_version = 0
+        self._state_lock = threading.Lock()
+
+        # Error recovery state (see `_syringeErrorHandler`)
+        self.last_cmd = None
+        self.last_recovery = None
+        self._recovering = False
+        self._resume = None
 
         # Handle debug mode init
         self.debug = debug
+        self._trace_name = '{0}@{1:x}'.format(self.__class__.__name__,
+                                              id(self))
         if self.debug:
             self.initDebugLogging(debug_log_path)
 
-        self.setMicrostep(on=microstep)
+        if state is None:
+            self.setMicrostep(on=microstep)
 
         # Command chaining state information
         self.cmd_chain = ''
+        self.chain_steps = []
+        self._loop_marks = []
+        self._segments = None
         self.exec_time = 0
         self.sim_speed_change = False
         self.sim_state = {k: v for k, v in self.state.items()}
 
         # Init functions
-        self.updateSpeeds()
-        self.getPlungerPos()
-        self.getCurPort()
+        if state is None:
+            self.updateSpeeds()
+            self.getPlungerPos()
+            self.getCurPort()
+        else:
+            self.state.update(state)
         self.updateSimState()
 
     #########################################################################
@@ -116,27 +157,29 @@ class XCaliburD(Syringe):
     #########################################################################
 
     def initDebugLogging(self, debug_log_path):
-        """ Initialize logger and log file handler """
+        """
+        Starts the process-wide trace log in `debug_log_path` (see
+        tracing.py). All pumps share a single background file handler.
 
-        self.logger = logging.getLogger('XCaliburD')
-        fp = debug_log_path.rstrip('/') + '/xcaliburd_debug.log'
-        hdlr = logging.FileHandler(fp)
-        formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
-        hdlr.setFormatter(formatter)
-        self.logger.addHandler(hdlr)
-        self.logger.setLevel(logging.DEBUG)
+        """
+        TRACER.enableFile(debug_log_path)
+        self.logger = TRACER.logger
 
     def logCall(self, f_name, f_locals):
-        """ Logs function params at call """
+        """
+        Records a call and its params in the trace buffer. Call sites only
+        call this if `self.debug` is set, so `f_locals` is never built when
+        tracing is off.
 
-        if self.debug:
-            self.logger.debug('-> {}: {}'.format(f_name, f_locals))
+        """
+        f_locals = {k: v for k, v in f_locals.items() if k != 'self'}
+        TRACER.record(self._trace_name, f_name, f_locals)
 
     def logDebug(self, msg):
         """ Handles debug logging if self.debug == True """
 
         if self.debug:
-            self.logger.debug(msg)
+            TRACER.record(self._trace_name, 'debug', msg)
 
     #########################################################################
     # Pump initialization                                                   #
@@ -149,8 +192,24 @@ class XCaliburD(Syringe):
         if not provided. Blocks until initialization is complete.
 
         """
-        self.logCall('init', locals())
+        if self.debug:
+            self.logCall('init', locals())
+
+        cmd_string, out_port = self._initCmd(init_force, direction, in_port,
+                                             out_port)
+        self.sendRcv(cmd_string, execute=True)
+        self.waitReady()
+        self._initDone(out_port)
+        return 0  # 0 seconds left to wait
 
+    def _initCmd(self, init_force=None, direction=None, in_port=None,
+                 out_port=None):
+        """
+        Returns the initialization command string (without 'R') and the
+        port the valve ends at, using the instance defaults for arguments
+        that are `None` (see `init` and fleet.py)
+
+        """
         init_force = init_force if init_force is not None else self.init_force
         direction = direction if direction is not None else self.direction
         out_port = out_port if out_port is not None else self.waste_port
@@ -159,9 +218,13 @@ class XCaliburD(Syringe):
         cmd_string = '{0}{1},{2},{3}'.format(
                      self.__class__.DIR_DICT[direction][1],
                      init_force, in_port, out_port)
-        self.sendRcv(cmd_string, execute=True)
-        self.waitReady()
-        return 0  # 0 seconds left to wait
+        return cmd_string, out_port
+
+    def _initDone(self, out_port):
+        """ Updates the pump state after a completed initialization """
+        self._ready = True
+        self._setState({'plunger_pos': 0, 'port': out_port})
+        self.updateSimState()
 
     #########################################################################
     # Convenience functions                                                 #
@@ -172,57 +235,63 @@ class XCaliburD(Syringe):
         """
         Extracts `volume_ul` from `in_port`. If the relative plunger move
         exceeds the encoder range, the syringe will dispense to `out_port`,
-        which defaults to `self.waste_port`. If `minimal_reset` is `True`,
-        state updates upon execution will be based on simulations rather
-        than polling. If `flush` is `True`, the contents of the syringe
-        will be flushed to waste following the extraction.
+        which defaults to `self.waste_port`; volumes above the syringe
+        volume are first streamed through to `out_port` (see `transfer`,
+        which blocks) until one syringe volume is left to extract. If
+        `minimal_reset` is `True`, state updates upon execution will be
+        based on simulations rather than polling. If `flush` is `True`, the
+        contents of the syringe will be flushed to waste following the
+        extraction.
 
         """
-        self.logCall('extractToWaste', locals())
+        if self.debug:
+            self.logCall('extractToWaste', locals())
 
         out_port = out_port if out_port is not None else self.waste_port
-        if speed_code is not None:
-            self.setSpeed(speed_code)
-        self.cacheSimSpeeds()
+        if volume_ul > self.syringe_ul:
+            # Stream the excess straight through to `out_port` and extract
+            # one full syringe
+            self.transfer(in_port, out_port, volume_ul - self.syringe_ul,
+                          speed_code=speed_code)
+            volume_ul = self.syringe_ul
         steps = self._ulToSteps(volume_ul)
 
         retry = False
-        extracted = False
-
-        while not extracted:
+        while True:
+            if speed_code is not None:
+                self.setSpeed(speed_code)
+            self.cacheSimSpeeds()
+            # If the move is calculated to execeed the encoder range,
+            # dispense to waste and then make relative plunger extract
+            max_pos = 24000 if self.sim_state['microstep'] else 3000
+            if (self.sim_state['plunger_pos'] + steps) > max_pos or retry:
+                self.logDebug('extractToWaste: move would exceed {} '
+                              'dumping to out port [{}]'.format(
+                              max_pos, out_port))
+                self.changePort(out_port, from_port=in_port)
+                self.setSpeed(0)
+                self.movePlungerAbs(0)
+                self.changePort(in_port, from_port=out_port)
+                self.restoreSimSpeeds()
+            # Make relative plunger extract
+            self.changePort(in_port)
+            self.logDebug('extractToWaste: attempting relative extract '
+                          '[steps: {}]'.format(steps))
+            # Delay execution 200 ms to stop oscillations
+            self.delayExec(200)
+            self.movePlungerRel(steps)
+            if flush:
+                self.dispenseToWaste()
             try:
-                # If the move is calculated to execeed 3000 encoder counts,
-                # dispense to waste and then make relative plunger extract
-                if (self.sim_state['plunger_pos'] + steps) > 3000 or retry:
-                    self.logDebug('extractToWaste: move would exceed 3000 '
-                                  'dumping to out port [{}]'.format(out_port))
-                    self.changePort(out_port, from_port=in_port)
-                    self.setSpeed(0)
-                    self.movePlungerAbs(0)
-                    self.changePort(in_port, from_port=out_port)
-                    self.restoreSimSpeeds()
-                # Make relative plunger extract
-                self.changePort(in_port)
-                self.logDebug('extractToWaste: attempting relative extract '
-                              '[steps: {}]'.format(steps))
-                # Delay execution 200 ms to stop oscillations
-                self.delayExec(200)
-                self.movePlungerRel(steps)
-                if flush:
-                    self.dispenseToWaste()
-                exec_time = self.executeChain(minimal_reset=True)
-                extracted = True
-            except SyringeError as e:
-                if e.err_code in [2, 3, 4]:
-                    self.logDebug('extractToWaste: caught SyringeError [{}], '
-                                  'retrying.')
-                    retry = True
-                    self.resetChain()
-                    self.waitReady()
-                    continue
-                else:
+                return self.executeChain(minimal_reset=True)
+            except ValueError as e:
+                # Rejected by the chain validator (nothing was sent and the
+                # chain was reset): retry once, dumping to `out_port` first
+                if retry:
                     raise
-        return exec_time
+                self.logDebug('extractToWaste: chain rejected [{}], '
+                              'retrying.'.format(e))
+                retry = True
 
     def primePort(self, in_port, volume_ul, speed_code=None, out_port=None,
                   split_command=False):
@@ -232,41 +301,267 @@ class XCaliburD(Syringe):
         provided, the syringe speed will be appended to the
         beginning of the command chain. Blocks until priming is complete.
 
+        `split_command` is deprecated and ignored: strokes are always
+        compressed into a g...G loop and only split into segments if they
+        do not fit in the command buffer (see `transfer`).
+
         """
-        self.logCall('primePort', locals())
+        if self.debug:
+            self.logCall('primePort', locals())
 
+        if split_command:
+            warnings.warn('`split_command` is deprecated and ignored; '
+                          'primePort always compresses strokes into a loop',
+                          DeprecationWarning, stacklevel=2)
         if out_port is None:
             out_port = self.waste_port
-        if speed_code is not None:
-            self.setSpeed(speed_code)
-        if volume_ul > self.syringe_ul:
-            num_rounds = volume_ul / self.syringe_ul
-            remainder_ul = volume_ul % self.syringe_ul
-            self.changePort(out_port, from_port=in_port)
-            self.movePlungerAbs(0)
-            for x in xrange(num_rounds):
-                self.changePort(in_port, from_port=out_port)
-                self.movePlungerAbs(3000)
-                self.changePort(out_port, from_port=in_port)
-                self.movePlungerAbs(0)
-                delay = self.executeChain()
-                self.waitReady(delay)
-            if remainder_ul != 0:
-                self.changePort(in_port, from_port=out_port)
-                self.movePlungerAbs(self._ulToSteps(remainder_ul))
-                self.changePort(out_port, from_port=in_port)
-                self.movePlungerAbs(0)
-                delay = self.executeChain()
-                self.waitReady(delay)
+        self.transfer(in_port, out_port, volume_ul, speed_code=speed_code)
+
+    def transferSegments(self, in_port, out_port, volume_ul, stroke_ul=None,
+                         speed_code=None):
+        """
+        Generator that builds the chain segments for moving `volume_ul`
+        from `in_port` to `out_port` in syringe strokes (fill and empty),
+        with the total rounded to whole steps only once. Any liquid
+        already in the syringe is emptied to `out_port` first. Identical
+        strokes are compressed into g...G loops (see `chain.compressLoops`),
+        so each segment holds as many strokes as fit in the command buffer
+        and most transfers are a single segment.
+
+        Yields `(segment, volume_ul)` tuples: the segment's chain steps
+        (see `streamChain`) and the volume it moves. Segments are built
+        lazily from the state at the end of the previous one, so the next
+        segment can be built while the current one runs. The command chain
+        must be empty; it is left empty between segments.
+
+        Kwargs:
+            `stroke_ul` (float) : max volume per stroke
+                [default] - the syringe volume
+            `speed_code` (int) : speed code set in the first segment
+
+        """
+        if self.cmd_chain:
+            raise ValueError('Cannot build a transfer while another command '
+                             'chain is pending')
+        microstep = self.sim_state['microstep']
+        max_pos = 24000 if microstep else 3000
+        stroke_steps = max_pos
+        if stroke_ul is not None:
+            stroke_steps = min(self._ulToSteps(stroke_ul, microstep), max_pos)
+        if stroke_steps < 1:
+            raise ValueError('`stroke_ul` [{0}] is less than one step'
+                             ''.format(stroke_ul))
+        total_steps = self._ulToSteps(volume_ul, microstep)
+        num_strokes, remainder = divmod(total_steps, stroke_steps)
+        strokes = [stroke_steps] * num_strokes
+        if remainder:
+            strokes.append(remainder)
+        # Strokes are only built once per start state, since every full
+        # stroke after the first starts from the same state
+        built = {}
+        state = dict(self.sim_state)
+        idx = 0
+        while idx < len(strokes):
+            # Build from the end state of the previous segment, even if
+            # the simulation state was reset in between (e.g. by a recovery)
+            self.sim_state = dict(state)
+            if idx == 0:
+                if speed_code is not None:
+                    self.setSpeed(speed_code)
+                if state['plunger_pos'] != 0:
+                    self.changePort(out_port)
+                    self.movePlungerAbs(0)
+            steps = self.chain_steps
+            self.cmd_chain = ''
+            self.chain_steps = []
+            self.exec_time = 0
+            # A loop repeats at most MAX_LOOP_COUNT times, so this many
+            # strokes always fit in one segment
+            first = idx
+            while idx < len(strokes) and idx - first < MAX_LOOP_COUNT:
+                key = (strokes[idx], tuple(sorted(self.sim_state.items())))
+                if key not in built:
+                    self.changePort(in_port)
+                    self.movePlungerAbs(strokes[idx])
+                    self.changePort(out_port, from_port=in_port)
+                    self.movePlungerAbs(0)
+                    built[key] = (self.chain_steps, dict(self.sim_state))
+                    self.cmd_chain = ''
+                    self.chain_steps = []
+                    self.exec_time = 0
+                stroke, end_state = built[key]
+                steps.extend(stroke)
+                self.sim_state = dict(end_state)
+                idx += 1
+            state = dict(self.sim_state)
+            segment_ul = sum(strokes[first:idx]) * float(self.syringe_ul) / \
+                max_pos
+            segments = segmentChain(compressLoops(steps), CMD_BUFFER_LEN - 1)
+            for seg_idx, segment in enumerate(segments, 1):
+                yield segment, segment_ul if seg_idx == len(segments) else 0.0
+
+    def transfer(self, in_port, out_port, volume_ul, stroke_ul=None,
+                 speed_code=None, progress=None, polling_interval=0.01):
+        """
+        Moves `volume_ul` (which can exceed the syringe volume) from
+        `in_port` to `out_port` and blocks until it is done. Strokes are
+        compressed into g...G loops, so a transfer is usually sent as a
+        single chain; longer transfers are split into segments, each built
+        while the previous one runs and sent as soon as the pump is ready
+        (see `transferSegments` and `streamChain`).
+
+        Kwargs:
+            `stroke_ul` (float) : max volume per stroke
+                [default] - the syringe volume
+            `speed_code` (int) : speed code for the transfer
+            `progress` (callable) : called as
+                                    `progress(done_ul, volume_ul)` after
+                                    each segment
+            `polling_interval` (float) : ready polling interval in seconds
+                                         near the end of each segment
+
+        """
+        if self.debug:
+            self.logCall('transfer', locals())
+
+        volumes = []
+
+        def segments():
+            for segment, segment_ul in self.transferSegments(
+                    in_port, out_port, volume_ul, stroke_ul, speed_code):
+                volumes.append(segment_ul)
+                yield segment
+
+        def segmentsDone(num_done):
+            if progress is not None:
+                progress(sum(volumes[:num_done]), volume_ul)
+
+        try:
+            delay = self.streamChain(segments(), progress=segmentsDone,
+                                     polling_interval=polling_interval)
+        except Exception:
+            self.resetChain()
+            raise
+        # The simulation state is now the end state of the last segment
+        self.resetChain(on_execute=True, minimal_reset=True)
+        self.waitReady(delay=delay, timeout=delay + 10)
+        segmentsDone(len(volumes))
+
+    def dispenseMany(self, aliquots, source_port, pre_waste_ul=0,
+                     post_waste_ul=0, waste_port=None, preserve_order=False,
+                     execute=True):
+        """
+        Dispenses many aliquots drawn from `source_port` using as few
+        syringe fills as possible. Aliquots are packed into strokes
+        (first-fit decreasing unless `preserve_order` is `True`), each
+        stroke is ordered to minimize valve travel, and plunger positions
+        are computed from the remaining volume in the syringe so rounding
+        errors do not accumulate within a stroke. Aliquots larger than a
+        single stroke are split across strokes.
+
+        Args:
+            `aliquots` (list) : list of `(port, volume_ul)` tuples
+            `source_port` (int) : port to aspirate from
+        Kwargs:
+            `pre_waste_ul` (float) : volume dispensed to waste after each
+                                     fill and before the first aliquot
+            `post_waste_ul` (float) : extra volume aspirated with each fill
+                                      and dispensed to waste at the end of
+                                      the stroke
+            `waste_port` (int) : port for pre/post-dispense waste
+                [default] - `self.waste_port`
+            `preserve_order` (bool) : keep the aliquots in the given order
+                                      (no packing or port reordering)
+            `execute` (bool) : execute the chain (otherwise it is left in
+                               `self.cmd_chain`)
+
+        Returns:
+            `exec_time` (float) : total estimated execution time in seconds
+
+        """
+        if self.debug:
+            self.logCall('dispenseMany', locals())
+
+        waste_port = waste_port if waste_port is not None else self.waste_port
+        capacity = self.syringe_ul - pre_waste_ul - post_waste_ul
+        if capacity <= 0:
+            raise ValueError('Pre and post-dispense waste volumes leave no '
+                             'room for aliquots')
+        pieces = []
+        for port, volume_ul in aliquots:
+            while volume_ul > capacity:
+                pieces.append((port, capacity))
+                volume_ul -= capacity
+            if volume_ul > 0:
+                pieces.append((port, volume_ul))
+        if not pieces and not pre_waste_ul and not post_waste_ul:
+            return 0
+
+        # Pack aliquots into strokes
+        strokes = []
+        if preserve_order:
+            for piece in pieces:
+                if not strokes or sum(v for _, v in strokes[-1]) + \
+                   piece[1] > capacity:
+                    strokes.append([])
+                strokes[-1].append(piece)
         else:
-            self.changePort(out_port)
-            self.movePlungerAbs(0)
-            self.changePort(in_port, from_port=out_port)
-            self.movePlungerAbs(self._ulToSteps(volume_ul))
-            self.changePort(out_port, from_port=in_port)
+            for piece in sorted(pieces, key=lambda piece: -piece[1]):
+                for stroke in strokes:
+                    if sum(v for _, v in stroke) + piece[1] <= capacity:
+                        stroke.append(piece)
+                        break
+                else:
+                    strokes.append([piece])
+
+        max_pos = 24000 if self.sim_state['microstep'] else 3000
+        steps_per_ul = max_pos / float(self.syringe_ul)
+        if self.sim_state['plunger_pos'] != 0:
+            self.changePort(waste_port)
             self.movePlungerAbs(0)
-            delay = self.executeChain()
-            self.waitReady(delay)
+        for stroke in strokes:
+            remaining_ul = pre_waste_ul + sum(v for _, v in stroke) + \
+                           post_waste_ul
+            self.changePort(source_port)
+            self.movePlungerAbs(int(round(remaining_ul * steps_per_ul)))
+            if pre_waste_ul:
+                remaining_ul -= pre_waste_ul
+                self.changePort(waste_port)
+                self.movePlungerAbs(int(round(remaining_ul * steps_per_ul)))
+            if not preserve_order:
+                stroke = self.orderPortOps(stroke)
+            for port, volume_ul in stroke:
+                remaining_ul -= volume_ul
+                if port != self.sim_state['port']:
+                    self.changePort(port)
+                self.movePlungerAbs(int(round(remaining_ul * steps_per_ul)))
+            if self.sim_state['plunger_pos'] != 0:
+                self.changePort(waste_port)
+                self.movePlungerAbs(0)
+        exec_time = self.exec_time
+        if execute:
+            self.executeChain()
+        return exec_time
+
+    def orderPortOps(self, ops, key=None):
+        """
+        Reorders a batch of operations that may be run in any order (e.g.
+        `(port, volume_ul)` dispenses) to minimize total valve travel from
+        the simulated current port (see `motion.orderByValveTravel`).
+
+        Args:
+            `ops` (list) : operations to reorder
+        Kwargs:
+            `key` (callable) : returns the port of an operation
+                [default] - the first item of each operation
+
+        """
+        if self.debug:
+            self.logCall('orderPortOps', locals())
+
+        key = key if key is not None else (lambda op: op[0])
+        from_port = self.sim_state['port'] or 1
+        return orderByValveTravel(ops, from_port, self.num_ports, key=key)
 
     #########################################################################
     # Command chain functions                                               #
@@ -277,20 +572,70 @@ class XCaliburD(Syringe):
         Executes and resets the current command chain (`self.cmd_chain`).
         Returns the estimated execution time (`self.exec_time`) for the chain.
 
+        Chains that exceed the pump's command buffer are split into
+        buffer-sized segments (see `streamChain`); in that case this call
+        blocks until the final segment has been sent and the returned time
+        refers to the final segment. Chains loaded with `loadChain` are
+        sent as-is (already segmented and validated).
+
         """
-        self.logCall('executeChain', locals())
+        if self.debug:
+            self.logCall('executeChain', locals())
 
         # Compensaate for reset time (tic/toc) prior to returning wait_time
-        tic = time.time()
-        self.sendRcv(self.cmd_chain, execute=True)
-        exec_time = self.exec_time
+        tic = self._time()
+        CHAIN_LENGTH.observe(len(self.cmd_chain), device=self.device)
+        segments = self.chainSegments()
+        try:
+            if len(segments) > 1:
+                exec_time = self.streamChain(segments)
+                tic = self._time()
+            else:
+                self._resume = (dict(self.state), dict(self.sim_state))
+                self.sendRcv(self.cmd_chain, execute=True)
+                exec_time = self.exec_time
+        finally:
+            self._resume = None
         self.resetChain(on_execute=True, minimal_reset=minimal_reset)
-        toc = time.time()
+        toc = self._time()
         wait_time = exec_time - (toc-tic)
         if wait_time < 0:
             wait_time = 0
         return wait_time
 
+    def iterChain(self, minimal_reset=False):
+        """
+        Generator that executes the current command chain one segment at a
+        time, for callers that poll several pumps from one loop (see
+        scheduler.py). Each iteration sends the next segment and yields
+        its estimated execution time; advance it only once the pump is
+        ready again (e.g. with `checkReady`). The chain is reset as by
+        `executeChain` when the last segment is sent, and the error
+        recovery state when the generator is exhausted or closed.
+
+        """
+        if self.debug:
+            self.logCall('iterChain', locals())
+
+        CHAIN_LENGTH.observe(len(self.cmd_chain), device=self.device)
+        segments = self.chainSegments()
+        end_state = dict(self.sim_state)
+        speed_change = self.sim_speed_change
+        state = dict(self.state)
+        try:
+            for idx, segment in enumerate(segments, 1):
+                state = self.sendSegment(segment, state)
+                if idx == len(segments):
+                    # A recovery resets the simulation state, so restore
+                    # the end state of the chain
+                    self.sim_state = end_state
+                    self.sim_speed_change = speed_change
+                    self.resetChain(on_execute=True,
+                                    minimal_reset=minimal_reset)
+                yield chainTime(segment)
+        finally:
+            self._resume = None
+
     def resetChain(self, on_execute=False, minimal_reset=False):
         """
         Resets the command chain (`self.cmd_chain`) and execution time
@@ -308,29 +653,226 @@ class XCaliburD(Syringe):
                                      be extremely reliable but use with
                                      caution.
         """
-        self.logCall('resetChain', locals())
+        if self.debug:
+            self.logCall('resetChain', locals())
 
         self.cmd_chain = ''
+        self.chain_steps = []
+        self._loop_marks = []
+        self._segments = None
         self.exec_time = 0
-        if (on_execute and self.sim_speed_change):
-            if minimal_reset:
-                self.state = {k: v for k, v in self.sim_state.items()}
-            else:
-                self.state['slope'] = self.sim_state['slope']
-                self.state['microstep'] = self.sim_state['microstep']
+        if on_execute:
+            with self._state_lock:
+                if minimal_reset:
+                    self.state = {k: v for k, v in self.sim_state.items()}
+                else:
+                    # The pump is still moving, so take the end positions
+                    # from the simulation rather than polling intermediate
+                    # positions
+                    self.state['plunger_pos'] = self.sim_state['plunger_pos']
+                    self.state['port'] = self.sim_state['port']
+                    if self.sim_speed_change:
+                        self.state['slope'] = self.sim_state['slope']
+                        self.state['microstep'] = self.sim_state['microstep']
+                self.state_version += 1
+            if not minimal_reset and self.sim_speed_change:
                 self.updateSpeeds()
-                self.getCurPort()
-                self.getPlungerPos()
         self.sim_speed_change = False
         self.updateSimState()
 
+    def saveChain(self):
+        """
+        Returns a snapshot of the command chain, the simulation state, and
+        the step rounding residuals, for `restoreChain`
+
+        """
+        return {
+            'cmd_chain': self.cmd_chain,
+            'chain_steps': list(self.chain_steps),
+            '_loop_marks': list(self._loop_marks),
+            '_segments': self._segments,
+            'exec_time': self.exec_time,
+            'sim_speed_change': self.sim_speed_change,
+            'sim_state': dict(self.sim_state),
+            '_step_residuals': dict(self._step_residuals)
+        }
+
+    def restoreChain(self, saved):
+        """
+        Restores a snapshot from `saveChain`, discarding any commands added
+        since (e.g. by a build that failed part way)
+
+        """
+        for key, value in saved.items():
+            if isinstance(value, (list, dict)):
+                value = type(value)(value)
+            setattr(self, key, value)
+
+    def validateChain(self, segments=None):
+        """
+        Validates the current command chain against the pump state before
+        it is sent (see `chain.validateChain`), so invalid plunger moves,
+        ports, or buffer overflows fail locally instead of on the pump.
+        The chain is reset if validation fails.
+
+        Kwargs:
+            `segments` (list) : pre-computed chain segments to validate in
+                                order (defaults to the current chain as a
+                                single segment)
+
+        """
+        if self.debug:
+            self.logCall('validateChain', locals())
+
+        if segments is None:
+            segments = [self.chain_steps]
+        state = self.state
+        try:
+            for segment in segments:
+                state = validateChain(segment, state, self.num_ports)
+        except ValueError:
+            self.resetChain()
+            raise
+
+    def chainSegments(self):
+        """
+        Returns the current command chain as validated, buffer-sized
+        segments (see `chain.segmentChain`), compressing it into loops
+        first if it does not fit in the command buffer. Chains loaded with
+        `loadChain` are returned as-is.
+
+        """
+        if self._segments is not None:
+            return self._segments
+        if len(self.cmd_chain) >= CMD_BUFFER_LEN:
+            self.compressChain()
+        segments = segmentChain(self.chain_steps, CMD_BUFFER_LEN - 1)
+        self.validateChain(segments)
+        return segments
+
+    def loadChain(self, segments, end_state, start_state=None,
+                  speed_change=False):
+        """
+        Loads a pre-compiled, pre-validated command chain (see protocol.py)
+        so that `executeChain` sends it without compressing, segmenting, or
+        validating it again.
+
+        Args:
+            `segments` (list) : chain segments (lists of
+                                `(cmd_string, exec_time)` steps)
+            `end_state` (dict) : simulated pump state at the end of the
+                                 chain
+        Kwargs:
+            `start_state` (dict) : pump state the chain was compiled
+                                   against; raises `ValueError` if the
+                                   `plunger_pos`, `port`, or `microstep`
+                                   state of the pump differs
+            `speed_change` (bool) : whether the chain changes any speed
+                                    settings
+
+        """
+        if self.debug:
+            self.logCall('loadChain', locals())
+
+        if self.cmd_chain:
+            raise ValueError('Cannot load a chain while another command chain '
+                             'is pending')
+        if start_state is not None:
+            for key in ('plunger_pos', 'port', 'microstep'):
+                if key in start_state and start_state[key] != self.state[key]:
+                    raise ValueError('Chain was compiled for `{0}` = {1} but '
+                                     'the pump is at {2}'.format(
+                                     key, start_state[key], self.state[key]))
+        segments = [[tuple(step) for step in segment]
+                    for segment in segments]
+        for segment in segments:
+            for cmd_string, exec_time in segment:
+                self._appendCmd(cmd_string, exec_time)
+        self._segments = segments
+        self.sim_state.update(end_state)
+        self.sim_speed_change = speed_change
+
+    def compressChain(self):
+        """
+        Compresses repeated command subsequences in the current command
+        chain into g...G loops (see `chain.compressLoops`). The estimated
+        execution time and simulation state are unchanged.
+
+        """
+        if self.debug:
+            self.logCall('compressChain', locals())
+
+        if self._loop_marks:
+            raise ValueError('Cannot compress a chain with an open loop '
+                             '(`markRepeatStart` without `repeatCmdSeq`)')
+        self.chain_steps = compressLoops(self.chain_steps)
+        self.cmd_chain = chainString(self.chain_steps)
+
+    def streamChain(self, segments, lead_time=0.05, polling_interval=0.01,
+                    progress=None):
+        """
+        Sends chain `segments` (see `chain.segmentChain`) to the pump back
+        to back. `segments` can be any iterable (e.g. a generator that
+        builds each segment while the previous one runs). After each
+        segment is sent, sleeps until shortly before its estimated
+        completion and then polls the pump's ready status, so that the next
+        segment is sent as soon as the pump can accept it. Returns the
+        estimated execution time of the final segment. Does not reset the
+        command chain.
+
+        Kwargs:
+            `lead_time` (float) : time in seconds before the estimated
+                                  completion of a segment to start polling
+            `polling_interval` (float) : polling interval in seconds once
+                                         polling has started
+            `progress` (callable) : called as `progress(num_done)` each time
+                                    a segment is confirmed complete (the
+                                    final segment is not waited for)
+
+        """
+        if self.debug:
+            self.logCall('streamChain', locals())
+
+        seg_time = 0
+        state = dict(self.state)
+        for idx, segment in enumerate(segments):
+            if idx > 0:
+                delay = max(seg_time - (self._time() - sent) - lead_time, 0)
+                self._ready = False
+                self.waitReady(timeout=max(2 * seg_time, 10),
+                               polling_interval=polling_interval,
+                               delay=delay)
+                if progress is not None:
+                    progress(idx)
+            if self.debug:
+                self.logDebug('streamChain: sending segment {0}'
+                              ''.format(idx + 1))
+            state = self.sendSegment(segment, state)
+            sent = self._time()
+            seg_time = chainTime(segment)
+        return seg_time
+
+    def sendSegment(self, segment, state):
+        """
+        Sends and executes a single chain `segment` that starts from the
+        pump `state` (see `streamChain`). Returns the simulated state at
+        the end of the segment. The start and end states are kept for
+        error recovery until the next segment is sent or the stream ends.
+
+        """
+        end_state = validateChain(segment, state, self.num_ports)
+        self._resume = (state, end_state)
+        self.sendRcv(chainString(segment), execute=True)
+        return end_state
+
     def updateSimState(self):
         """
         Copies the current state dictionary (`self.state`) to the
         simulation state dictionary (`self.sim_state`)
 
         """
-        self.logCall('updateSimState', locals())
+        if self.debug:
+            self.logCall('updateSimState', locals())
 
         self.sim_state = {k: v for k, v in self.state.items()}
 
@@ -341,7 +883,8 @@ class XCaliburD(Syringe):
         need to be temporarily changed and then reverted
 
         """
-        self.logCall('cacheSimSpeeds', locals())
+        if self.debug:
+            self.logCall('cacheSimSpeeds', locals())
 
         self._cached_start_speed = self.sim_state['start_speed']
         self._cached_top_speed = self.sim_state['top_speed']
@@ -349,7 +892,8 @@ class XCaliburD(Syringe):
 
     def restoreSimSpeeds(self):
         """ Restores simulation speeds cached by `self.cacheSimSpeeds` """
-        self.logCall('restoreSimSpeeds', locals())
+        if self.debug:
+            self.logCall('restoreSimSpeeds', locals())
 
         self.sim_state['start_speed'] = self._cached_start_speed
         self.sim_state['top_speed'] = self._cached_top_speed
@@ -380,6 +924,21 @@ class XCaliburD(Syringe):
                 return self.executeChain(minimal_reset=minimal_reset)
         return addAndExec
 
+    def _appendCmd(self, cmd_string, exec_time=0):
+        """
+        Appends `cmd_string` to the command chain and adds its estimated
+        `exec_time` (in seconds) to the chain execution time. Raises
+        `ValueError` if a pre-compiled chain is loaded (see `loadChain`),
+        since it is sent as-is.
+
+        """
+        if self._segments is not None:
+            raise ValueError('Cannot add `{0}` to a loaded chain'
+                             ''.format(cmd_string))
+        self.cmd_chain += cmd_string
+        self.chain_steps.append((cmd_string, exec_time))
+        self.exec_time += exec_time
+
     #########################################################################
     # Chainable high level functions                                        #
     #########################################################################
@@ -390,7 +949,8 @@ class XCaliburD(Syringe):
         Dispense current syringe contents to waste. If `retain_port` is true,
         the syringe will be returned to the original port after the dump.
         """
-        self.logCall('dispenseToWaste', locals())
+        if self.debug:
+            self.logCall('dispenseToWaste', locals())
         if retain_port:
             orig_port = self.sim_state['port']
         self.changePort(self.waste_port)
@@ -401,18 +961,20 @@ class XCaliburD(Syringe):
     @execWrap
     def extract(self, from_port, volume_ul):
         """ Extract `volume_ul` from `from_port` """
-        self.logCall('extract', locals())
+        if self.debug:
+            self.logCall('extract', locals())
 
-        steps = self._ulToSteps(volume_ul)
+        steps = self._ulToSteps(volume_ul, residual_key='extract')
         self.changePort(from_port)
         self.movePlungerRel(steps)
 
     @execWrap
     def dispense(self, to_port, volume_ul):
         """ Dispense `volume_ul` from `to_port` """
-        self.logCall('dispense', locals())
+        if self.debug:
+            self.logCall('dispense', locals())
 
-        steps = self._ulToSteps(volume_ul)
+        steps = self._ulToSteps(volume_ul, residual_key='dispense')
         self.changePort(to_port)
         self.movePlungerRel(-steps)
 
@@ -421,22 +983,24 @@ class XCaliburD(Syringe):
     #########################################################################
 
     @execWrap
-    def changePort(self, to_port, from_port=None, direction='CW'):
+    def changePort(self, to_port, from_port=None, direction=None):
         """
-        Change port to `to_port`. If `from_port` is provided, the `direction`
-        will be calculated to minimize travel time. `direction` may also be
-        provided directly.
+        Change port to `to_port`. Unless `direction` is provided, the valve
+        turns in the direction with the shorter angular distance from
+        `from_port` (which defaults to the simulated current port). The
+        estimated move time scales with the angular distance.
 
         Args:
             `to_port` (int) : port to which to change
         Kwargs:
             `from_port` (int) : originating port
             `direction` (str) : direction of valve movement
-                'CW' - clockwise
+                'CW' - clockwise (towards higher port numbers)
                 'CCW' - counterclockwise
 
         """
-        self.logCall('changePort', locals())
+        if self.debug:
+            self.logCall('changePort', locals())
 
         if not 0 < to_port <= self.num_ports:
             raise(ValueError('`to_port` [{0}] must be between 1 and '
@@ -447,14 +1011,13 @@ class XCaliburD(Syringe):
                 from_port = self.sim_state['port']
             else:
                 from_port = 1
-        delta = to_port - from_port
-        diff = -delta if abs(delta) >= 7 else delta
-        direction = 'CCW' if diff < 0 else 'CW'
+        direction, port_steps = valveTravel(from_port, to_port,
+                                            self.num_ports, direction)
         cmd_string = '{0}{1}'.format(self.__class__.DIR_DICT[direction][0],
                                      to_port)
         self.sim_state['port'] = to_port
-        self.cmd_chain += cmd_string
-        self.exec_time += 0.2
+        self._appendCmd(cmd_string, self.calibration.valveTime(
+                        port_steps, self.num_ports))
 
     @execWrap
     def movePlungerAbs(self, abs_position):
@@ -467,7 +1030,8 @@ class XCaliburD(Syringe):
                 (0-3000) in standard mode
 
         """
-        self.logCall('movePlungerAbs', locals())
+        if self.debug:
+            self.logCall('movePlungerAbs', locals())
 
         if self.sim_state['microstep']:
             if not 0 <= abs_position <= 24000:
@@ -483,15 +1047,14 @@ class XCaliburD(Syringe):
         cur_pos = self.sim_state['plunger_pos']
         delta_pos = cur_pos-abs_position
         self.sim_state['plunger_pos'] = abs_position
-        self.cmd_chain += cmd_string
-        self.exec_time += self._calcPlungerMoveTime(abs(delta_pos))
+        self._appendCmd(cmd_string, self._calcPlungerMoveTime(abs(delta_pos)))
 
     @execWrap
     def movePlungerRel(self, rel_position):
         """
-        Moves the plunger to relative position `rel_position`. There is no
-        front-end error handling -- invalid relative moves will result in
-        error code 3 from the XCalibur, raising a `SyringeError`
+        Moves the plunger to relative position `rel_position`. The move is
+        bounds-checked against the simulated pump state when the chain is
+        executed (see `validateChain`), raising a `ValueError`
 
         Args:
             `rel_position` (int) : relative plunger position
@@ -499,15 +1062,16 @@ class XCaliburD(Syringe):
                 if rel_position > 0 : plunger moves down (relative extract)
 
         """
-        self.logCall('movePlungerRel', locals())
+        if self.debug:
+            self.logCall('movePlungerRel', locals())
 
         if rel_position < 0:
             cmd_string = 'D{0}'.format(abs(rel_position))
         else:
             cmd_string = 'P{0}'.format(rel_position)
         self.sim_state['plunger_pos'] += rel_position
-        self.cmd_chain += cmd_string
-        self.exec_time += self._calcPlungerMoveTime(abs(rel_position))
+        self._appendCmd(cmd_string,
+                        self._calcPlungerMoveTime(abs(rel_position)))
 
     #########################################################################
     # Command set commands                                                  #
@@ -516,7 +1080,8 @@ class XCaliburD(Syringe):
     @execWrap
     def setSpeed(self, speed_code):
         """ Set top speed by `speed_code` (see OEM docs) """
-        self.logCall('setSpeed', locals())
+        if self.debug:
+            self.logCall('setSpeed', locals())
 
         if not 0 <= speed_code <= 40:
             raise(ValueError('`speed_code` [{0}] must be between 0 and 40'
@@ -524,82 +1089,202 @@ class XCaliburD(Syringe):
         cmd_string = 'S{0}'.format(speed_code)
         self.sim_speed_change = True
         self._simIncToPulses(speed_code)
-        self.cmd_chain += cmd_string
+        self._appendCmd(cmd_string)
+
+    @execWrap
+    def setFlowRate(self, max_flow_ul_s, max_accel_ul_s2=None,
+                    use_speed_code=False):
+        """
+        Sets the fastest speeds and slope that keep the flow rate at or
+        below `max_flow_ul_s` (and the acceleration at or below
+        `max_accel_ul_s2`, if provided). See `planSpeeds`.
+
+        """
+        if self.debug:
+            self.logCall('setFlowRate', locals())
+
+        plan = self.planSpeeds(0, max_flow_ul_s, max_accel_ul_s2,
+                               use_speed_code)
+        if plan['speed_code'] is not None:
+            self.setSpeed(plan['speed_code'])
+        else:
+            self.setTopSpeed(plan['top_speed'])
+        self.setStartSpeed(plan['start_speed'])
+        self.setCutoffSpeed(plan['cutoff_speed'])
+        self.setSlope(plan['slope'])
+
+    def planSpeeds(self, volume_ul, max_flow_ul_s, max_accel_ul_s2=None,
+                   use_speed_code=False):
+        """
+        Returns the time-optimal speed settings for moving `volume_ul`
+        under the given flow rate (uL/s) and acceleration (uL/s^2) limits
+        for this syringe and microstep mode (see `motion.planSpeeds`).
+        Does not modify the command chain.
+
+        """
+        if self.debug:
+            self.logCall('planSpeeds', locals())
+
+        return planSpeeds(volume_ul, max_flow_ul_s, self.syringe_ul,
+                          microstep=self.sim_state['microstep'],
+                          max_accel_ul_s2=max_accel_ul_s2,
+                          use_speed_code=use_speed_code)
 
     @execWrap
     def setStartSpeed(self, pulses_per_sec):
         """ Set start speed in `pulses_per_sec` [50-1000] """
-        self.logCall('setStartSpeed', locals())
+        if self.debug:
+            self.logCall('setStartSpeed', locals())
 
         cmd_string = 'v{0}'.format(pulses_per_sec)
         self.sim_speed_change = True
-        self.cmd_chain += cmd_string
+        self.sim_state['start_speed'] = min(pulses_per_sec,
+                                            self.sim_state['top_speed'])
+        self._appendCmd(cmd_string)
 
     @execWrap
     def setTopSpeed(self, pulses_per_sec):
         """ Set top speed in `pulses_per_sec` [5-6000] """
-        self.logCall('setTopSpeed', locals())
+        if self.debug:
+            self.logCall('setTopSpeed', locals())
 
         cmd_string = 'V{0}'.format(pulses_per_sec)
         self.sim_speed_change = True
-        self.cmd_chain += cmd_string
+        self._simTopSpeed(pulses_per_sec)
+        self._appendCmd(cmd_string)
 
     @execWrap
     def setCutoffSpeed(self, pulses_per_sec):
         """ Set cutoff speed in `pulses_per_sec` [50-2700] """
-        self.logCall('setCutoffSpeed', locals())
+        if self.debug:
+            self.logCall('setCutoffSpeed', locals())
 
         cmd_string = 'c{0}'.format(pulses_per_sec)
         self.sim_speed_change = True
-        self.cmd_chain += cmd_string
+        self.sim_state['cutoff_speed'] = min(pulses_per_sec,
+                                             self.sim_state['top_speed'])
+        self._appendCmd(cmd_string)
 
     @execWrap
     def setSlope(self, slope_code, chain=False):
-        self.logCall('setSlope', locals())
+        if self.debug:
+            self.logCall('setSlope', locals())
 
         if not 1 <= slope_code <= 20:
             raise(ValueError('`slope_code` [{0}] must be between 1 and 20'
                              ''.format(slope_code)))
         cmd_string = 'L{0}'.format(slope_code)
         self.sim_speed_change = True
-        self.cmd_chain += cmd_string
+        self.sim_state['slope'] = slope_code
+        self._appendCmd(cmd_string)
 
     # Chainable control commands
 
     @execWrap
     def repeatCmdSeq(self, num_repeats):
-        self.logCall('repeatCmdSeq', locals())
+        """
+        Repeats the command sequence since the matching `markRepeatStart`
+        (or since the start of the chain) `num_repeats` times in total.
+        The simulated plunger position and estimated execution time account
+        for all iterations.
+
+        """
+        if self.debug:
+            self.logCall('repeatCmdSeq', locals())
 
         if not 0 < num_repeats < 30000:
             raise(ValueError('`num_repeats` [{0}] must be between 0 and 30000'
                              ''.format(num_repeats)))
+        if self._loop_marks:
+            mark_idx, start_pos = self._loop_marks.pop()
+        else:
+            self.chain_steps.insert(0, ('g', 0))
+            self.cmd_chain = 'g' + self.cmd_chain
+            mark_idx, start_pos = 0, self.state['plunger_pos']
+        body = self.chain_steps[mark_idx + 1:]
+        # Valve and absolute moves in the first iteration start from the
+        # state before the loop, so price the repeated iterations from the
+        # state at the end of the first one
+        repeat_time = 0
+        if num_repeats > 1:
+            saved = self.saveChain()
+            self.cmd_chain = ''
+            self.chain_steps = []
+            self._loop_marks = []
+            self.exec_time = 0
+            self._replaySteps(body)
+            repeat_time = self.exec_time
+            self.restoreChain(saved)
+        # Bodies without absolute moves shift the plunger every iteration
+        if not any(cmd.startswith('A') for cmd, _ in body):
+            delta_pos = self.sim_state['plunger_pos'] - start_pos
+            self.sim_state['plunger_pos'] += delta_pos * (num_repeats - 1)
         cmd_string = 'G{0}'.format(num_repeats)
-        self.cmd_chain += cmd_string
-        self.exec_time *= num_repeats
+        self._appendCmd(cmd_string, repeat_time * (num_repeats - 1))
+
+    def _replaySteps(self, steps):
+        """
+        Adds the commands of chain `steps` to the command chain again,
+        estimating their execution time from the current simulation state
+
+        """
+        for cmd, _ in steps:
+            op, arg = cmd[0], cmd[1:]
+            if op == 'g':
+                self.markRepeatStart()
+            elif op == 'G':
+                self.repeatCmdSeq(int(arg))
+            elif op == 'A':
+                self.movePlungerAbs(int(arg))
+            elif op in 'PD':
+                self.movePlungerRel(int(arg) if op == 'P' else -int(arg))
+            elif op in 'IO':
+                self.changePort(int(arg), direction='CW' if op == 'I' else
+                                'CCW')
+            elif op == 'M':
+                self.delayExec(int(arg))
+            elif op == 'S':
+                self.setSpeed(int(arg))
+            elif op == 'V':
+                self.setTopSpeed(int(arg))
+            elif op == 'v':
+                self.setStartSpeed(int(arg))
+            elif op == 'c':
+                self.setCutoffSpeed(int(arg))
+            elif op == 'L':
+                self.setSlope(int(arg))
+            else:
+                self._appendCmd(cmd)
 
     @execWrap
     def markRepeatStart(self):
-        self.logCall('markRepeatStart', locals())
+        """ Marks the start of a command sequence to repeat """
+        if self.debug:
+            self.logCall('markRepeatStart', locals())
 
+        self._loop_marks.append((len(self.chain_steps),
+                                 self.sim_state['plunger_pos']))
         cmd_string = 'g'
-        self.cmd_chain += cmd_string
+        self._appendCmd(cmd_string)
 
     @execWrap
     def delayExec(self, delay_ms):
         """ Delays command execution for `delay` milliseconds """
-        self.logCall('delayExec', locals())
+        if self.debug:
+            self.logCall('delayExec', locals())
 
         if not 0 < delay_ms < 30000:
             raise(ValueError('`delay` [{0}] must be between 0 and 40000 ms'
                              ''.format(delay_ms)))
         cmd_string = 'M{0}'.format(delay_ms)
-        self.cmd_chain += cmd_string
+        self._appendCmd(cmd_string, delay_ms / 1000.0)
 
     @execWrap
     def haltExec(self, input_pin=0):
         """
         Used within a command string to halt execution until another [R]
-        command is sent, or until TTL pin `input_pin` goes low
+        command is sent, or until TTL pin `input_pin` goes low (see
+        sync.py)
 
         Kwargs:
             `input_pin` (int) : input pin code corresponding to the desired
@@ -609,20 +1294,22 @@ class XCaliburD(Syringe):
                 2 - input 2 (J4 pin 8)
 
         """
-        self.logCall('haltExec', locals())
+        if self.debug:
+            self.logCall('haltExec', locals())
 
-        if not 0 <= input_pin < 2:
+        if not 0 <= input_pin <= 2:
             raise(ValueError('`input_pin` [{0}] must be between 0 and 2'
-                             ''.format(input_sig)))
-        cmd_string = 'H{0}'.format(input_sig)
-        return self.sendRcv(cmd_string)
+                             ''.format(input_pin)))
+        cmd_string = 'H{0}'.format(input_pin)
+        self._appendCmd(cmd_string)
 
     #########################################################################
     # Report commands (cannot be chained)                                   #
     #########################################################################
 
     def updateSpeeds(self):
-        self.logCall('updateSpeeds', locals())
+        if self.debug:
+            self.logCall('updateSpeeds', locals())
 
         self.getStartSpeed()
         self.getTopSpeed()
@@ -630,43 +1317,48 @@ class XCaliburD(Syringe):
 
     def getPlungerPos(self):
         """ Returns the absolute plunger position as an int (0-3000) """
-        self.logCall('getPlungerPos', locals())
+        if self.debug:
+            self.logCall('getPlungerPos', locals())
 
         cmd_string = '?'
         data = self.sendRcv(cmd_string)
-        self.state['plunger_pos'] = int(data)
+        self._setState({'plunger_pos': int(data)})
         return self.state['plunger_pos']
 
     def getStartSpeed(self):
         """ Returns the start speed as an int (in pulses/sec) """
-        self.logCall('getStartSpeed', locals())
+        if self.debug:
+            self.logCall('getStartSpeed', locals())
 
         cmd_string = '?1'
         data = self.sendRcv(cmd_string)
-        self.state['start_speed'] = int(data)
+        self._setState({'start_speed': int(data)})
         return self.state['start_speed']
 
     def getTopSpeed(self):
         """ Returns the top speed as an int (in pulses/sec) """
-        self.logCall('getTopSpeed', locals())
+        if self.debug:
+            self.logCall('getTopSpeed', locals())
 
         cmd_string = '?2'
         data = self.sendRcv(cmd_string)
-        self.state['top_speed'] = int(data)
+        self._setState({'top_speed': int(data)})
         return self.state['top_speed']
 
     def getCutoffSpeed(self):
         """ Returns the cutoff speed as an int (in pulses/sec) """
-        self.logCall('getCutoffSpeed', locals())
+        if self.debug:
+            self.logCall('getCutoffSpeed', locals())
 
         cmd_string = '?3'
         data = self.sendRcv(cmd_string)
-        self.state['cutoff_speed'] = int(data)
+        self._setState({'cutoff_speed': int(data)})
         return self.state['cutoff_speed']
 
     def getEncoderPos(self):
         """ Returns the current encoder count on the plunger axis """
-        self.logCall('getEncoderPos', locals())
+        if self.debug:
+            self.logCall('getEncoderPos', locals())
 
         cmd_string = '?4'
         data = self.sendRcv(cmd_string)
@@ -674,7 +1366,8 @@ class XCaliburD(Syringe):
 
     def getCurPort(self):
         """ Returns the current port position (1-num_ports) """
-        self.logCall('getCurPort', locals())
+        if self.debug:
+            self.logCall('getCurPort', locals())
 
         cmd_string = '?6'
         data = self.sendRcv(cmd_string)
@@ -683,24 +1376,82 @@ class XCaliburD(Syringe):
                 port = int(data)
             except ValueError:
                 raise SyringeError(7, self.__class__.ERROR_DICT)
-            self.state['port'] = port
+            self._setState({'port': port})
             return port
 
     def getBufferStatus(self):
         """ Returns the current cmd buffer status (0=empty, 1=non-empty) """
-        self.logCall('getBufferStatus', locals())
+        if self.debug:
+            self.logCall('getBufferStatus', locals())
 
         cmd_string = '?10'
         data = self.sendRcv(cmd_string)
         return int(data)
 
+    def _setState(self, changes, version=None):
+        """
+        Updates `self.state` with `changes` and bumps `state_version` if
+        anything changed. If `version` is given, the update is dropped
+        (returns `False`) when the state version has moved on since.
+
+        """
+        with self._state_lock:
+            if version is not None and version != self.state_version:
+                return False
+            if any(self.state.get(k) != v for k, v in changes.items()):
+                self.state.update(changes)
+                self.state_version += 1
+            return True
+
+    def stateSnapshot(self):
+        """ Returns a consistent `(state_version, state)` pair """
+        with self._state_lock:
+            return self.state_version, dict(self.state)
+
+    def pollStatus(self, update_state=False):
+        """
+        Samples the ready/error status, plunger position, and valve port
+        directly over the com link. Does not touch the command chain or the
+        error handling state, so it is safe to call from a monitoring
+        thread (see status.py).
+
+        Kwargs:
+            `update_state` (bool) : if the pump is ready without an error,
+                                    confirm the sampled `plunger_pos` and
+                                    `port` into `self.state` (unless a chain
+                                    was executed during the poll)
+
+        Returns:
+            `status` (dict) : `ready` (bool), `error` (int error code),
+                              `plunger_pos` and `port` (`None` if the pump
+                              did not report a number)
+
+        """
+        status = {}
+        version = self.state_version
+        for cmd_string, key in (('?', 'plunger_pos'), ('?6', 'port')):
+            response = self.com_link.sendRcv(cmd_string)
+            try:
+                status[key] = int(response['data'])
+            except (TypeError, ValueError):
+                status[key] = None
+        status_byte = response['status_byte']
+        status['ready'] = status_byte[2] == '1'
+        status['error'] = int(status_byte[4:8], 2)
+        if update_state and status['ready'] and not status['error'] and \
+                None not in (status['plunger_pos'], status['port']):
+            self._setState({'plunger_pos': status['plunger_pos'],
+                            'port': status['port']}, version=version)
+        return status
+
     #########################################################################
     # Config commands                                                       #
     #########################################################################
 
     def setMicrostep(self, on=False):
         """ Turns microstep mode on or off """
-        self.logCall('setMicrostep', locals())
+        if self.debug:
+            self.logCall('setMicrostep', locals())
 
         cmd_string = 'N{0}'.format(int(on))
         self.sendRcv(cmd_string, execute=True)
@@ -711,54 +1462,192 @@ class XCaliburD(Syringe):
     #########################################################################
 
     def terminateCmd(self):
-        self.logCall('terminateCommand', locals())
+        """
+        Terminates the command string in progress (including one halted
+        with `haltExec`). 'T' acts immediately, so it is sent without an
+        execute command.
+
+        """
+        if self.debug:
+            self.logCall('terminateCommand', locals())
 
         cmd_string = 'T'
-        return self.sendRcv(cmd_string, execute=True)
+        return self.sendRcv(cmd_string)
 
     #########################################################################
     # Communication handlers and special functions                          #
     #########################################################################
 
+    # Error codes handled by `_syringeErrorHandler`
+    RECOVERABLE_ERRORS = (7, 9, 10)
+
+    # Commands that move the plunger or valve (or loop over moves)
+    _MOVE_OPS = 'APDIOgG'
+
+    def _planRecovery(self, err_code, cmd_string):
+        """
+        Picks the cheapest safe recovery for error `err_code` reported in
+        response to `cmd_string`. Returns `(repair, follow_up)`:
+
+        `repair` : 'requery' - nothing (the error had already cleared when
+                               the pump was queried again)
+                   'valve' - re-home the valve only (valve overload [10];
+                             the plunger keeps its position)
+                   'init' - re-initialize the plunger and valve (not
+                            initialized [7], plunger overload [9])
+        `follow_up` : 'requery' - resend the query (queries report errors
+                                  of earlier commands)
+                      'replay' - restore the state the rejected command was
+                                 built for and resend it (error 7: the
+                                 command did not run)
+                      'resume' - restore the simulated state at the end of
+                                 the interrupted moves, which are not safe
+                                 to repeat (errors 9 and 10)
+                      'resend' - resend the command (no moves)
+                      None - nothing left to do (init / terminate commands)
+
+        """
+        cmd = cmd_string[:-1] if cmd_string.endswith('R') else cmd_string
+        repair = 'valve' if err_code == 10 else 'init'
+        if cmd in ('Q', '&') or cmd.startswith('?'):
+            return repair, 'requery'
+        ops = [token[0] for token in tokenizeChain(cmd)]
+        if not ops or ops[0] in 'ZYWwT':
+            return repair, None
+        if any(op in self.__class__._MOVE_OPS for op in ops):
+            return repair, 'replay' if err_code == 7 else 'resume'
+        return repair, 'resend'
+
+    def _waitIdle(self, timeout=30, polling_interval=0.1):
+        """
+        Re-queries the pump status until it is no longer busy (e.g. with
+        moves queued before the failed one) and returns its error code
+
+        """
+        start = self._time()
+        while True:
+            status_byte = self.com_link.sendRcv('Q')['status_byte']
+            if status_byte[2] == '1':
+                return int(status_byte[4:8], 2)
+            if self._time() - start > timeout:
+                raise SyringeTimeout('Timeout while waiting for the pump to '
+                                     'stop before recovery [{0}]'.format(
+                                     timeout))
+            self._sleep(polling_interval)
+
+    def _restoreState(self, target):
+        """ Moves the valve and plunger to the `target` state """
+        if target.get('port') and self.state['port'] != target['port']:
+            self.changePort(target['port'])
+        if target.get('plunger_pos') is not None and \
+                self.state['plunger_pos'] != target['plunger_pos']:
+            self.movePlungerAbs(target['plunger_pos'])
+        if self.cmd_chain:
+            wait_time = self.executeChain()
+            self._waitReady(delay=wait_time)
+
+    def _recover(self, err_code, cmd_string):
+        """
+        Recovers from error `err_code` (see `_planRecovery`). Returns the
+        response data of the follow-up command (e.g. the re-query), and
+        records the recovery and its downtime in `self.last_recovery`.
+
+        """
+        tic = self._time()
+        repair, follow_up = self._planRecovery(err_code, cmd_string)
+        if self._resume is not None:
+            start_state, end_state = self._resume
+        else:
+            start_state = end_state = dict(self.state)
+        self.resetChain()
+        self._recovering = True
+        resume, self._resume = self._resume, None
+        data = None
+        try:
+            if not self._waitIdle():
+                repair = 'requery'
+            if repair == 'valve':
+                self.logDebug('ErrorHandler: re-homing valve')
+                try:
+                    self.sendRcv('w', execute=True)
+                    self._waitReady()
+                    self.getPlungerPos()
+                    self.getCurPort()
+                    self.updateSimState()
+                except SyringeError as e:
+                    self.logDebug('ErrorHandler: valve re-home failed [{}], '
+                                  're-initializing'.format(e.err_code))
+                    repair = 'init'
+            if repair == 'init':
+                self.logDebug('ErrorHandler: re-initializing')
+                self.init()
+            if follow_up == 'requery':
+                self._restoreState(end_state)
+                data = self.sendRcv(cmd_string)
+            elif follow_up == 'replay':
+                self._restoreState(start_state)
+                data = self.sendRcv(cmd_string)
+                self._ready = False
+                self.sim_state.update(end_state)
+            elif follow_up == 'resume':
+                self._restoreState(end_state)
+            elif follow_up == 'resend':
+                self._restoreState(end_state)
+                data = self.sendRcv(cmd_string)
+        finally:
+            self._recovering = False
+            self._resume = resume
+        downtime = self._time() - tic
+        action = '+'.join(step for step in (repair, follow_up) if step)
+        RECOVERIES.inc(device=self.device, code=err_code, action=action)
+        RECOVERY_TIME.observe(downtime, device=self.device, action=action)
+        self.last_recovery = {'error': err_code, 'cmd': cmd_string,
+                              'action': action, 'downtime': downtime}
+        self.logDebug('ErrorHandler: recovered from error {0} on {1} with '
+                      '{2} in {3:.3f} s'.format(err_code, cmd_string, action,
+                                                downtime))
+        return data
+
     @contextmanager
     def _syringeErrorHandler(self):
         """
-        Context manager to handle `SyringeError` based on error code. Right
-        now this just handles error codes 7, 9, and 10 by initializing the
-        pump and then re-running the previous command.
+        Context manager to handle `SyringeError` based on error code. Error
+        codes 7, 9, and 10 are recovered from (see `_planRecovery`) and
+        the rest are re-raised. Yields a dict that receives the response
+        `data` of the command that completed the recovery, if any.
 
         """
+        result = {}
         try:
-            yield
+            yield result
         except SyringeError as e:
             self.logDebug('ErrorHandler: caught error code {}'.format(
                           e.err_code))
-            if e.err_code in [7, 9, 10]:
-                last_cmd = self.last_cmd
-                self.resetChain()
-                try:
-                    self.logDebug('ErrorHandler: attempting re-init')
-                    self.init()
-                except SyringeError as e:
-                    self.logDebug('ErrorHandler: Error during re-init '
-                                  '[{}]'.format(e.err_code))
-                    if e.err_code in [7, 9, 10]:
-                        pass
-                    else:
-                        raise e
-                self._waitReady()
-                self.logDebug('ErrorHandler: resending last command {} '
-                              ''.format(last_cmd))
-                self.sendRcv(last_cmd)
+            if e.err_code in self.__class__.RECOVERABLE_ERRORS and \
+                    not self._recovering:
+                result['data'] = self._recover(e.err_code, self.last_cmd)
             else:
-                self.logDebug('ErrorHandler: error not in [7, 9, 10], '
-                              're-raising [{}]'.format(e.err_code))
+                self.logDebug('ErrorHandler: not recovering from error '
+                              '[{}]'.format(e.err_code))
                 self.resetChain()
                 raise e
         except Exception as e:
             self.resetChain()
             raise e
 
+    def checkReady(self):
+        """
+        Non-blocking counterpart of `waitReady`: polls the pump once and
+        returns whether it is ready. Errors are handled (and recovered
+        from) as in `waitReady`; after a recovery the pump is reported as
+        not ready, so the caller polls again.
+
+        """
+        ready = False
+        with self._syringeErrorHandler():
+            ready = self._checkReady()
+        return ready
+
     def waitReady(self, timeout=10, polling_interval=0.3, delay=None):
         """
         Waits a maximum of `timeout` seconds for the syringe to be
@@ -767,7 +1656,8 @@ class XCaliburD(Syringe):
         seconds prior to beginning polling.
 
         """
-        self.logCall('waitReady', locals())
+        if self.debug:
+            self.logCall('waitReady', locals())
         with self._syringeErrorHandler():
             self._waitReady(timeout=timeout, polling_interval=polling_interval,
                             delay=delay)
@@ -787,84 +1677,76 @@ class XCaliburD(Syringe):
             `parsed_reponse` (tuple) : parsed pump response tuple
 
         """
-        self.logCall('sendRcv', locals())
+        if self.debug:
+            self.logCall('sendRcv', locals())
 
         if execute:
             cmd_string += 'R'
         self.last_cmd = cmd_string
-        self.logDebug('sendRcv: sending cmd_string: {}'.format(cmd_string))
-        with self._syringeErrorHandler():
+        if self.debug:
+            self.logDebug('sendRcv: sending cmd_string: {}'.format(
+                          cmd_string))
+        with self._syringeErrorHandler() as recovery:
             parsed_response = super(XCaliburD, self)._sendRcv(cmd_string)
-            self.logDebug('sendRcv: received response: {}'.format(
-                          parsed_response))
+            if self.debug:
+                self.logDebug('sendRcv: received response: {}'.format(
+                              parsed_response))
             data = parsed_response[0]
             return data
+        return recovery.get('data')
 
     def _calcPlungerMoveTime(self, move_steps):
         """
-        Calculates plunger move time using equations provided by Tecan.
-        Assumes that all input values have been validated
+        Calculates plunger move time using equations provided by Tecan
+        (see `motion.plungerMoveTime`) and the simulated speed settings,
+        corrected by the device timing calibration. Assumes that all input
+        values have been validated
 
         """
         sd = self.sim_state
-        start_speed = sd['start_speed']
-        top_speed = sd['top_speed']
-        cutoff_speed = sd['cutoff_speed']
-        slope = sd['slope']
-        microstep = sd['microstep']
+        model_t = plungerMoveTime(move_steps, sd['start_speed'],
+                                  sd['top_speed'], sd['cutoff_speed'],
+                                  sd['slope'], sd['microstep'])
+        return self.calibration.plungerTime(model_t)
 
-        slope *= 2500.0
-        if microstep:
-            move_steps = move_steps / 8.0
-        theo_top_speed = sqrt((4.0 * move_steps*slope) + start_speed ** 2.0)
-        # If theoretical top speed will not exceed cutoff speed
-        if theo_top_speed < cutoff_speed:
-            move_t = theo_top_speed - (start_speed/slope)
-        else:
-            theo_top_speed = sqrt(((2.0*move_steps*slope) +
-                                  ((start_speed**2.0+cutoff_speed**2.0)/2.0)))
-        # If theoretical top speed with exceed cutoff speed but not
-        # reach the set top speed
-        if cutoff_speed < theo_top_speed < top_speed:
-            move_t = ((1 / slope) * (2.0 * theo_top_speed - start_speed -
-                                     cutoff_speed))
-        # If start speed, top speed, and cutoff speed are all the same
-        elif start_speed == top_speed == cutoff_speed:
-            move_t = (2.0 * move_steps) / top_speed
-        # Otherwise, calculate time spent in each phase (start, constant,
-        # ramp down)
-        else:
-            ramp_up_halfsteps = ((top_speed ** 2.0 - start_speed ** 2.0) /
-                                (2.0 * slope))
-            ramp_down_halfsteps = ((top_speed ** 2.0 - cutoff_speed ** 2.0) /
-                                  (2.0 * slope))
-            if (ramp_up_halfsteps + ramp_down_halfsteps) < (2.0 * top_speed):
-                ramp_up_t = (top_speed - start_speed) / slope
-                ramp_down_t = (top_speed - cutoff_speed) / slope
-                constant_halfsteps = (2.0 * move_steps - ramp_up_halfsteps -
-                                      ramp_down_halfsteps)
-                constant_t = constant_halfsteps / top_speed
-                move_t = ramp_up_t + ramp_down_t + constant_t
-        return move_t
-
-    def _ulToSteps(self, volume_ul, microstep=None):
-        """
-        Converts a volume in microliters (ul) to encoder steps.
+    def _ulToSteps(self, volume_ul, microstep=None, residual_key=None):
+        """
+        Converts a volume in microliters (ul) to a whole number of encoder
+        steps. If `residual_key` is provided, the rounding error is carried
+        over to the next conversion with the same key, so the total over a
+        sequence of conversions stays within half a step of the exact total.
 
         Args:
             `volume_ul` (int) : volume in microliters
         Kwargs:
             `microstep` (bool) : whether to convert to standard steps or
                                  microsteps
+            `residual_key` (str) : key of the rounding error accumulator
 
         """
         if microstep is None:
             microstep = self.state['microstep']
         if microstep:
-            steps = volume_ul * (24000/self.syringe_ul)
+            steps = volume_ul * (24000.0/self.syringe_ul)
         else:
-            steps = volume_ul * (3000/self.syringe_ul)
-        return steps
+            steps = volume_ul * (3000.0/self.syringe_ul)
+        if residual_key is None:
+            return int(round(steps))
+        steps += self._step_residuals.get(residual_key, 0.0)
+        whole_steps = int(round(steps))
+        self._step_residuals[residual_key] = steps - whole_steps
+        return whole_steps
+
+    def ulToStepsBatch(self, volumes_ul):
+        """
+        Converts an array of transfer volumes to integer steps at the
+        simulated step resolution, diffusing rounding errors across the
+        batch (see `motion.allocateSteps`). Returns a tuple of the steps
+        array and the per-transfer rounding errors in microliters.
+
+        """
+        return allocateSteps(volumes_ul, self.syringe_ul,
+                             self.sim_state['microstep'])
 
     def _simIncToPulses(self, speed_inc):
         """
@@ -873,7 +1755,14 @@ class XCaliburD(Syringe):
         be higher than top speed, so it is automatically adjusted on the pump)
 
         """
-        top_speed = self.__class__.SPEED_CODES[speed_inc]
+        self._simTopSpeed(self.__class__.SPEED_CODES[speed_inc])
+
+    def _simTopSpeed(self, top_speed):
+        """
+        Updates the simulation top speed, capping the start and cutoff
+        speeds at the new top speed (as the XCalibur does)
+
+        """
         self.sim_state['top_speed'] = top_speed
         if self.sim_state['start_speed'] > top_speed:
             self.sim_state['start_speed'] = top_speed
@@ -0,0 +1,316 @@
+"""
+motion.py
+
+Contains the XCalibur plunger motion-time model (based on the equations
+provided by Tecan) and distribution valve geometry helpers. Speeds are in
+pulses (half-steps) per second and the slope is given as the XCalibur
+slope code. A move follows one of three velocity profiles:
+
+ramp        : the plunger accelerates from the start speed and stops before
+              reaching the cutoff speed
+triangle    : the plunger accelerates past the cutoff speed and ramps down
+              to the cutoff speed without reaching the top speed
+trapezoid   : the plunger ramps up to the top speed, travels at constant
+              speed, and ramps down to the cutoff speed
+
+`plungerMoveTimes` evaluates the model over NumPy arrays (NumPy is an
+optional dependency that is only needed for the vectorized functions).
+
+"""
+from bisect import bisect_right
+from math import sqrt
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# Acceleration in pulses/sec^2 per slope code increment
+SLOPE_UNIT = 2500.0
+
+# Pulses (half-steps) per full plunger stroke. Speeds are set in the same
+# units in standard and microstep mode, so flow rates only depend on the
+# syringe size.
+PULSES_PER_STROKE = 6000.0
+
+# Top speeds in pulses/sec by speed code
+SPEED_CODES = {0: 6000, 1: 5600, 2: 5000, 3: 4400, 4: 3800, 5: 3200,
+               6: 2600, 7: 2200, 8: 2000, 9: 1800, 10: 1600, 11: 1400,
+               12: 1200, 13: 1000, 14: 800, 15: 600, 16: 400, 17: 200,
+               18: 190, 19: 180, 20: 170, 21: 160, 22: 150, 23: 140,
+               24: 130, 25: 120, 26: 110, 27: 100, 28: 90, 29: 80,
+               30: 70, 31: 60, 32: 50, 33: 40, 34: 30, 35: 20, 36: 18,
+               37: 16, 38: 14, 39: 12, 40: 10}
+
+# Speed setting ranges in pulses/sec and slope code range
+TOP_SPEED_RANGE = (5, 6000)
+START_SPEED_RANGE = (50, 1000)
+CUTOFF_SPEED_RANGE = (50, 2700)
+SLOPE_RANGE = (1, 20)
+
+# Standard XCalibur syringe sizes in microliters
+SYRINGE_SIZES = (25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+def plungerMoveTime(move_steps, start_speed, top_speed, cutoff_speed, slope,
+                    microstep=False):
+    """
+    Returns the estimated time in seconds for a plunger move of
+    `move_steps` steps. Assumes that all input values have been validated.
+
+    Args:
+        `move_steps` (int) : absolute number of steps to move
+        `start_speed` (int) : start speed in pulses/sec
+        `top_speed` (int) : top speed in pulses/sec
+        `cutoff_speed` (int) : cutoff speed in pulses/sec
+        `slope` (int) : slope code (1-20)
+    Kwargs:
+        `microstep` (bool) : whether `move_steps` is given in microsteps
+            [default] - False
+
+    """
+    slope *= SLOPE_UNIT
+    if microstep:
+        move_steps = move_steps / 8.0
+    ramp_peak = sqrt((4.0 * move_steps * slope) + start_speed ** 2.0)
+    # Theoretical top speed will not exceed the cutoff speed
+    if ramp_peak < cutoff_speed:
+        return (ramp_peak - start_speed) / slope
+    tri_peak = sqrt(((2.0 * move_steps * slope) +
+                     ((start_speed ** 2.0 + cutoff_speed ** 2.0) / 2.0)))
+    # Theoretical top speed will exceed the cutoff speed but not reach the
+    # set top speed
+    if tri_peak < top_speed:
+        return (2.0 * tri_peak - start_speed - cutoff_speed) / slope
+    # Otherwise, calculate time spent in each phase (ramp up, constant,
+    # ramp down)
+    ramp_up_halfsteps = (top_speed ** 2.0 - start_speed ** 2.0) / (2.0 * slope)
+    ramp_down_halfsteps = ((top_speed ** 2.0 - cutoff_speed ** 2.0) /
+                           (2.0 * slope))
+    ramp_up_t = (top_speed - start_speed) / slope
+    ramp_down_t = (top_speed - cutoff_speed) / slope
+    constant_halfsteps = (2.0 * move_steps - ramp_up_halfsteps -
+                          ramp_down_halfsteps)
+    constant_t = constant_halfsteps / top_speed
+    return ramp_up_t + ramp_down_t + constant_t
+
+
+def plungerMoveTimes(move_steps, start_speed, top_speed, cutoff_speed, slope,
+                     microstep=False):
+    """
+    Vectorized version of `plungerMoveTime`. All arguments may be scalars
+    or NumPy arrays (broadcast against each other), so a single call can
+    estimate many moves under many different speed settings.
+
+    Returns:
+        `move_t` (ndarray) : estimated move times in seconds
+
+    """
+    if np is None:
+        raise ImportError('`plungerMoveTimes` requires NumPy')
+    move_steps = np.asarray(move_steps, dtype=float)
+    start_speed = np.asarray(start_speed, dtype=float)
+    top_speed = np.asarray(top_speed, dtype=float)
+    cutoff_speed = np.asarray(cutoff_speed, dtype=float)
+    slope = np.asarray(slope, dtype=float) * SLOPE_UNIT
+    move_steps = np.where(microstep, move_steps / 8.0, move_steps)
+
+    ramp_peak = np.sqrt(4.0 * move_steps * slope + start_speed ** 2.0)
+    tri_peak = np.sqrt(2.0 * move_steps * slope +
+                       (start_speed ** 2.0 + cutoff_speed ** 2.0) / 2.0)
+    ramp_t = (ramp_peak - start_speed) / slope
+    tri_t = (2.0 * tri_peak - start_speed - cutoff_speed) / slope
+    ramp_up_halfsteps = (top_speed ** 2.0 - start_speed ** 2.0) / (2.0 * slope)
+    ramp_down_halfsteps = ((top_speed ** 2.0 - cutoff_speed ** 2.0) /
+                           (2.0 * slope))
+    trap_t = ((top_speed - start_speed) / slope +
+              (top_speed - cutoff_speed) / slope +
+              (2.0 * move_steps - ramp_up_halfsteps - ramp_down_halfsteps) /
+              top_speed)
+    return np.where(ramp_peak < cutoff_speed, ramp_t,
+                    np.where(tri_peak < top_speed, tri_t, trap_t))
+
+
+def allocateSteps(volumes_ul, syringe_ul, microstep=False):
+    """
+    Converts an array of volumes to whole plunger steps with error
+    diffusion: each transfer is rounded so that the cumulative number of
+    steps tracks the exact cumulative volume, keeping the cumulative
+    delivered volume within half a step of the target (rather than
+    accumulating per-transfer truncation errors).
+
+    Args:
+        `volumes_ul` (array_like) : transfer volumes in microliters (may be
+                                    negative for dispenses)
+        `syringe_ul` (int) : syringe volume in microliters
+    Kwargs:
+        `microstep` (bool) : allocate microsteps instead of standard steps
+
+    Returns:
+        `steps` (ndarray) : integer steps per transfer
+        `errors_ul` (ndarray) : per-transfer rounding error in microliters
+                                (delivered minus requested)
+
+    """
+    if np is None:
+        raise ImportError('`allocateSteps` requires NumPy')
+    volumes_ul = np.asarray(volumes_ul, dtype=float)
+    steps_per_ul = (24000 if microstep else 3000) / float(syringe_ul)
+    cum_steps = np.rint(np.cumsum(volumes_ul * steps_per_ul)).astype(int)
+    steps = np.diff(np.concatenate(([0], cum_steps)))
+    errors_ul = steps / steps_per_ul - volumes_ul
+    return steps, errors_ul
+
+
+def valveTravel(from_port, to_port, num_ports, direction=None):
+    """
+    Returns the `(direction, port_steps)` of a valve move from `from_port`
+    to `to_port` on a valve with `num_ports` evenly spaced ports, where
+    'CW' moves towards higher port numbers. If `direction` is not provided,
+    the shorter direction is chosen (ties go 'CW').
+
+    """
+    cw_steps = (to_port - from_port) % num_ports
+    ccw_steps = (from_port - to_port) % num_ports
+    if direction is None:
+        direction = 'CW' if cw_steps <= ccw_steps else 'CCW'
+    return direction, cw_steps if direction == 'CW' else ccw_steps
+
+
+def orderByValveTravel(items, from_port, num_ports, key=None):
+    """
+    Reorders `items` (operations that may run in any order) to minimize
+    the total valve travel when visiting their ports starting from
+    `from_port`. Items on the same port are kept together and in their
+    original relative order.
+
+    On a circular valve the optimal route either sweeps in one direction
+    or sweeps one way, turns around once, and sweeps the other way, so all
+    such routes are compared directly.
+
+    Kwargs:
+        `key` (callable) : returns the port of an item
+            [default] - items are ports
+
+    """
+    key = key if key is not None else (lambda item: item)
+    groups = {}
+    for item in items:
+        groups.setdefault(key(item), []).append(item)
+    dist = {port: (port - from_port) % num_ports for port in groups}
+    ports = sorted((port for port in groups if dist[port] != 0),
+                   key=lambda port: dist[port])
+    routes = []
+    if ports:
+        routes.append((dist[ports[-1]], ports))
+        routes.append((num_ports - dist[ports[0]], ports[::-1]))
+        for idx in range(1, len(ports)):
+            near, far = dist[ports[idx - 1]], dist[ports[idx]]
+            routes.append((2 * near + num_ports - far,
+                           ports[:idx] + ports[:idx - 1:-1]))
+            routes.append((2 * (num_ports - far) + near,
+                           ports[:idx - 1:-1] + ports[:idx]))
+    order = [port for port in groups if dist[port] == 0]
+    if routes:
+        order += min(routes, key=lambda route: route[0])[1]
+    return [item for port in order for item in groups[port]]
+
+
+def _speedTable(syringe_ul):
+    """
+    Returns the inverse speed code lookup for `syringe_ul`: a tuple of
+    ascending flow rates (uL/s) and the matching speed codes.
+
+    """
+    if syringe_ul not in _SPEED_TABLES:
+        pairs = sorted((pulses * syringe_ul / PULSES_PER_STROKE, code)
+                       for code, pulses in SPEED_CODES.items())
+        _SPEED_TABLES[syringe_ul] = ([flow for flow, _ in pairs],
+                                     [code for _, code in pairs])
+    return _SPEED_TABLES[syringe_ul]
+
+
+_SPEED_TABLES = {}
+for _syringe_ul in SYRINGE_SIZES:
+    _speedTable(_syringe_ul)
+
+
+def planSpeeds(volume_ul, max_flow_ul_s, syringe_ul, microstep=False,
+               max_accel_ul_s2=None, use_speed_code=False):
+    """
+    Chooses the speed settings and slope that minimize the time of a
+    plunger move of `volume_ul` without exceeding `max_flow_ul_s` or (if
+    provided) `max_accel_ul_s2`. Move time decreases monotonically with
+    every speed setting and the slope, so the fastest settings within the
+    limits are optimal.
+
+    Since the start and cutoff speeds are applied as step changes, they
+    are set to their minimum when an acceleration limit is given.
+
+    Args:
+        `volume_ul` (float) : volume to move in microliters
+        `max_flow_ul_s` (float) : maximum flow rate in uL/s
+        `syringe_ul` (int) : syringe volume in microliters
+    Kwargs:
+        `microstep` (bool) : whether the pump is in microstep mode
+        `max_accel_ul_s2` (float) : maximum acceleration in uL/s^2
+        `use_speed_code` (bool) : restrict the top speed to speed codes
+                                  (otherwise any pulse rate is used)
+
+    Returns:
+        `plan` (dict) : `top_speed`, `speed_code` (or None), `start_speed`,
+                        `cutoff_speed`, `slope`, `flow_ul_s` (achieved top
+                        flow rate), `steps`, and `move_time`
+
+    """
+    ul_per_pulse = float(syringe_ul) / PULSES_PER_STROKE
+    speed_code = None
+    if use_speed_code:
+        flows, codes = _speedTable(syringe_ul)
+        idx = bisect_right(flows, max_flow_ul_s)
+        if idx == 0:
+            raise ValueError('`max_flow_ul_s` [{0}] is below the slowest '
+                             'speed code [{1} uL/s]'.format(max_flow_ul_s,
+                                                            flows[0]))
+        speed_code = codes[idx - 1]
+        top_speed = SPEED_CODES[speed_code]
+    else:
+        top_speed = min(int(max_flow_ul_s / ul_per_pulse),
+                        TOP_SPEED_RANGE[1])
+        if top_speed < TOP_SPEED_RANGE[0]:
+            raise ValueError('`max_flow_ul_s` [{0}] is below the minimum top '
+                             'speed [{1} uL/s]'.format(
+                             max_flow_ul_s, TOP_SPEED_RANGE[0] * ul_per_pulse))
+
+    if max_accel_ul_s2 is None:
+        slope = SLOPE_RANGE[1]
+        start_speed = min(START_SPEED_RANGE[1], top_speed)
+        cutoff_speed = min(CUTOFF_SPEED_RANGE[1], top_speed)
+    else:
+        slope = min(int(max_accel_ul_s2 / (SLOPE_UNIT * ul_per_pulse)),
+                    SLOPE_RANGE[1])
+        if slope < SLOPE_RANGE[0]:
+            raise ValueError('`max_accel_ul_s2` [{0}] is below the minimum '
+                             'slope [{1} uL/s^2]'.format(
+                             max_accel_ul_s2, SLOPE_UNIT * ul_per_pulse))
+        start_speed = START_SPEED_RANGE[0]
+        cutoff_speed = CUTOFF_SPEED_RANGE[0]
+    start_speed = max(start_speed, START_SPEED_RANGE[0])
+    cutoff_speed = max(cutoff_speed, CUTOFF_SPEED_RANGE[0])
+
+    steps = int(round(volume_ul * (24000 if microstep else 3000) /
+                      float(syringe_ul)))
+    # The pump caps the start and cutoff speeds at the top speed
+    move_time = plungerMoveTime(steps, min(start_speed, top_speed), top_speed,
+                                min(cutoff_speed, top_speed), slope, microstep)
+    return {
+        'top_speed': top_speed,
+        'speed_code': speed_code,
+        'start_speed': start_speed,
+        'cutoff_speed': cutoff_speed,
+        'slope': slope,
+        'flow_ul_s': top_speed * ul_per_pulse,
+        'steps': steps,
+        'move_time': move_time
+    }
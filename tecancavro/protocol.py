@@ -0,0 +1,407 @@
+"""
+protocol.py
+
+Declarative pump protocols. A protocol is a JSON (or YAML) document that
+describes the pumps, their configuration and starting state, and a list
+of steps. Protocols are compiled ahead of time (without any hardware) into
+validated, buffer-sized chain segments with execution time estimates, and
+compiled protocols are cached by a hash of their content so that rerunning
+a protocol skips all planning and validation.
+
+Example (JSON):
+
+    {
+        "pumps": {
+            "a": {"num_ports": 9, "syringe_ul": 1000, "waste_port": 9},
+            "b": {"num_ports": 9, "syringe_ul": 500,
+                  "state": {"plunger_pos": 0, "port": 1}}
+        },
+        "steps": [
+            {"pump": "a", "op": "speed", "code": 12},
+            {"pump": "b", "op": "flow_rate", "max_flow_ul_s": 100},
+            {"op": "loop", "count": 3, "steps": [
+                {"pump": "a", "op": "extract", "port": 1, "volume_ul": 250},
+                {"pump": "a", "op": "dispense", "port": 2, "volume_ul": 250}
+            ]},
+            {"op": "sync"},
+            {"pump": "b", "op": "dispense_many", "source_port": 3,
+             "aliquots": [[4, 50], [5, 50]]}
+        ]
+    }
+
+Pump steps (`op`):
+
+extract         : `port`, `volume_ul`
+dispense        : `port`, `volume_ul`
+port            : `port`
+move            : `position` (absolute plunger position)
+speed           : `code` (speed code)
+flow_rate       : `max_flow_ul_s`, optional `max_accel_ul_s2`
+delay           : `ms`
+waste           : dispense the syringe contents to the waste port
+dispense_many   : `source_port`, `aliquots` ([port, volume_ul] pairs) and
+                  optional `pre_waste_ul`, `post_waste_ul`, `waste_port`,
+                  `preserve_order` (see `XCaliburD.dispenseMany`)
+
+Control steps:
+
+loop            : repeats `steps` `count` times (the steps may address
+                  several pumps)
+sync            : all pumps finish their preceding steps before any pump
+                  continues
+
+A pump's `state` defaults to the state after initialization (plunger at
+0, valve at the waste port, factory default speeds). Compiled protocols
+are run with `runProtocol` (or queued on a `jobs.JobQueue` with
+`submitProtocol`), which checks that each pump is in the state the
+protocol was compiled against. `bindPumps` fills in the configuration and
+current state of connected pumps.
+
+"""
+import hashlib
+import os
+
+try:
+    import simplejson as json
+except:
+    import json
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+from .calibration import TimingCalibration
+from .chain import CMD_BUFFER_LEN, chainTime, compressLoops, segmentChain
+from .models import XCaliburD
+from .scheduler import ProtocolScheduler, PumpOp
+
+
+# Bump when the compiled format or compilation changes to invalidate caches
+COMPILER_VERSION = 2
+
+# Pump state after initialization with factory default speeds
+DEFAULT_STATE = {
+    'plunger_pos': 0,
+    'start_speed': 900,
+    'top_speed': 1400,
+    'cutoff_speed': 900,
+    'slope': 14
+}
+
+PUMP_DEFAULTS = {
+    'num_ports': 9,
+    'syringe_ul': 1000,
+    'microstep': False,
+    'waste_port': 9,
+    'direction': 'CW',
+    'calibration_path': None
+}
+
+_OPS = {
+    'extract': lambda pump, step: pump.extract(step['port'],
+                                               step['volume_ul']),
+    'dispense': lambda pump, step: pump.dispense(step['port'],
+                                                 step['volume_ul']),
+    'port': lambda pump, step: pump.changePort(step['port']),
+    'move': lambda pump, step: pump.movePlungerAbs(step['position']),
+    'speed': lambda pump, step: pump.setSpeed(step['code']),
+    'flow_rate': lambda pump, step: pump.setFlowRate(
+        step['max_flow_ul_s'], step.get('max_accel_ul_s2')),
+    'delay': lambda pump, step: pump.delayExec(step['ms']),
+    'waste': lambda pump, step: pump.dispenseToWaste(retain_port=False),
+    'dispense_many': lambda pump, step: pump.dispenseMany(
+        [tuple(aliquot) for aliquot in step['aliquots']],
+        step['source_port'],
+        pre_waste_ul=step.get('pre_waste_ul', 0),
+        post_waste_ul=step.get('post_waste_ul', 0),
+        waste_port=step.get('waste_port'),
+        preserve_order=step.get('preserve_order', False),
+        execute=False)
+}
+
+
+def loadProtocol(path):
+    """
+    Loads a protocol document from a JSON or YAML (.yaml / .yml) file.
+    YAML requires PyYAML.
+
+    """
+    with open(path) as fd:
+        if os.path.splitext(path)[1].lower() in ('.yaml', '.yml'):
+            if yaml is None:
+                raise ImportError('PyYAML is required to load YAML protocols')
+            return yaml.safe_load(fd)
+        return json.load(fd)
+
+
+def protocolHash(doc):
+    """
+    Returns the content hash of a protocol document. Includes the compiler
+    version and the timing calibrations the protocol refers to, since both
+    change the compiled output.
+
+    """
+    calibrations = {}
+    for name, config in doc.get('pumps', {}).items():
+        path = config.get('calibration_path')
+        if path is not None:
+            calibrations[name] = TimingCalibration.load(path).toDict()
+    content = json.dumps([COMPILER_VERSION, doc, calibrations],
+                         sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def _pumpConfig(name, config):
+    unknown = set(config) - set(PUMP_DEFAULTS) - set(['state'])
+    if unknown:
+        raise ValueError('Pump `{0}` has unknown settings: {1}'.format(
+                         name, ', '.join(sorted(unknown))))
+    pump_config = dict(PUMP_DEFAULTS)
+    pump_config.update(config)
+    state = dict(DEFAULT_STATE)
+    state['port'] = pump_config['waste_port']
+    state['microstep'] = pump_config['microstep']
+    state.update(config.get('state', {}))
+    pump_config['state'] = state
+    return pump_config
+
+
+def bindPumps(doc, pumps):
+    """
+    Returns a copy of a protocol document with the configuration and
+    current state of `pumps` (`XCaliburD` instances keyed by protocol pump
+    name) filled in wherever the document does not specify them, so that
+    the protocol compiles against the pumps as they are.
+
+    """
+    doc = dict(doc)
+    doc['pumps'] = {name: dict(config)
+                    for name, config in doc.get('pumps', {}).items()}
+    for name, pump in pumps.items():
+        config = doc['pumps'].setdefault(name, {})
+        for key in ('num_ports', 'syringe_ul', 'waste_port', 'direction'):
+            config.setdefault(key, getattr(pump, key))
+        config.setdefault('microstep', pump.state['microstep'])
+        state = dict(config.get('state', {}))
+        for key, value in pump.state.items():
+            if value is not None:
+                state.setdefault(key, value)
+        config['state'] = state
+    return doc
+
+
+def _flattenSteps(steps, path=''):
+    """
+    Expands loops and yields `(path, step)` for each pump step, and
+    `(path, None)` for each sync point
+
+    """
+    for idx, step in enumerate(steps):
+        step_path = '{0}{1}'.format(path, idx)
+        op = step.get('op')
+        if op == 'loop':
+            if not 0 < step.get('count', 0) < 30000:
+                raise ValueError('Step {0}: loop `count` must be between 1 '
+                                 'and 29999'.format(step_path))
+            for _ in range(step['count']):
+                for item in _flattenSteps(step.get('steps', []),
+                                          step_path + '.'):
+                    yield item
+        elif op == 'sync':
+            yield step_path, None
+        else:
+            yield step_path, step
+
+
+def _compilePhase(pump):
+    """
+    Segments and validates the pump's pending chain, and advances the
+    pump's state to the end of the chain. Returns the compiled phase entry.
+
+    """
+    start_state = dict(pump.state)
+    speed_change = pump.sim_speed_change
+    if len(pump.cmd_chain) >= CMD_BUFFER_LEN:
+        pump.compressChain()
+    segments = segmentChain(pump.chain_steps, CMD_BUFFER_LEN - 1)
+    pump.validateChain(segments)
+    end_state = dict(pump.sim_state)
+    pump.resetChain(on_execute=True, minimal_reset=True)
+    return {
+        'segments': [[list(step) for step in segment]
+                     for segment in segments],
+        'exec_time': sum(chainTime(segment) for segment in segments),
+        'start_state': start_state,
+        'end_state': end_state,
+        'speed_change': speed_change
+    }
+
+
+def compileProtocol(doc, cache_dir=None):
+    """
+    Compiles a protocol document into per-pump, per-phase chain segments.
+    Each phase ends at a sync point; within a phase the pumps run
+    independently. Every chain is validated against the simulated pump
+    state (see `chain.validateChain`), so invalid protocols fail here
+    rather than on the hardware.
+
+    Args:
+        `doc` (dict) : protocol document (see `loadProtocol`)
+    Kwargs:
+        `cache_dir` (str) : directory of compiled protocols keyed by
+                            content hash. If the protocol has been compiled
+                            before, it is loaded from the cache instead.
+            [default] - None (no caching)
+
+    Returns:
+        `compiled` (dict) : `hash`, `pumps` (pump configurations), `phases`
+                            (list of {pump name: compiled chain}), and
+                            `exec_time` (estimated protocol duration in
+                            seconds)
+
+    """
+    key = protocolHash(doc)
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, key + '.json')
+        if os.path.exists(cache_path):
+            with open(cache_path) as fd:
+                return json.load(fd)
+
+    configs = {}
+    pumps = {}
+    for name, config in doc.get('pumps', {}).items():
+        configs[name] = _pumpConfig(name, config)
+        config = configs[name]
+        pumps[name] = XCaliburD(None, num_ports=config['num_ports'],
+                                syringe_ul=config['syringe_ul'],
+                                direction=config['direction'],
+                                microstep=config['microstep'],
+                                waste_port=config['waste_port'],
+                                calibration_path=config['calibration_path'],
+                                state=config['state'])
+
+    phases = []
+    for path, step in _flattenSteps(doc.get('steps', [])):
+        if step is not None:
+            if step.get('pump') not in pumps:
+                raise ValueError('Step {0}: unknown pump `{1}`'.format(
+                                 path, step.get('pump')))
+            if step.get('op') not in _OPS:
+                raise ValueError('Step {0}: unknown op `{1}`'.format(
+                                 path, step.get('op')))
+            try:
+                _OPS[step['op']](pumps[step['pump']], step)
+            except KeyError as e:
+                raise ValueError('Step {0}: missing `{1}`'.format(
+                                 path, e.args[0]))
+            except ValueError as e:
+                raise ValueError('Step {0}: {1}'.format(path, e))
+            continue
+        phase = {}
+        for name, pump in pumps.items():
+            if pump.chain_steps:
+                try:
+                    phase[name] = _compilePhase(pump)
+                except ValueError as e:
+                    raise ValueError('Pump `{0}` before sync step {1}: {2}'
+                                     ''.format(name, path, e))
+        if phase:
+            phases.append(phase)
+    phase = {}
+    for name, pump in pumps.items():
+        if pump.chain_steps:
+            try:
+                phase[name] = _compilePhase(pump)
+            except ValueError as e:
+                raise ValueError('Pump `{0}` at the end of the protocol: {1}'
+                                 ''.format(name, e))
+    if phase:
+        phases.append(phase)
+
+    compiled = {
+        'version': COMPILER_VERSION,
+        'hash': key,
+        'pumps': configs,
+        'phases': phases,
+        'exec_time': sum(max(entry['exec_time'] for entry in phase.values())
+                         for phase in phases)
+    }
+    if cache_dir is not None:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_path = cache_path + '.tmp'
+        with open(tmp_path, 'w') as fd:
+            json.dump(compiled, fd)
+        os.rename(tmp_path, cache_path)
+    return compiled
+
+
+def _loader(entry):
+    def build(pump):
+        pump.loadChain(entry['segments'], entry['end_state'],
+                       start_state=entry['start_state'],
+                       speed_change=entry['speed_change'])
+    return build
+
+
+def protocolOps(compiled, pumps):
+    """
+    Returns the `PumpOp`s for a compiled protocol, one per pump and phase.
+    Each phase depends on every operation of the previous phase.
+
+    Args:
+        `compiled` (dict) : compiled protocol (see `compileProtocol`)
+        `pumps` (dict) : `XCaliburD` instances keyed by protocol pump name
+
+    """
+    missing = set(compiled['pumps']) - set(pumps)
+    if missing:
+        raise ValueError('No pump provided for: {0}'.format(
+                         ', '.join(sorted(missing))))
+    ops = []
+    prev_names = []
+    for idx, phase in enumerate(compiled['phases']):
+        names = []
+        for name, entry in sorted(phase.items()):
+            op_name = '{0}:{1}'.format(idx, name)
+            ops.append(PumpOp(op_name, pumps[name], _loader(entry),
+                              deps=prev_names,
+                              duration=entry['exec_time']))
+            names.append(op_name)
+        prev_names = names
+    return ops
+
+
+def runProtocol(compiled, pumps, polling_interval=0.05):
+    """
+    Runs a compiled protocol on `pumps` (`XCaliburD` instances keyed by
+    protocol pump name) and blocks until it is complete. Returns the
+    scheduler report (see `ProtocolScheduler.run`).
+
+    """
+    scheduler = ProtocolScheduler(protocolOps(compiled, pumps),
+                                  polling_interval=polling_interval)
+    return scheduler.run()
+
+
+def submitProtocol(compiled, job_queue, pump_keys=None, description=None):
+    """
+    Queues a compiled protocol on a `jobs.JobQueue` (see
+    `JobQueue.submitPhases`) and returns the group job id immediately.
+
+    Kwargs:
+        `pump_keys` (dict) : job queue pump keys by protocol pump name
+            [default] - protocol pump names are the job queue keys
+        `description` (str) : job description
+            [default] - 'protocol <hash prefix>'
+
+    """
+    pump_keys = pump_keys or {}
+    phases = [{pump_keys.get(name, name): _loader(entry)
+               for name, entry in phase.items()}
+              for phase in compiled['phases']]
+    if description is None:
+        description = 'protocol {0}'.format(compiled['hash'][:12])
+    return job_queue.submitPhases(phases, exec_time=compiled['exec_time'],
+                                  description=description)
@@ -0,0 +1,297 @@
+"""
+scheduler.py
+
+Contains the `PumpOp` and `ProtocolScheduler` classes, which coordinate
+command chains across several pumps (e.g. `XCaliburD` instances). A
+protocol is a DAG of pump operations with dependencies and shared-resource
+constraints (e.g. a shared waste line). The scheduler plans a critical-path
+list schedule from the chain execution time estimates and then dispatches
+each operation as soon as its dependencies have completed and its pump and
+resources are free, polling the pumps and sending the segments of long
+chains from a single loop.
+
+"""
+import time
+
+try:
+    from gevent import monkey; monkey.patch_all(thread=False)
+    from gevent import sleep
+except:
+    from time import sleep
+
+from .syringe import SyringeTimeout
+
+
+class PumpOp(object):
+    """
+    A single pump operation in a protocol DAG.
+
+    Args:
+        `name` (str) : unique operation name
+        `pump` (Object) : pump to run the operation on (e.g. `XCaliburD`)
+        `build` (callable) : called as `build(pump)` to add the operation's
+                             commands to the pump's command chain
+    Kwargs:
+        `deps` (iterable) : names of operations that must complete first
+        `resources` (iterable) : names of shared resources (e.g. 'waste',
+                                 'bus:/dev/ttyUSB0') held while the
+                                 operation runs
+        `duration` (float) : estimated duration in seconds; estimated from
+                             the built chain if not provided
+
+    """
+
+    def __init__(self, name, pump, build, deps=(), resources=(),
+                 duration=None):
+        self.name = name
+        self.pump = pump
+        self.build = build
+        self.deps = tuple(deps)
+        self.resources = tuple(resources)
+        self.duration = duration
+
+
+class ProtocolScheduler(object):
+    """
+    Plans and runs a DAG of `PumpOp`s across several pumps.
+
+    Args:
+        `ops` (iterable) : `PumpOp` instances
+    Kwargs:
+        `polling_interval` (float) : max time in seconds between pump polls
+        `wait_timeout` (float) : extra time in seconds beyond the estimated
+                                 execution time of each chain segment to
+                                 wait for its pump
+        `clock` (callable) : returns the current time in seconds
+        `sleep` (callable) : sleeps for a number of seconds
+
+    """
+
+    def __init__(self, ops, polling_interval=0.05, wait_timeout=10,
+                 clock=time.time, sleep=sleep):
+        self.ops = {}
+        for op in ops:
+            if op.name in self.ops:
+                raise ValueError('Duplicate operation name `{0}`'.format(
+                                 op.name))
+            self.ops[op.name] = op
+        self.polling_interval = polling_interval
+        self.wait_timeout = wait_timeout
+        self.clock = clock
+        self.sleep = sleep
+        self.planned = None
+        self._checkDag()
+
+    def _checkDag(self):
+        """ Checks for unknown dependencies and cycles """
+        self.successors = {name: [] for name in self.ops}
+        for op in self.ops.values():
+            for dep in op.deps:
+                if dep not in self.ops:
+                    raise ValueError('Operation `{0}` depends on unknown '
+                                     'operation `{1}`'.format(op.name, dep))
+                self.successors[dep].append(op.name)
+        self.order = []
+        indegree = {name: len(op.deps) for name, op in self.ops.items()}
+        pending = [name for name, deg in indegree.items() if deg == 0]
+        while pending:
+            name = pending.pop()
+            self.order.append(name)
+            for succ in self.successors[name]:
+                indegree[succ] -= 1
+                if indegree[succ] == 0:
+                    pending.append(succ)
+        if len(self.order) != len(self.ops):
+            raise ValueError('Operation dependencies contain a cycle')
+
+    def _estimateDuration(self, op, state=None):
+        """
+        Builds `op` on its pump, starting from the simulated pump `state`
+        (defaults to the pump's current state), to read the chain
+        execution time estimate. Returns `(duration, end_state)`, and
+        restores the pump's chain, simulation state, and step rounding
+        residuals.
+
+        """
+        pump = op.pump
+        if pump.cmd_chain:
+            raise ValueError('Pump for operation `{0}` has a pending command '
+                             'chain'.format(op.name))
+        saved = pump.saveChain()
+        try:
+            if state is not None:
+                pump.sim_state = dict(state)
+            op.build(pump)
+            return pump.exec_time, dict(pump.sim_state)
+        finally:
+            pump.restoreChain(saved)
+
+    def _pumpPredecessors(self):
+        """
+        Returns a dict mapping each operation name to the name of the
+        last operation on the same pump that must complete before it
+        (following dependencies transitively), or `None`
+
+        """
+        position = {name: idx for idx, name in enumerate(self.order)}
+        ancestors = {}
+        predecessors = {}
+        for name in self.order:
+            op = self.ops[name]
+            ancestors[name] = set(op.deps)
+            for dep in op.deps:
+                ancestors[name].update(ancestors[dep])
+            same_pump = [other for other in ancestors[name]
+                         if self.ops[other].pump is op.pump]
+            predecessors[name] = max(same_pump, key=position.get) \
+                if same_pump else None
+        return predecessors
+
+    def _dispatchable(self, names, busy_pumps, busy_resources):
+        """
+        Returns the operations in `names` that can start given the busy
+        pumps and resources, in critical-path priority order, claiming
+        pumps and resources as they are selected.
+
+        """
+        selected = []
+        for name in sorted(names, key=lambda name: -self.rank[name]):
+            op = self.ops[name]
+            if id(op.pump) in busy_pumps or \
+               busy_resources.intersection(op.resources):
+                continue
+            busy_pumps.add(id(op.pump))
+            busy_resources.update(op.resources)
+            selected.append(name)
+        return selected
+
+    def plan(self):
+        """
+        Estimates operation durations, ranks operations by critical path
+        length (longest remaining path to the end of the protocol), and
+        simulates the list schedule. Stores planned start/end times in
+        `self.planned` and returns the planned makespan in seconds.
+
+        """
+        # Operations on the same pump start from the simulated end state of
+        # the one before them
+        predecessors = self._pumpPredecessors()
+        end_states = {}
+        for name in self.order:
+            op = self.ops[name]
+            state = end_states.get(predecessors[name])
+            duration, end_states[name] = self._estimateDuration(op, state)
+            if op.duration is None:
+                op.duration = duration
+        self.rank = {}
+        for name in reversed(self.order):
+            succ_ranks = [self.rank[succ] for succ in self.successors[name]]
+            self.rank[name] = self.ops[name].duration + max(succ_ranks + [0])
+
+        self.planned = {}
+        now = 0.0
+        running = {}
+        done = set()
+        while len(done) < len(self.ops):
+            ready = [name for name, op in self.ops.items()
+                     if name not in self.planned and
+                     all(dep in done for dep in op.deps)]
+            busy_pumps = set(id(self.ops[name].pump) for name in running)
+            busy_resources = set()
+            for name in running:
+                busy_resources.update(self.ops[name].resources)
+            for name in self._dispatchable(ready, busy_pumps,
+                                           busy_resources):
+                end = now + self.ops[name].duration
+                self.planned[name] = (now, end)
+                running[name] = end
+            now = min(running.values())
+            for name in [name for name, end in running.items()
+                         if end <= now]:
+                del running[name]
+                done.add(name)
+        return max([end for _, end in self.planned.values()] + [0])
+
+    def run(self):
+        """
+        Runs the protocol, dispatching each operation's chain as soon as
+        its dependencies are complete and its pump and resources are free.
+        Blocks until all operations are complete.
+
+        Returns:
+            `report` (dict) : `planned_makespan`, `achieved_makespan`, and
+                              per-operation `ops` timing (planned and
+                              actual start/end times relative to the
+                              start of the run)
+
+        """
+        planned_makespan = self.plan()
+        start = self.clock()
+        actual = {}
+        running = {}
+        deadlines = {}
+        streams = {}
+        done = set()
+        while len(done) < len(self.ops):
+            ready = [name for name, op in self.ops.items()
+                     if name not in actual and
+                     all(dep in done for dep in op.deps)]
+            busy_pumps = set(id(self.ops[name].pump) for name in running)
+            busy_resources = set()
+            for name in running:
+                busy_resources.update(self.ops[name].resources)
+            for name in self._dispatchable(ready, busy_pumps,
+                                           busy_resources):
+                op = self.ops[name]
+                op_start = self.clock()
+                op.build(op.pump)
+                # Long chains are sent one segment at a time from this
+                # loop, so starting them does not block the other pumps
+                streams[name] = op.pump.iterChain()
+                seg_time = next(streams[name], 0)
+                actual[name] = [op_start - start, None]
+                running[name] = self.clock() + seg_time
+                deadlines[name] = running[name] + self.wait_timeout
+
+            # Poll pumps whose segments are due to complete (errors are
+            # recovered from as in `waitReady`)
+            now = self.clock()
+            completed = False
+            for name, expected in list(running.items()):
+                if expected > now:
+                    continue
+                pump = self.ops[name].pump
+                pump._ready = False
+                if pump.checkReady():
+                    seg_time = next(streams[name], None)
+                    if seg_time is not None:
+                        running[name] = self.clock() + seg_time
+                        deadlines[name] = running[name] + self.wait_timeout
+                        continue
+                    actual[name][1] = self.clock() - start
+                    del running[name]
+                    done.add(name)
+                    completed = True
+                elif self.clock() > deadlines[name]:
+                    for stream in streams.values():
+                        stream.close()
+                    raise SyringeTimeout('Timeout while waiting for '
+                                         'operation `{0}`'.format(name))
+            if running and not completed:
+                next_due = min(running.values()) - self.clock()
+                self.sleep(next_due if next_due > 0 else
+                           self.polling_interval)
+
+        report = {
+            'planned_makespan': planned_makespan,
+            'achieved_makespan': self.clock() - start,
+            'ops': {}
+        }
+        for name in self.ops:
+            report['ops'][name] = {
+                'planned_start': self.planned[name][0],
+                'planned_end': self.planned[name][1],
+                'start': actual[name][0],
+                'end': actual[name][1]
+            }
+        return report
@@ -0,0 +1,381 @@
+"""
+simulator.py
+
+Contains the `VirtualClock` and `SimulatedLink` classes. `SimulatedLink`
+is a drop-in `com_link` for `XCaliburD` that models the XCalibur command
+buffer, state machine, move timing (see motion.py and calibration.py) and
+error codes on a virtual clock, so protocols run through the real
+`XCaliburD` code without hardware and without waiting in real time:
+
+    clock = VirtualClock()
+    pump = XCaliburD(SimulatedLink(clock=clock))
+    pump.init()
+    pump.extract(1, 500, execute=True)
+    pump.waitReady()
+    clock.time()  # virtual seconds elapsed
+
+`Syringe` picks up the link's `time` and `sleep`, so waits advance the
+virtual clock instead of blocking. Several links may share a clock (e.g.
+to schedule many virtual pumps with `scheduler.ProtocolScheduler`, using
+`clock=clock.time, sleep=clock.sleep`).
+
+"""
+from .calibration import TimingCalibration
+from .chain import CMD_BUFFER_LEN, MAX_LOOP_DEPTH, tokenizeChain
+from .motion import (CUTOFF_SPEED_RANGE, SLOPE_RANGE, SPEED_CODES,
+                     START_SPEED_RANGE, TOP_SPEED_RANGE, plungerMoveTime,
+                     valveTravel)
+
+
+class VirtualClock(object):
+    """ Clock that only advances when something sleeps on it """
+
+    def __init__(self, start=0.0):
+        self.now = float(start)
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            self.now += seconds
+
+
+class _SimError(Exception):
+    def __init__(self, code):
+        super(_SimError, self).__init__(code)
+        self.code = code
+
+
+class SimulatedLink(object):
+    """
+    Simulated XCalibur pump (with distribution valve) exposing the
+    transport `sendRcv` interface, plus the `time` and `sleep` of its
+    virtual clock.
+
+    Commands without an execute command ('R') are stored in the command
+    buffer. Executed command strings run to completion instantly in
+    simulation; the pump then reports busy until the modelled execution
+    time has passed on the virtual clock, and position queries report the
+    position after the last completed move. Commands other than queries
+    sent while the pump is busy are rejected with error 15.
+
+    Errors are reported in the status byte until the next accepted
+    command. Error 9 (plunger overload) leaves the pump uninitialized
+    (error 7 on moves) until it is re-initialized; after error 10 (valve
+    overload) only valve moves are refused until the valve is re-homed
+    ('w') or the pump is re-initialized.
+
+    Kwargs:
+        `clock` (VirtualClock) : clock to run on
+            [default] - a new clock starting at 0
+        `num_ports` (int) : number of ports on the distribution valve
+        `plunger_pos` (int) : initial plunger position
+        `port` (int) : initial valve port
+        `microstep` (bool) : initial microstep mode
+        `initialized` (bool) : whether the pump starts out initialized
+        `calibration` (TimingCalibration) : timing of the simulated pump
+            [default] - uncorrected datasheet timing
+        `latency` (float) : virtual seconds per `sendRcv` round trip
+        `init_time` (float) : virtual seconds per plunger initialization
+
+    """
+
+    FIRMWARE = b'XCALIBUR SIMULATOR'
+
+    def __init__(self, clock=None, num_ports=9, plunger_pos=0, port=1,
+                 microstep=False, initialized=True, calibration=None,
+                 latency=0.0, init_time=2.0):
+        self.clock = clock if clock is not None else VirtualClock()
+        self.num_ports = num_ports
+        self.calibration = (calibration if calibration is not None else
+                            TimingCalibration())
+        self.latency = latency
+        self.init_time = init_time
+        self.initialized = initialized
+        self.valve_initialized = initialized
+        self.state = {
+            'plunger_pos': plunger_pos,
+            'port': port,
+            'microstep': microstep,
+            'start_speed': 900,
+            'top_speed': 1400,
+            'cutoff_speed': 900,
+            'slope': 14
+        }
+        self.error = 0
+        self.busy_until = self.clock.time()
+        self.halted_pin = None
+        self.cmd_count = 0
+        self._buffer = []
+        self._events = []
+        self._reported = {'plunger_pos': plunger_pos, 'port': port}
+        self._injected = None
+
+    def time(self):
+        return self.clock.time()
+
+    def sleep(self, seconds):
+        self.clock.sleep(seconds)
+
+    def injectError(self, error_code, after_cmds=0):
+        """
+        Makes the next executed command string fail with `error_code` after
+        `after_cmds` commands have run (e.g. 9 for a plunger overload)
+
+        """
+        self._injected = (error_code, after_cmds)
+
+    def triggerInput(self, pin=1):
+        """
+        Drives TTL input `pin` (1 or 2) low, resuming a command string halted
+        with 'H0' or 'H<pin>'
+
+        """
+        if self.halted_pin in (0, pin):
+            self._advance()
+            try:
+                self._execute([])
+            except _SimError as e:
+                self.error = e.code
+
+    #########################################################################
+    # Transport interface                                                   #
+    #########################################################################
+
+    def sendRcv(self, cmd):
+        self.clock.sleep(self.latency)
+        self.cmd_count += 1
+        self._advance()
+        data = None
+        try:
+            if cmd == 'Q':
+                pass
+            elif cmd == '&':
+                data = self.FIRMWARE
+            elif cmd.startswith('?'):
+                data = self._query(cmd)
+            elif cmd == 'T':
+                self._terminate()
+            else:
+                self._command(cmd)
+        except _SimError as e:
+            self.error = e.code
+            if e.code == 9:
+                self.initialized = False
+            elif e.code == 10:
+                self.valve_initialized = False
+        return {'status_byte': self._statusByte(), 'data': data}
+
+    def _statusByte(self):
+        ready = self.clock.time() >= self.busy_until
+        return '{0:08b}'.format(0x40 | (0x20 if ready else 0) | self.error)
+
+    def _advance(self):
+        """ Reports the moves that have completed by now """
+        now = self.clock.time()
+        while self._events and self._events[0][0] <= now:
+            self._reported.update(self._events.pop(0)[1])
+
+    def _query(self, cmd):
+        if cmd not in ('?', '?1', '?2', '?3', '?4', '?6', '?10', '?76'):
+            raise _SimError(2)
+        if cmd in ('?', '?4'):
+            value = self._reported['plunger_pos']
+        elif cmd == '?6':
+            value = self._reported['port']
+        elif cmd == '?10':
+            value = int(bool(self._buffer))
+        elif cmd == '?76':
+            value = 'XC{0}'.format(self.num_ports)
+        else:
+            value = self.state[{'?1': 'start_speed', '?2': 'top_speed',
+                                '?3': 'cutoff_speed'}[cmd]]
+        return str(value).encode('utf-8')
+
+    def _terminate(self):
+        """ Stops the current command string where it is """
+        self._events = []
+        self.state['plunger_pos'] = self._reported['plunger_pos']
+        self.state['port'] = self._reported['port']
+        self.busy_until = self.clock.time()
+        self._buffer = []
+        self.halted_pin = None
+
+    def _command(self, cmd):
+        if self.clock.time() < self.busy_until:
+            raise _SimError(15)
+        if len(cmd) > CMD_BUFFER_LEN:
+            raise _SimError(15)
+        cmds = tokenizeChain(cmd)
+        if ''.join(cmds) + ('R' if cmd.endswith('R') else '') != cmd:
+            raise _SimError(2)
+        self._checkSyntax(cmds)
+        if not cmd.endswith('R'):
+            self._buffer.extend(cmds)
+            self.error = 0
+            return
+        self._execute(cmds)
+
+    def _checkSyntax(self, cmds):
+        """ Checks commands and fixed operand ranges before execution """
+        depth = 0
+        for cmd in cmds:
+            op, arg = cmd[0], cmd[1:]
+            if op not in 'ZYWwAPDIOSVvcLNgGMH':
+                raise _SimError(2)
+            if op in 'ZYWw':
+                if arg and not all(part.isdigit() for part in arg.split(',')):
+                    raise _SimError(3)
+                continue
+            if arg and not arg.isdigit():
+                raise _SimError(3)
+            value = int(arg) if arg else 0
+            if op == 'g':
+                depth += 1
+                if depth > MAX_LOOP_DEPTH:
+                    raise _SimError(4)
+            elif op == 'G':
+                depth -= 1
+                if depth < 0:
+                    raise _SimError(4)
+                if not 0 < value < 30000:
+                    raise _SimError(3)
+            elif op in 'IO' and not 0 < value <= self.num_ports:
+                raise _SimError(3)
+            elif op == 'S' and value not in SPEED_CODES:
+                raise _SimError(3)
+            elif op == 'V' and not TOP_SPEED_RANGE[0] <= value <= \
+                    TOP_SPEED_RANGE[1]:
+                raise _SimError(3)
+            elif op == 'v' and not START_SPEED_RANGE[0] <= value <= \
+                    START_SPEED_RANGE[1]:
+                raise _SimError(3)
+            elif op == 'c' and not CUTOFF_SPEED_RANGE[0] <= value <= \
+                    CUTOFF_SPEED_RANGE[1]:
+                raise _SimError(3)
+            elif op == 'L' and not SLOPE_RANGE[0] <= value <= SLOPE_RANGE[1]:
+                raise _SimError(3)
+            elif op == 'N' and value > 1:
+                raise _SimError(3)
+            elif op == 'M' and not 0 < value < 30000:
+                raise _SimError(3)
+            elif op == 'H' and value > 2:
+                raise _SimError(3)
+        if depth != 0:
+            raise _SimError(4)
+
+    def _execute(self, cmds):
+        """
+        Runs the buffered commands followed by `cmds`, recording the time
+        at which each move completes
+
+        """
+        program = self._buffer + cmds
+        self._buffer = []
+        self.halted_pin = None
+        self.error = 0
+        injected, self._injected = self._injected, None
+        t = self.clock.time()
+        loops = []
+        pc = 0
+        executed = 0
+        try:
+            while pc < len(program):
+                if injected is not None and executed == injected[1]:
+                    raise _SimError(injected[0])
+                cmd = program[pc]
+                op, arg = cmd[0], cmd[1:]
+                pc += 1
+                executed += 1
+                if op == 'g':
+                    loops.append([pc, None])
+                elif op == 'G':
+                    loop = loops[-1]
+                    if loop[1] is None:
+                        loop[1] = int(arg) - 1
+                    if loop[1] > 0:
+                        loop[1] -= 1
+                        pc = loop[0]
+                    else:
+                        loops.pop()
+                elif op == 'H':
+                    self._buffer = program[pc:]
+                    self.halted_pin = int(arg) if arg else 0
+                    break
+                else:
+                    t += self._run(op, arg)
+                    self._events.append((t, {
+                        'plunger_pos': self.state['plunger_pos'],
+                        'port': self.state['port']}))
+        finally:
+            self.busy_until = t
+            self._advance()
+
+    def _run(self, op, arg):
+        """ Applies a single command and returns its execution time """
+        state = self.state
+        max_pos = 24000 if state['microstep'] else 3000
+        if op in 'ZYWw':
+            args = [int(part) for part in arg.split(',') if part]
+            if op == 'w':
+                to_port = args[0] if args and args[0] else 1
+                exec_time = self.calibration.valveTime(
+                    valveTravel(state['port'], to_port, self.num_ports)[1],
+                    self.num_ports)
+                state['port'] = to_port
+                self.valve_initialized = True
+                return exec_time
+            out_port = args[2] if len(args) > 2 and args[2] else \
+                self.num_ports
+            state['plunger_pos'] = 0
+            state['port'] = out_port
+            self.initialized = True
+            self.valve_initialized = True
+            return self.init_time
+        if op in 'APDIO' and not self.initialized or \
+                op in 'IO' and not self.valve_initialized:
+            raise _SimError(7)
+        value = int(arg) if arg else 0
+        if op in 'APD':
+            if op == 'A':
+                new_pos = value
+            elif op == 'P':
+                new_pos = state['plunger_pos'] + value
+            else:
+                new_pos = state['plunger_pos'] - value
+            if not 0 <= new_pos <= max_pos:
+                raise _SimError(3)
+            move_steps = abs(new_pos - state['plunger_pos'])
+            state['plunger_pos'] = new_pos
+            return self.calibration.plungerTime(plungerMoveTime(
+                move_steps, state['start_speed'], state['top_speed'],
+                state['cutoff_speed'], state['slope'], state['microstep']))
+        if op in 'IO':
+            direction = 'CW' if op == 'I' else 'CCW'
+            port_steps = valveTravel(state['port'], value, self.num_ports,
+                                     direction)[1]
+            state['port'] = value
+            return self.calibration.valveTime(port_steps, self.num_ports)
+        if op == 'M':
+            return value / 1000.0
+        if op in 'SV':
+            top_speed = SPEED_CODES[value] if op == 'S' else value
+            state['top_speed'] = top_speed
+            state['start_speed'] = min(state['start_speed'], top_speed)
+            state['cutoff_speed'] = min(state['cutoff_speed'], top_speed)
+        elif op == 'v':
+            state['start_speed'] = min(value, state['top_speed'])
+        elif op == 'c':
+            state['cutoff_speed'] = min(value, state['top_speed'])
+        elif op == 'L':
+            state['slope'] = value
+        elif op == 'N':
+            microstep = bool(value)
+            if microstep != state['microstep']:
+                if microstep:
+                    state['plunger_pos'] *= 8
+                else:
+                    state['plunger_pos'] //= 8
+            state['microstep'] = microstep
+        return 0
@@ -0,0 +1,152 @@
+"""
+status.py
+
+Contains the `StatusHub` class, which runs one background poller thread
+per bus (for all the pumps on it) and publishes pump status changes to
+any number of subscribers (e.g. Server-Sent Event streams). The pumps are
+sampled at a fixed rate regardless of the number of subscribers, so
+watching the status does not add bus load per client.
+
+"""
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from .tecanapi import TecanAPITimeout
+
+
+class StatusHub(object):
+    """
+    Polls pumps (see `XCaliburD.pollStatus`) and publishes status deltas.
+    Confirmed samples (pump ready, no error) also update the pumps' known
+    state (see `XCaliburD.state_version`).
+
+    Each event is a dict with `seq` (increasing event number), `pump` (pump
+    key), `time`, and `status` (only the fields that changed since the
+    previous sample, or `{'online': False}` if the pump stopped
+    responding).
+
+    Kwargs:
+        `interval` (float) : sampling period per bus in seconds
+        `max_backlog` (int) : events buffered per subscriber; subscribers
+                              that fall further behind are dropped (and
+                              receive `None`)
+
+    """
+
+    def __init__(self, interval=0.5, max_backlog=1000):
+        self.interval = interval
+        self.max_backlog = max_backlog
+        self._status = {}
+        self._subscribers = []
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._buses = {}
+        self._threads = {}
+
+    def addBus(self, bus, pumps):
+        """
+        Polls the pumps (dict of pump key -> pump) on `bus`. The first
+        pumps added to a bus start its poller thread; pumps added later
+        (e.g. as they are discovered) join that poller.
+
+        """
+        with self._lock:
+            if bus in self._buses:
+                self._buses[bus].update(pumps)
+                return
+            self._buses[bus] = dict(pumps)
+            thread = threading.Thread(target=self._poll, args=(bus,))
+            thread.daemon = True
+            self._threads[bus] = thread
+        thread.start()
+
+    def addPumps(self, pumps):
+        """
+        Groups pumps (dict of pump key -> pump) by bus (their serial port
+        or node address) and polls them with the poller for each bus.
+        Keys must identify a pump on its bus (e.g. serial port and
+        address), since several pumps can share a serial port.
+
+        """
+        buses = {}
+        for key, pump in pumps.items():
+            link = pump.com_link
+            bus = getattr(link, 'ser_port', getattr(link, 'node_addr', key))
+            buses.setdefault(bus, {})[key] = pump
+        for bus, bus_pumps in buses.items():
+            self.addBus(bus, bus_pumps)
+
+    def stop(self):
+        self._stop.set()
+
+    def _poll(self, bus):
+        next_sample = time.time()
+        while not self._stop.is_set():
+            with self._lock:
+                pumps = list(self._buses[bus].items())
+            for key, pump in pumps:
+                try:
+                    status = pump.pollStatus(update_state=True)
+                    status['online'] = True
+                except TecanAPITimeout:
+                    status = {'online': False}
+                self._update(key, status)
+            next_sample += self.interval
+            delay = next_sample - time.time()
+            if delay > 0:
+                self._stop.wait(delay)
+            else:
+                next_sample = time.time()
+
+    def _update(self, key, status):
+        with self._lock:
+            prev = self._status.get(key, {})
+            if status['online']:
+                delta = {k: v for k, v in status.items()
+                         if prev.get(k) != v}
+            elif prev.get('online') is False:
+                delta = {}
+            else:
+                delta = status
+            self._status[key] = status
+            if not delta:
+                return
+            self._seq += 1
+            event = {'seq': self._seq, 'pump': key, 'time': time.time(),
+                     'status': delta}
+            for subscriber in list(self._subscribers):
+                if subscriber.qsize() >= self.max_backlog:
+                    self._subscribers.remove(subscriber)
+                    subscriber.put(None)
+                else:
+                    subscriber.put(event)
+
+    def snapshot(self):
+        """ Returns the latest full status of every pump """
+        with self._lock:
+            return {key: dict(status) for key, status in self._status.items()}
+
+    def subscribe(self):
+        """
+        Returns a `(snapshot, events)` tuple: the current full status and a
+        queue that receives every subsequent event (or `None` if the
+        subscriber was dropped)
+
+        """
+        events = queue.Queue()
+        with self._lock:
+            self._subscribers.append(events)
+            snapshot = {key: dict(status)
+                        for key, status in self._status.items()}
+        return snapshot, events
+
+    def unsubscribe(self, events):
+        with self._lock:
+            if events in self._subscribers:
+                self._subscribers.remove(events)
@@ -0,0 +1,239 @@
+"""
+sync.py
+
+Contains the `SyncStart` class, which starts command chains on several
+pumps at the same moment. Each pump's chain is preloaded ending in a halt
+('H', see `XCaliburD.haltExec`) followed by the synchronized commands, and
+the pumps are then released together: by a TTL edge on the shared input
+(driven by a caller-supplied `trigger`), or in software by an 'R' sent to
+the broadcast address of each bus (or to each pump in turn, where a bus
+cannot be broadcast to). The release then polls the pumps to measure the
+window in which each one started, and reports the start skew bound.
+
+"""
+from .chain import CMD_BUFFER_LEN, segmentChain
+from .syringe import SyringeTimeout
+from .transport import TecanAPISerial
+
+
+class SyncStart(object):
+    """
+    Synchronized start of several pumps.
+
+    Args:
+        `pumps` (dict) : `XCaliburD` instances keyed by name
+    Kwargs:
+        `input_pin` (int) : TTL input the pumps halt on (see
+                            `XCaliburD.haltExec`)
+        `trigger` (callable) : drives the shared TTL input low when
+                               called; if `None`, the pumps are released
+                               in software
+        `broadcast` (bool) : release in software with one broadcast 'R'
+                             per bus where the bus holds only these pumps
+        `polling_interval` (float) : status polling interval in seconds
+        `timeout` (float) : max time in seconds to wait for the pumps to
+                            reach the halt
+        `release_timeout` (float) : max time in seconds to watch for the
+                                    pumps to leave the halt after a release
+
+    """
+
+    def __init__(self, pumps, input_pin=0, trigger=None, broadcast=True,
+                 polling_interval=0.01, timeout=30, release_timeout=1.0):
+        self.pumps = pumps
+        self.input_pin = input_pin
+        self.trigger = trigger
+        self.broadcast = broadcast
+        self.polling_interval = polling_interval
+        self.timeout = timeout
+        self.release_timeout = release_timeout
+        self.exec_times = {}
+        self.armed = False
+        first = next(iter(pumps.values()))
+        self._time = first._time
+        self._sleep = first._sleep
+
+    def arm(self, builds):
+        """
+        Preloads the chains and blocks until every pump has reached its
+        halt. Commands already in a pump's command chain run before the
+        halt; the commands added by `builds[name](pump)` run after it.
+        Each chain must fit in the command buffer. If any build fails, no
+        chain is sent and every pump's command chain is reset. If the
+        pumps do not reach the halt within `timeout`, the preloaded chains
+        are terminated before `SyringeTimeout` is raised.
+
+        Args:
+            `builds` (dict) : callables keyed by pump name
+
+        """
+        try:
+            for name, pump in sorted(self.pumps.items()):
+                pre_time = pump.exec_time
+                pump.haltExec(self.input_pin)
+                builds[name](pump)
+                if len(segmentChain(pump.chain_steps,
+                                    CMD_BUFFER_LEN - 1)) > 1:
+                    raise ValueError('Chain for pump `{0}` does not fit in '
+                                     'the command buffer; synchronized '
+                                     'chains cannot be streamed'.format(name))
+                self.exec_times[name] = pump.exec_time - pre_time
+        except Exception:
+            for pump in self.pumps.values():
+                pump.resetChain()
+            raise
+        for name, pump in sorted(self.pumps.items()):
+            pump.executeChain()
+        start = self._time()
+        waiting = set(self.pumps)
+        while waiting:
+            for name in sorted(waiting):
+                if self._isHalted(self.pumps[name]):
+                    waiting.discard(name)
+            if not waiting:
+                break
+            if self._time() - start > self.timeout:
+                self._abort()
+                raise SyringeTimeout('Pumps did not reach the halt: {0}'
+                                     ''.format(', '.join(sorted(waiting))))
+            self._sleep(self.polling_interval)
+        self.armed = True
+
+    def _abort(self):
+        """
+        Terminates the preloaded chains and re-reads the pumps' positions,
+        so no pump is left holding a chain behind a halt
+
+        """
+        for name, pump in sorted(self.pumps.items()):
+            pump.terminateCmd()
+            pump.resetChain()
+            pump.getPlungerPos()
+            pump.getCurPort()
+            pump.updateSimState()
+
+    def _isHalted(self, pump):
+        """
+        A halted pump is ready (the commands before the halt are done) and
+        holds the rest of its chain in the command buffer
+
+        """
+        link = pump.com_link
+        if link.sendRcv('Q')['status_byte'][2] != '1':
+            return False
+        return link.sendRcv('?10')['data'] in (b'1', '1')
+
+    def _buses(self):
+        """
+        Returns `(broadcast, direct)`: {serial port: pump names} for buses
+        that can be released by broadcast, and the other pump names
+
+        """
+        buses = {}
+        direct = []
+        for name, pump in sorted(self.pumps.items()):
+            link = pump.com_link
+            if self.broadcast and isinstance(link, TecanAPISerial):
+                buses.setdefault(link.ser_port, []).append(name)
+            else:
+                direct.append(name)
+        broadcast = {}
+        for bus, names in buses.items():
+            if len(TecanAPISerial.ser_mapping[bus]['_devices']) == len(names):
+                broadcast[bus] = names
+            else:
+                direct.extend(names)
+        return broadcast, sorted(direct)
+
+    def release(self):
+        """
+        Releases the halted pumps and then polls their command buffers
+        ('?10') to see when each one left the halt. Returns a report dict:
+
+        `mode` : 'ttl', 'broadcast', or 'direct' (addressed 'R' per pump;
+                 'broadcast' if any bus was broadcast to)
+        `start_times` : estimated start time of each pump (when the edge or
+                        frame that released it was sent; the midpoint of
+                        the exchange for addressed releases)
+        `release_windows` : `(earliest, latest)` time each released pump
+                            can have left the halt: from the release (or
+                            the last poll that found it halted) to the
+                            reply of the first poll that found it running
+        `skew` : measured upper bound on the spread of the start times in
+                 seconds (from the earliest to the latest end of the
+                 release windows); limited by the polling round trips
+        `released` : names of the pumps seen to leave the halt within
+                     `release_timeout`
+
+        """
+        if not self.armed:
+            raise ValueError('SyncStart is not armed')
+        start_times = {}
+        sent = {}
+        if self.trigger is not None:
+            mode = 'ttl'
+            tic = self._time()
+            self.trigger()
+            for name in self.pumps:
+                start_times[name] = sent[name] = tic
+        else:
+            broadcast, direct = self._buses()
+            mode = 'broadcast' if broadcast else 'direct'
+            for bus, names in sorted(broadcast.items()):
+                tic = self._time()
+                TecanAPISerial.broadcast(bus, 'R')
+                for name in names:
+                    start_times[name] = sent[name] = tic
+            for name in direct:
+                tic = self._time()
+                self.pumps[name].com_link.sendRcv('R')
+                sent[name] = tic
+                start_times[name] = (tic + self._time()) / 2.0
+        self.armed = False
+        windows = self._releaseWindows(sent)
+        for name, pump in self.pumps.items():
+            pump._ready = False
+        skew = 0.0
+        if windows:
+            skew = max(latest for _, latest in windows.values()) - \
+                min(earliest for earliest, _ in windows.values())
+        return {
+            'mode': mode,
+            'start_times': start_times,
+            'release_windows': windows,
+            'skew': skew,
+            'released': sorted(windows)
+        }
+
+    def _releaseWindows(self, sent):
+        """
+        Polls the pumps in turn until each has left the halt (its command
+        buffer is empty) or `release_timeout` has passed, starting from the
+        times their release was `sent`. Returns {name: (earliest, latest)}
+        for the pumps that left the halt.
+
+        """
+        earliest = dict(sent)
+        windows = {}
+        start = self._time()
+        waiting = sorted(self.pumps)
+        while waiting:
+            for name in list(waiting):
+                tic = self._time()
+                data = self.pumps[name].com_link.sendRcv('?10')['data']
+                if data in (b'0', '0'):
+                    windows[name] = (earliest[name], self._time())
+                    waiting.remove(name)
+                else:
+                    earliest[name] = tic
+            if waiting:
+                if self._time() - start > self.release_timeout:
+                    break
+                self._sleep(self.polling_interval)
+        return windows
+
+    def wait(self, timeout=10):
+        """ Waits for every released pump to finish its chain """
+        for name, pump in sorted(self.pumps.items()):
+            pump.waitReady(timeout=self.exec_times.get(name, 0) + timeout,
+                           polling_interval=max(self.polling_interval, 0.1))
@@ -6,6 +6,8 @@ try:
 except:
     from time import sleep
 
+from .metrics import SYRINGE_ERRORS, WAIT_OVERSHOOT
+
 
 class SyringeError(Exception):
     """
@@ -56,6 +58,12 @@ class Syringe(object):
 
     def __init__(self, com_link):
         self.com_link = com_link
+        # Links with a virtual clock (e.g. `simulator.SimulatedLink`)
+        # provide their own `time` and `sleep`
+        self._time = getattr(com_link, 'time', time.time)
+        self._sleep = getattr(com_link, 'sleep', sleep)
+        self.device = str(getattr(com_link, 'device', '{0:x}'.format(
+                          id(self))))
         self._ready = False
         self._prev_error_code = 0
         self._repeat_error = False
@@ -88,6 +96,10 @@ class Syringe(object):
             self._repeat_error = False
         self._prev_error_code = error_code
         if error_code != 0:
+            # Polls of a pump stuck in an error repeat the same code, so
+            # only count the code when it is new
+            if not self._repeat_error:
+                SYRINGE_ERRORS.inc(device=self.device, code=error_code)
             error_dict = self.__class__.ERROR_DICT
             raise SyringeError(error_code, error_dict)
         return ready, error_code
@@ -119,13 +131,17 @@ class Syringe(object):
 
         """
         if delay:
-            sleep(delay)
-        start = time.time()
-        while (start-time.time()) < (start+timeout):
+            self._sleep(delay)
+        start = self._time()
+        while (self._time()-start) < timeout:
             ready = self._checkReady()
             if not ready:
-                sleep(polling_interval)
+                self._sleep(polling_interval)
             else:
+                if delay:
+                    # Time past the estimated end of the move
+                    WAIT_OVERSHOOT.observe(self._time() - start,
+                                           device=self.device)
                 return
         raise(SyringeTimeout('Timeout while waiting for syringe to be ready'
                              ' to accept commands [{}]'.format(timeout)))
@@ -19,6 +19,10 @@ class TecanAPITimeout(Exception):
 
 class TecanAPI(object):
 
+    # Opt-in frame recorder shared by all links (see capture.py); may be
+    # overridden per instance
+    recorder = None
+
     def __init__(self, addr):
         self.START_BYTE = 0x02
         self.STOP_BYTE = 0x03
@@ -31,14 +35,18 @@ class TecanAPI(object):
         Returns a bytestring outgoing frame built around `cmd`
         """
         self._cmd = cmd
-        return self._buildFrame()
+        frame = self._buildFrame()
+        self._record(0, frame)
+        return frame
 
     def emitRepeat(self):
         """
         Returns a repeat frame (repeat bit = 1) containing the same `cmd`
         as the previous emitted frame.
         """
-        return self._buildFrame(repeat=True)
+        frame = self._buildFrame(repeat=True)
+        self._record(0, frame)
+        return frame
 
     def parseFrame(self, frame):
         """
@@ -46,8 +54,18 @@ class TecanAPI(object):
         frame does not pass validation. Otherwise, returns a dictionary of
         the `status_code` and `data_block`.
         """
+        self._record(1, frame)
         return self._analyzeFrame(frame)
 
+    def _record(self, direction, frame):
+        """
+        Records `frame` with the capture recorder, if any, under the
+        link's `device` name (set by transports)
+        """
+        if self.recorder is not None:
+            self.recorder.record(getattr(self, 'device', hex(id(self))),
+                                 self.addr, direction, frame)
+
     def _analyzeFrame(self, raw_frame):
         try:
             # Get basic indices
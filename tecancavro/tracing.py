@@ -0,0 +1,141 @@
+"""
+tracing.py
+
+Contains the `Tracer` class and the process-wide `TRACER` instance used
+for debug tracing of pump calls. Trace events are appended to an
+in-memory ring buffer (`Tracer.events`) and, if a log file is configured,
+handed to a background thread through a queue so file I/O stays out of
+the command path. A single file handler is shared by all pumps in the
+process.
+
+Call sites guard tracing with the pump's `debug` flag so that nothing
+(not even the `locals()` dict) is built when tracing is off:
+
+    if self.debug:
+        self.logCall('extract', locals())
+
+"""
+import logging
+import threading
+import time
+
+from collections import deque
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from logging.handlers import QueueHandler, QueueListener
+except ImportError:
+    QueueHandler = QueueListener = None
+
+
+if QueueHandler is not None:
+    class _DeferredQueueHandler(QueueHandler):
+        """ Queues records unformatted; the listener thread formats them """
+
+        def prepare(self, record):
+            return record
+
+
+class Tracer(object):
+    """
+    Ring buffer of trace events with optional asynchronous file logging.
+
+    Kwargs:
+        `capacity` (int) : number of events kept in memory
+            [default] - 10000
+
+    """
+
+    LOG_NAME = 'xcaliburd_debug.log'
+
+    def __init__(self, capacity=10000):
+        self.events = deque(maxlen=capacity)
+        self.logger = logging.getLogger('tecancavro.trace')
+        self.logger.propagate = False
+        self.log_path = None
+        self._handler = None
+        self._listener = None
+        self._lock = threading.Lock()
+
+    def enableFile(self, log_dir='.'):
+        """
+        Starts writing trace events to `LOG_NAME` in `log_dir`. Only one
+        log file is kept per process; enabling a different directory
+        replaces the previous file.
+
+        """
+        log_path = log_dir.rstrip('/') + '/' + self.LOG_NAME
+        with self._lock:
+            if log_path == self.log_path:
+                return
+            self._stopFile()
+            file_handler = logging.FileHandler(log_path)
+            file_handler.setFormatter(logging.Formatter(
+                '%(asctime)s %(levelname)s %(message)s'))
+            if QueueHandler is not None:
+                log_queue = queue.Queue(-1)
+                self._handler = _DeferredQueueHandler(log_queue)
+                self._listener = QueueListener(log_queue, file_handler)
+                self._listener.start()
+            else:
+                # Python 2 has no queue handler; write synchronously
+                self._handler = file_handler
+            self.logger.addHandler(self._handler)
+            self.logger.setLevel(logging.DEBUG)
+            self.log_path = log_path
+
+    def disableFile(self):
+        """ Flushes and closes the trace log file """
+        with self._lock:
+            self._stopFile()
+
+    def _stopFile(self):
+        if self._handler is None:
+            return
+        self.logger.removeHandler(self._handler)
+        if self._listener is not None:
+            self._listener.stop()
+            for handler in self._listener.handlers:
+                handler.close()
+        self._handler.close()
+        self._handler = None
+        self._listener = None
+        self.log_path = None
+
+    def flush(self):
+        """ Blocks until all queued events have been written """
+        with self._lock:
+            if self._listener is not None:
+                self._listener.stop()
+                self._listener.start()
+
+    def record(self, source, event, detail=None):
+        """
+        Records a trace `event` (e.g. a method name) from `source` (e.g. a
+        pump) with an optional `detail` (e.g. the call arguments)
+
+        """
+        self.events.append((time.time(), source, event, detail))
+        if self._handler is not None:
+            self.logger.debug('%s %s: %s', source, event, detail)
+
+    def dump(self, source=None):
+        """
+        Returns the buffered events as a list of `(time, source, event,
+        detail)` tuples, optionally only those from `source`
+
+        """
+        events = list(self.events)
+        if source is not None:
+            events = [entry for entry in events if entry[1] == source]
+        return events
+
+    def clear(self):
+        self.events.clear()
+
+
+TRACER = Tracer()
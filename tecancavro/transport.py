@@ -15,6 +15,7 @@ which sends a command string (`cmd`) and returns a dictionary containing the
 
 import glob
 import sys
+import threading
 import uuid
 import time
 
@@ -37,6 +38,11 @@ except:
     from time import sleep
 
 from .tecanapi import TecanAPI, TecanAPITimeout
+from .metrics import BUS_BUSY, RETRIES, ROUND_TRIP, TIMEOUTS
+
+# Address '_' (0x5F): every device on the bus executes the command and none
+# of them answer
+BROADCAST_ADDR = 0x5F - 0x31
 
 # From http://stackoverflow.com/questions/12090503/
 #      listing-available-com-ports-with-python
@@ -78,6 +84,8 @@ class TecanAPISerial(TecanAPI):
     and management for the Tecan OEM API. Maps devices to a state-monitored
     dictionary, `ser_mapping`, which allows multiple Tecan devices to
     share a serial port (provided that the serial params are the same).
+    Exchanges on a shared port are serialized by a per-port lock, so the
+    devices on a bus may be driven from different threads.
     """
 
     ser_mapping = {}
@@ -113,6 +121,7 @@ class TecanAPISerial(TecanAPI):
 
         self.id_ = str(uuid.uuid4())
         self.ser_port = ser_port
+        self.device = '{0}:{1}'.format(ser_port, tecan_addr)
         self.ser_info = {
             'baud': ser_baud,
             'timeout': ser_timeout,
@@ -121,25 +130,57 @@ class TecanAPISerial(TecanAPI):
         self._registerSer()
 
     def sendRcv(self, cmd):
+        # The whole exchange holds the port lock: retries resend the last
+        # emitted frame, so no other command may be built in between
+        with self._lock:
+            return self._exchange(cmd)
+
+    def _exchange(self, cmd):
         attempt_num = 0
+        tic = time.time()
         while attempt_num < self.ser_info['max_attempts']:
             try:
                 attempt_num += 1
                 if attempt_num == 1:
                     frame_out = self.emitFrame(cmd)
                 else:
+                    RETRIES.inc(device=self.device)
                     frame_out = self.emitRepeat()
                 self._sendFrame(frame_out)
                 frame_in = self._receiveFrame()
                 if frame_in:
+                    elapsed = time.time() - tic
+                    ROUND_TRIP.observe(elapsed, device=self.device)
+                    BUS_BUSY.inc(elapsed, bus=self.ser_port)
                     return frame_in
                 sleep(0.05 * attempt_num)
             except serial.SerialException:
                 sleep(0.2)
+        TIMEOUTS.inc(device=self.device)
+        BUS_BUSY.inc(time.time() - tic, bus=self.ser_port)
         raise(TecanAPITimeout('Tecan serial communication exceeded max '
                               'attempts [{0}]'.format(
                               self.ser_info['max_attempts'])))
 
+    def send(self, cmd):
+        """
+        Sends `cmd` without waiting for a response (e.g. to the broadcast
+        address, `BROADCAST_ADDR`, which is never answered)
+        """
+        with self._lock:
+            self._sendFrame(self.emitFrame(cmd))
+
+    @classmethod
+    def broadcast(cls, ser_port, cmd):
+        """
+        Sends `cmd` to every device on `ser_port` (which must already be
+        registered). Delivery is not acknowledged.
+        """
+        info = cls.ser_mapping[ser_port]['info']
+        link = cls(BROADCAST_ADDR, ser_port, info['baud'], info['timeout'],
+                   info['max_attempts'])
+        link.send(cmd)
+
     def _sendFrame(self, frame):
         self._ser.write(frame)
 
@@ -167,6 +208,7 @@ class TecanAPISerial(TecanAPI):
                                     baudrate=reg[port]['info']['baud'],
                                     timeout=reg[port]['info']['timeout'])
             reg[port]['_devices'] = [self.id_]
+            reg[port]['_lock'] = threading.RLock()
         else:
             if len(set(self.ser_info.items()) &
                set(reg[port]['info'].items())) != 3:
@@ -176,6 +218,7 @@ class TecanAPISerial(TecanAPI):
             else:
                 reg[port]['_devices'].append(self.id_)
         self._ser = reg[port]['_ser']
+        self._lock = reg[port]['_lock']
 
     def __del__(self):
         """
@@ -203,25 +246,41 @@ class TecanAPINode(TecanAPI):
                  max_attempts=5):
         super(TecanAPINode, self).__init__(tecan_addr)
         self.node_addr = node_addr
+        self.device = '{0}:{1}'.format(node_addr, tecan_addr)
         self.response_len = response_len
         self.max_attempts = max_attempts
+        self._lock = threading.Lock()
 
     def sendRcv(self, cmd):
+        # Serializes exchanges on this link (see `TecanAPISerial.sendRcv`)
+        with self._lock:
+            return self._exchange(cmd)
+
+    def _exchange(self, cmd):
         attempt_num = 0
+        tic = time.time()
         while attempt_num < self.max_attempts:
             attempt_num += 1
             if attempt_num == 1:
                 frame_out = self.emitFrame(cmd)
             else:
+                RETRIES.inc(device=self.device)
                 frame_out = self.emitRepeat()
             url = ('http://{0}/syringe?LENGTH={1}&SYRINGE={2}'
                    ''.format(self.node_addr, self.response_len,
                             frame_out))
             raw_in = self._jsonFetch(url)
+            if raw_in:
+                self._record(1, raw_in['MSG'])
             frame_in = self._analyzeFrame(raw_in)
             if frame_in:
+                elapsed = time.time() - tic
+                ROUND_TRIP.observe(elapsed, device=self.device)
+                BUS_BUSY.inc(elapsed, bus=self.node_addr)
                 return frame_in
             sleep(0.2 * attempt_num)
+        TIMEOUTS.inc(device=self.device)
+        BUS_BUSY.inc(time.time() - tic, bus=self.node_addr)
         raise(TecanAPITimeout('Tecan HTTP communication exceeded max '
                               'attempts [{0}]'.format(
                               self.max_attempts)))
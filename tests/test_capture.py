@@ -0,0 +1,132 @@
+"""
+test_capture.py
+
+Records a simulated pump session with `FrameRecorder` and reads and
+replays it with `CaptureReader`.
+
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from tecancavro import capture
+from tecancavro.capture import CaptureReader, startCapture, stopCapture
+from tecancavro.models import XCaliburD
+from tecancavro.simulator import SimulatedLink, VirtualClock
+from tecancavro.tecanapi import TecanAPI
+
+
+class FramedLink(TecanAPI):
+    """
+    `com_link` that passes every command through Tecan OEM API frames (so
+    it is captured) to a `SimulatedLink`
+
+    """
+
+    def __init__(self, sim, device):
+        super(FramedLink, self).__init__(0)
+        self.sim = sim
+        self.device = device
+        self.time = sim.time
+        self.sleep = sim.sleep
+
+    def sendRcv(self, cmd):
+        self.emitFrame(cmd)
+        response = self.sim.sendRcv(cmd)
+        frame = [self.START_BYTE, 0x30, int(response['status_byte'], 2)]
+        if response['data'] is not None:
+            frame.extend(bytearray(response['data']))
+        frame.append(self.STOP_BYTE)
+        frame.append(self._buildChecksum(frame))
+        return self.parseFrame(bytearray(frame))
+
+
+class CaptureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'session.cap')
+        self.clock = VirtualClock()
+        # Timestamp records on the virtual clock, so the captured timing
+        # matches the simulated pump
+        self._monotonic = capture._monotonic
+        capture._monotonic = self.clock.time
+
+    def tearDown(self):
+        stopCapture()
+        capture._monotonic = self._monotonic
+        shutil.rmtree(self.tmp_dir)
+
+    def recordSession(self, inject_error=None):
+        startCapture(self.path)
+        sim = SimulatedLink(clock=self.clock, latency=0.004)
+        pump = XCaliburD(FramedLink(sim, '/dev/ttyUSB0:0'))
+        pump.init()
+        pump.waitReady(polling_interval=0.05)
+        for port in (2, 3, 4):
+            if port == 3 and inject_error is not None:
+                sim.injectError(inject_error, after_cmds=1)
+            pump.extract(1, 300)
+            pump.dispense(port, 300)
+            pump.executeChain()
+            pump.waitReady(polling_interval=0.05)
+        stopCapture()
+        return CaptureReader(self.path)
+
+    def testRecordsExchanges(self):
+        reader = self.recordSession()
+        self.addCleanup(reader.close)
+        self.assertEqual(reader.devices, ['/dev/ttyUSB0:0'])
+        self.assertTrue(os.path.exists(self.path + capture.INDEX_SUFFIX))
+        exchanges = reader.exchanges('/dev/ttyUSB0:0')
+        self.assertEqual(len(exchanges) * 2, len(reader))
+        for out_idx, in_idx in exchanges:
+            self.assertEqual(in_idx, out_idx + 1)
+            self.assertEqual(reader.record(out_idx)[3], capture.OUT)
+            self.assertEqual(reader.record(in_idx)[3], capture.IN)
+        times = [reader.record(i)[0] for i in range(len(reader))]
+        self.assertEqual(times, sorted(times))
+        stats = reader.latencyStats()['/dev/ttyUSB0:0']
+        self.assertEqual(stats['count'], len(exchanges))
+        self.assertEqual(stats['unanswered'], 0)
+        self.assertAlmostEqual(stats['p50'], 0.004)
+
+    def testSelectByTime(self):
+        reader = self.recordSession()
+        self.addCleanup(reader.close)
+        start = reader.record(10)[0]
+        end = reader.record(-10)[0]
+        expected = [i for i in range(len(reader))
+                    if start <= reader.record(i)[0] < end]
+        self.assertEqual(reader.select('/dev/ttyUSB0:0', start, end),
+                         expected)
+        self.assertEqual(reader.select('/dev/ttyUSB9:0'), [])
+
+    def testReopenWithoutIndex(self):
+        reader = self.recordSession()
+        expected = [reader.record(i) for i in range(len(reader))]
+        reader.close()
+        os.remove(self.path + capture.INDEX_SUFFIX)
+        reader = CaptureReader(self.path)
+        self.addCleanup(reader.close)
+        self.assertEqual([reader.record(i) for i in range(len(reader))],
+                         expected)
+
+    def testReplayMatches(self):
+        reader = self.recordSession()
+        self.addCleanup(reader.close)
+        self.assertEqual(reader.replay('/dev/ttyUSB0:0', latency=0.004), [])
+
+    def testReplayFlagsInjectedError(self):
+        reader = self.recordSession(inject_error=9)
+        self.addCleanup(reader.close)
+        mismatches = reader.replay('/dev/ttyUSB0:0', latency=0.004)
+        self.assertTrue(mismatches)
+        out_idx, cmd, recorded, simulated = mismatches[0]
+        self.assertEqual(int(recorded[4:], 2), 9)
+        self.assertEqual(int(simulated[4:], 2), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+"""
+test_chain.py
+
+Tests for the command chain helpers in chain.py.
+
+"""
+import unittest
+
+from tecancavro.chain import (MAX_LOOP_DEPTH, chainString, chainTime,
+                              compressLoops, segmentChain, splitUnits,
+                              tokenizeChain, unrollLoop, validateChain)
+
+
+def expandChain(steps):
+    """ Fully unrolls the loops in a list of chain `steps` """
+    cmds = []
+    for unit in splitUnits(steps):
+        if len(unit) == 1:
+            cmds.append(unit[0][0])
+        else:
+            cmds.extend(expandChain(unrollLoop(unit)))
+    return cmds
+
+
+def makeSteps(cmds):
+    return [(cmd, 0.5) for cmd in cmds]
+
+
+START = {'plunger_pos': 0, 'port': 1, 'microstep': False}
+
+
+class CompressLoopsTest(unittest.TestCase):
+
+    def assertRoundTrip(self, steps):
+        compressed = compressLoops(steps)
+        self.assertEqual(expandChain(compressed), [cmd for cmd, _ in steps])
+        self.assertAlmostEqual(chainTime(compressed), chainTime(steps))
+        return compressed
+
+    def testRepeatedStrokes(self):
+        steps = makeSteps(['I1', 'A3000', 'O9', 'A0'] * 20)
+        compressed = self.assertRoundTrip(steps)
+        self.assertEqual(chainString(compressed), 'gI1A3000O9A0G20')
+
+    def testNestedLoops(self):
+        inner = ['I2', 'P100', 'O3', 'D100'] * 3
+        steps = makeSteps((['I1', 'A0'] + inner) * 4 + ['I9'])
+        compressed = self.assertRoundTrip(steps)
+        self.assertLess(len(chainString(compressed)),
+                        len(chainString(steps)))
+        self.assertIn('gI2P100O3D100G3', chainString(compressed))
+
+    def testNothingToCompress(self):
+        steps = makeSteps(['I1', 'A3000', 'O9', 'A0'])
+        self.assertEqual(self.assertRoundTrip(steps), steps)
+
+    def testRespectsMaxDepth(self):
+        steps = makeSteps(['P1'] * 2 ** 12)
+        compressed = self.assertRoundTrip(steps)
+        self.assertLessEqual(chainString(compressed).count('g'),
+                             MAX_LOOP_DEPTH)
+
+
+class SegmentChainTest(unittest.TestCase):
+
+    def testConcatenationRoundTrip(self):
+        steps = makeSteps(['I1', 'A3000', 'O9', 'A0'] * 40)
+        segments = segmentChain(steps, max_len=50)
+        self.assertGreater(len(segments), 1)
+        self.assertEqual(sum(segments, []), steps)
+        for segment in segments:
+            self.assertLessEqual(len(chainString(segment)), 50)
+
+    def testLoopsAreNotSplit(self):
+        steps = makeSteps(['I1', 'A0'] * 10 + ['g', 'I2', 'A100', 'G5'] +
+                          ['I1', 'A0'] * 10)
+        segments = segmentChain(steps, max_len=30)
+        self.assertEqual(sum(segments, []), steps)
+        for segment in segments:
+            # Raises if a segment starts or ends inside a loop
+            splitUnits(segment)
+
+    def testOversizedLoopIsUnrolled(self):
+        steps = compressLoops(makeSteps(['I1', 'A3000', 'O9', 'A0'] * 30))
+        segments = segmentChain(steps, max_len=40)
+        self.assertEqual(expandChain(sum(segments, [])),
+                         expandChain(steps))
+        for segment in segments:
+            self.assertLessEqual(len(chainString(segment)), 40)
+
+    def testOversizedCommand(self):
+        self.assertRaises(ValueError, segmentChain, makeSteps(['A3000']),
+                          max_len=3)
+
+    def testTokenizeRoundTrip(self):
+        cmd_string = 'gI1A3000O9A0G20M500'
+        self.assertEqual(''.join(tokenizeChain(cmd_string + 'R')),
+                         cmd_string)
+
+
+class ValidateChainTest(unittest.TestCase):
+
+    def assertRejects(self, cmds, state=START, num_ports=9, **kwargs):
+        self.assertRaises(ValueError, validateChain, makeSteps(cmds), state,
+                          num_ports, **kwargs)
+
+    def testValidChain(self):
+        end_state = validateChain(
+            makeSteps(['I1', 'A3000', 'O9', 'D1000']), START, 9)
+        self.assertEqual(end_state['plunger_pos'], 2000)
+        self.assertEqual(end_state['port'], 9)
+
+    def testBufferOverflow(self):
+        cmds = ['I1', 'A3000', 'O9', 'A0'] * 30
+        self.assertRejects(cmds)
+        validateChain(makeSteps(cmds), START, 9, max_len=None)
+
+    def testPlungerOutOfRange(self):
+        self.assertRejects(['A3001'])
+        self.assertRejects(['D1'])
+        self.assertRejects(['A2900', 'P200'])
+
+    def testMicrostepRange(self):
+        validateChain(makeSteps(['N1', 'A24000']), START, 9)
+        self.assertRejects(['N1', 'A24001'])
+        self.assertRejects(['A3000', 'N1', 'P1'])
+
+    def testInvalidPort(self):
+        self.assertRejects(['I0'])
+        self.assertRejects(['O4'], num_ports=3)
+
+    def testRelativeLoopOverflowsInLastIteration(self):
+        validateChain(makeSteps(['g', 'P100', 'G30']), START, 9)
+        self.assertRejects(['g', 'P100', 'G31'])
+        self.assertRejects(['A3000', 'g', 'D100', 'G31'])
+
+    def testInfiniteLoop(self):
+        self.assertRejects(['g', 'I1', 'A3000', 'O9', 'A0', 'G0'])
+
+    def testLoopDepth(self):
+        depth = MAX_LOOP_DEPTH + 1
+        self.assertRejects(['g'] * depth + ['I1'] + ['G2'] * depth)
+
+    def testUnmatchedLoop(self):
+        self.assertRejects(['g', 'I1'])
+        self.assertRejects(['I1', 'G2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
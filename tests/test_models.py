@@ -0,0 +1,224 @@
+"""
+test_models.py
+
+Tests for `XCaliburD` against a `SimulatedLink`.
+
+"""
+import unittest
+
+from tecancavro.chain import tokenizeChain
+from tecancavro.models import XCaliburD
+from tecancavro.motion import np, plungerMoveTime, plungerMoveTimes
+from tecancavro.simulator import SimulatedLink, VirtualClock
+
+
+def makePump(**link_kwargs):
+    clock = VirtualClock()
+    link = SimulatedLink(clock=clock, **link_kwargs)
+    pump = XCaliburD(link)
+    pump.init()
+    pump.waitReady(polling_interval=0.01)
+    return pump, link, clock
+
+
+def runChain(pump, clock):
+    """ Executes the chain and returns the simulated execution time """
+    start = clock.time()
+    pump.executeChain()
+    pump.waitReady(timeout=300, polling_interval=0.01)
+    return clock.time() - start
+
+
+class RepeatCmdSeqTest(unittest.TestCase):
+
+    def testAbsoluteLoop(self):
+        pump, link, clock = makePump()
+        pump.markRepeatStart()
+        pump.changePort(1)
+        pump.movePlungerAbs(3000)
+        pump.changePort(9)
+        pump.movePlungerAbs(0)
+        pump.repeatCmdSeq(5)
+        self.assertEqual(pump.cmd_chain, 'gI1A3000O9A0G5')
+        self.assertEqual(pump.sim_state['plunger_pos'], 0)
+        self.assertEqual(pump.sim_state['port'], 9)
+        estimate = pump.exec_time
+        self.assertAlmostEqual(runChain(pump, clock), estimate, delta=0.05)
+        self.assertEqual(pump.getPlungerPos(), 0)
+
+    def testNestedRelativeLoop(self):
+        pump, link, clock = makePump()
+        pump.markRepeatStart()
+        pump.changePort(1)
+        pump.movePlungerRel(100)
+        pump.markRepeatStart()
+        pump.changePort(3)
+        pump.movePlungerRel(50)
+        pump.repeatCmdSeq(2)
+        pump.repeatCmdSeq(3)
+        self.assertEqual(pump.sim_state['plunger_pos'], 600)
+        estimate = pump.exec_time
+        self.assertAlmostEqual(runChain(pump, clock), estimate, delta=0.05)
+        self.assertEqual(pump.getPlungerPos(), 600)
+
+    def testRepeatCountRange(self):
+        pump, link, clock = makePump()
+        pump.movePlungerAbs(100)
+        self.assertRaises(ValueError, pump.repeatCmdSeq, 0)
+        self.assertRaises(ValueError, pump.repeatCmdSeq, 30000)
+
+
+@unittest.skipIf(np is None, 'requires NumPy')
+class PlungerMoveTimesTest(unittest.TestCase):
+
+    def testMatchesScalarModel(self):
+        steps = np.array([1, 10, 100, 500, 1000, 3000, 24000])
+        for start, top, cutoff, slope, microstep in (
+                (900, 1400, 900, 14, False),
+                (50, 5800, 2700, 20, False),
+                (400, 400, 400, 1, False),
+                (900, 1400, 900, 14, True)):
+            vectorized = plungerMoveTimes(steps, start, top, cutoff, slope,
+                                          microstep)
+            expected = [plungerMoveTime(int(s), start, top, cutoff, slope,
+                                        microstep) for s in steps]
+            self.assertTrue(np.allclose(vectorized, expected),
+                            (start, top, cutoff, slope, microstep))
+
+    def testBroadcastsSpeeds(self):
+        tops = np.array([1000, 2000, 3000])
+        times = plungerMoveTimes(3000, 900, tops, 900, 14)
+        self.assertEqual(times.shape, (3,))
+        self.assertTrue((np.diff(times) < 0).all())
+
+
+class UlToStepsTest(unittest.TestCase):
+
+    def testErrorDiffusion(self):
+        pump, link, clock = makePump()
+        for volume_ul in (0.7, 1.0 / 3, 2.55):
+            total = 0
+            for i in range(1, 501):
+                total += pump._ulToSteps(volume_ul, residual_key='test')
+                exact = i * volume_ul * 3.0
+                self.assertLessEqual(abs(total - exact), 0.5 + 1e-9)
+            pump._step_residuals.clear()
+
+    def testWithoutDiffusion(self):
+        pump, link, clock = makePump()
+        self.assertEqual(sum(pump._ulToSteps(0.1) for _ in range(10)), 0)
+        self.assertEqual(pump._ulToSteps(500, microstep=True), 12000)
+
+
+def strokeVolumes(cmd_chain, source_port):
+    """
+    Walks a dispense chain and returns the list of strokes, each a list of
+    `(port, steps)` tuples dispensed after a fill from `source_port` (the
+    plunger starts at 0)
+
+    """
+    strokes = []
+    port = None
+    pos = 0
+    for cmd in tokenizeChain(cmd_chain):
+        op, arg = cmd[0], cmd[1:]
+        if op in 'IO':
+            port = int(arg)
+        elif op == 'A':
+            new_pos = int(arg)
+            if port == source_port and new_pos > pos:
+                strokes.append([])
+            elif new_pos < pos:
+                strokes[-1].append((port, pos - new_pos))
+            pos = new_pos
+    return strokes
+
+
+class DispenseManyTest(unittest.TestCase):
+
+    def testFirstFitPacking(self):
+        pump, link, clock = makePump()
+        aliquots = [(2, 600), (3, 400), (4, 300), (5, 700)]
+        exec_time = pump.dispenseMany(aliquots, 1, execute=False)
+        strokes = strokeVolumes(pump.cmd_chain, 1)
+        self.assertEqual(len(strokes), 2)
+        dispensed = sorted((port, steps) for stroke in strokes
+                           for port, steps in stroke)
+        self.assertEqual(dispensed, [(2, 1800), (3, 1200), (4, 900),
+                                     (5, 2100)])
+        self.assertAlmostEqual(runChain(pump, clock), exec_time, delta=0.1)
+        self.assertEqual(pump.getPlungerPos(), 0)
+
+    def testPreserveOrder(self):
+        pump, link, clock = makePump()
+        aliquots = [(2, 600), (3, 400), (4, 300), (5, 700)]
+        pump.dispenseMany(aliquots, 1, preserve_order=True, execute=False)
+        strokes = strokeVolumes(pump.cmd_chain, 1)
+        self.assertEqual([[port for port, _ in stroke] for stroke in strokes],
+                         [[2, 3], [4, 5]])
+
+    def testLargeAliquotIsSplit(self):
+        pump, link, clock = makePump()
+        pump.dispenseMany([(2, 2500)], 1, execute=False)
+        strokes = strokeVolumes(pump.cmd_chain, 1)
+        self.assertEqual(len(strokes), 3)
+        self.assertEqual(sum(steps for stroke in strokes
+                             for _, steps in stroke), 7500)
+
+    def testWasteLimitsCapacity(self):
+        pump, link, clock = makePump()
+        self.assertRaises(ValueError, pump.dispenseMany, [(2, 100)], 1,
+                          pre_waste_ul=500, post_waste_ul=500)
+
+    def testNothingToDispense(self):
+        pump, link, clock = makePump()
+        cmd_count = link.cmd_count
+        self.assertEqual(pump.dispenseMany([], 1), 0)
+        self.assertEqual(link.cmd_count, cmd_count)
+
+
+class RecoveryTest(unittest.TestCase):
+
+    def failMove(self, err_code):
+        pump, link, clock = makePump()
+        pump.changePort(3)
+        pump.movePlungerAbs(1000)
+        runChain(pump, clock)
+        link.injectError(err_code, after_cmds=1)
+        pump.changePort(5)
+        pump.movePlungerAbs(2000)
+        runChain(pump, clock)
+        return pump, link
+
+    def assertRecovered(self, pump, link, err_code, action):
+        self.assertEqual(pump.last_recovery['error'], err_code)
+        self.assertEqual(pump.last_recovery['action'], action)
+        self.assertEqual(link.error, 0)
+        self.assertEqual(pump.getPlungerPos(), 2000)
+        self.assertEqual(pump.getCurPort(), 5)
+
+    def testNotInitialized(self):
+        pump, link = self.failMove(7)
+        self.assertRecovered(pump, link, 7, 'init+replay')
+
+    def testPlungerOverload(self):
+        pump, link = self.failMove(9)
+        self.assertRecovered(pump, link, 9, 'init+resume')
+        self.assertTrue(link.initialized)
+
+    def testValveOverload(self):
+        pump, link = self.failMove(10)
+        self.assertRecovered(pump, link, 10, 'valve+resume')
+
+    def testUninitializedAtStart(self):
+        clock = VirtualClock()
+        link = SimulatedLink(clock=clock, initialized=False)
+        pump = XCaliburD(link)
+        pump.movePlungerAbs(500)
+        runChain(pump, clock)
+        self.assertEqual(pump.last_recovery['action'], 'init+replay')
+        self.assertEqual(pump.getPlungerPos(), 500)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+"""
+test_sync_flow.py
+
+Timing tests for `SyncStart` and `ContinuousFlow` on simulated pumps
+sharing a virtual clock.
+
+"""
+import unittest
+
+from tecancavro.calibration import TimingCalibration
+from tecancavro.flow import ContinuousFlow
+from tecancavro.models import XCaliburD
+from tecancavro.simulator import SimulatedLink, VirtualClock
+from tecancavro.sync import SyncStart
+from tecancavro.syringe import SyringeTimeout
+
+
+def makePumps(num_pumps, calibrations=None, **link_kwargs):
+    clock = VirtualClock()
+    links = []
+    pumps = []
+    for i in range(num_pumps):
+        calibration = calibrations[i] if calibrations else None
+        link = SimulatedLink(clock=clock, calibration=calibration,
+                             **link_kwargs)
+        pump = XCaliburD(link)
+        pump.init()
+        pump.waitReady(polling_interval=0.01)
+        links.append(link)
+        pumps.append(pump)
+    return pumps, links, clock
+
+
+class SyncStartTest(unittest.TestCase):
+
+    def setUp(self):
+        pumps, self.links, self.clock = makePumps(4, latency=0.004)
+        self.pumps = dict(('p{0}'.format(i), pump)
+                          for i, pump in enumerate(pumps))
+        # Different setup moves, so the pumps reach the halt at different
+        # times
+        for i, name in enumerate(sorted(self.pumps)):
+            self.pumps[name].extract(i + 1, 100 * (i + 1))
+
+    def armAndRelease(self, sync):
+        sync.arm(dict((name, lambda pump: pump.dispense(8, 50))
+                      for name in self.pumps))
+        for link in self.links:
+            self.assertEqual(link.halted_pin, sync.input_pin)
+        report = sync.release()
+        sync.wait()
+        for i, name in enumerate(sorted(self.pumps)):
+            self.assertEqual(self.pumps[name].getPlungerPos(),
+                             300 * (i + 1) - 150)
+            self.assertEqual(self.pumps[name].getCurPort(), 8)
+        return report
+
+    def testSoftwareRelease(self):
+        report = self.armAndRelease(SyncStart(self.pumps))
+        self.assertEqual(report['mode'], 'direct')
+        self.assertEqual(sorted(report['released']), sorted(self.pumps))
+        for name, start_time in report['start_times'].items():
+            earliest, latest = report['release_windows'][name]
+            self.assertTrue(earliest <= start_time <= latest)
+        self.assertGreaterEqual(report['skew'],
+                                max(report['start_times'].values()) -
+                                min(report['start_times'].values()))
+        self.assertLess(report['skew'], 0.1)
+
+    def testTTLRelease(self):
+        def trigger():
+            for link in self.links:
+                link.triggerInput(1)
+
+        report = self.armAndRelease(SyncStart(self.pumps, input_pin=1,
+                                              trigger=trigger))
+        self.assertEqual(report['mode'], 'ttl')
+        self.assertEqual(len(set(report['start_times'].values())), 1)
+
+    def testArmTimeoutCancelsChains(self):
+        slow = self.pumps['p1']
+        slow.setSpeed(40)
+        slow.movePlungerAbs(3000)
+        sync = SyncStart(self.pumps, timeout=5)
+        self.assertRaises(SyringeTimeout, sync.arm,
+                          dict((name, lambda pump: pump.dispense(8, 50))
+                               for name in self.pumps))
+        for link in self.links:
+            self.assertEqual(link._buffer, [])
+            self.assertEqual(link.halted_pin, None)
+        for pump in self.pumps.values():
+            self.assertEqual(pump.cmd_chain, '')
+
+
+class ContinuousFlowTest(unittest.TestCase):
+
+    def runFlow(self, flow_ul_s, strokes):
+        pumps, links, clock = makePumps(2)
+        flow = ContinuousFlow(pumps, 1, 9, flow_ul_s)
+        start = clock.time()
+        stats = flow.run(strokes=strokes)
+        self.assertEqual(stats['strokes'], strokes)
+        self.assertAlmostEqual(stats['delivered_ul'],
+                               strokes * flow.stroke_ul)
+        self.assertEqual(stats['late_strokes'], 0)
+        return flow, clock.time() - start
+
+    def testStrokeTiming(self):
+        for flow_ul_s in (10.0, 100.0, 500.0):
+            flow, short_time = self.runFlow(flow_ul_s, 2)
+            flow, long_time = self.runFlow(flow_ul_s, 7)
+            period = flow.plan['period']
+            self.assertAlmostEqual(period, flow.stroke_ul / flow_ul_s,
+                                   delta=flow.tolerance * period)
+            # Both runs prime the same way, so the extra strokes take
+            # exactly one period each
+            self.assertAlmostEqual((long_time - short_time) / 5, period,
+                                   places=6)
+
+    def testRefillTooSlow(self):
+        pumps, links, clock = makePumps(2)
+        self.assertRaises(ValueError, ContinuousFlow, pumps, 1, 9, 900.0)
+
+    def testLateRefills(self):
+        slow = TimingCalibration()
+        slow.plunger_scale = 1.6
+        pumps, links, clock = makePumps(2, [TimingCalibration(), slow])
+        flow = ContinuousFlow(pumps, 1, 9, 500.0)
+        stats = flow.run(strokes=10)
+        self.assertEqual(stats['strokes'], 10)
+        self.assertGreater(stats['late_strokes'], 0)
+        self.assertGreater(stats['max_lateness'], 0)
+
+    def testAbortCleansUp(self):
+        stuck = TimingCalibration()
+        stuck.plunger_scale = 20
+        pumps, links, clock = makePumps(2, [TimingCalibration(), stuck])
+        flow = ContinuousFlow(pumps, 1, 9, 100.0, late_limit=1)
+        self.assertRaises(SyringeTimeout, flow.run, strokes=8)
+        for link in links:
+            self.assertEqual(link._buffer, [])
+            self.assertEqual(link.halted_pin, None)
+        for pump in pumps:
+            self.assertEqual(pump.cmd_chain, '')
+
+
+if __name__ == '__main__':
+    unittest.main()